@@ -0,0 +1,87 @@
+import os, sys, getopt, json
+
+from dhsvm_harness import metrics, metrics_cache
+from dhsvm_harness.settings import FLOW_METRICS, METRICS_CACHE_DIR
+
+def main(argv):
+    help_text = "usage: compare_flow_metrics.py -b <path to the baseline Stream.Flow file> -t <path to the treatment Stream.Flow file> -o <path to output json file> -s <numeric segment id (default: all)> -m <comma-separated flow metrics (default: all)> -w <worker processes (default: 1)> -n (skip the metrics cache)"
+    baseline_flow = False
+    treatment_flow = False
+    output_file = False
+    segment_id = 'all'
+    metric_keys = None
+    workers = 1
+    use_cache = METRICS_CACHE_DIR != None
+
+    try:
+        opts, args = getopt.getopt(argv, "hb:t:o:s:m:w:n", ["baseline_flow=", "treatment_flow=", "output_file=", "segment_id=", "metrics=", "workers=", "no_cache"])
+    except getopt.GetoptError:
+        print(help_text)
+        sys.exit(2)
+
+    for (opt, arg) in opts:
+        if opt == "-h":
+            print(help_text)
+            sys.exit()
+        elif opt in ("-b", "--baseline_flow"):
+            baseline_flow = arg
+        elif opt in ("-t", "--treatment_flow"):
+            treatment_flow = arg
+        elif opt in ("-o", "--output_file"):
+            output_file = arg
+        elif opt in ("-s", "--segment_id"):
+            segment_id = arg
+        elif opt in ("-m", "--metrics"):
+            metric_keys = [x.strip() for x in arg.split(',') if x.strip()]
+        elif opt in ("-w", "--workers"):
+            try:
+                workers = int(arg)
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                print("Workers (-w) must be a positive integer.")
+                print(help_text)
+                sys.exit(1)
+        elif opt in ("-n", "--no_cache"):
+            use_cache = False
+
+    for (flag, flow_file) in [('-b', baseline_flow), ('-t', treatment_flow)]:
+        if not flow_file or not os.path.isfile(flow_file):
+            print("Please provide an existing Stream.Flow file for %s." % flag)
+            print(help_text)
+            sys.exit(1)
+    if not output_file:
+        print("Please provide an output (-o) file to write the comparison to.")
+        print(help_text)
+        sys.exit(1)
+    if segment_id != 'all':
+        try:
+            segment_id = metrics.format_segment_id(segment_id)
+        except ValueError as e:
+            print("%s. Quitting...\n" % e)
+            sys.exit(1)
+    for metric_key in metric_keys if metric_keys else []:
+        if not metric_key in FLOW_METRICS.keys():
+            print("Unknown flow metric '%s'. Choose from: %s" % (metric_key, ', '.join(FLOW_METRICS.keys())))
+            sys.exit(1)
+
+    if os.path.isfile(output_file):
+        confirmation = input('%s exists. Do you want to overwrite this file? [y/N]\n' % output_file)
+        if confirmation.lower() in ['y','yes']:
+            os.remove(output_file)
+        else:
+            print("Script terminated by user.")
+            sys.exit(0)
+
+    segment_ids = None if segment_id == 'all' else [segment_id]
+    cache_dir = METRICS_CACHE_DIR if use_cache else None
+    baseline_results = metrics_cache.get_cached_segment_results(baseline_flow, segment_ids, metric_keys, workers, cache_dir=cache_dir)
+    treatment_results = metrics_cache.get_cached_segment_results(treatment_flow, segment_ids, metric_keys, workers, cache_dir=cache_dir)
+    comparison = metrics.compare_segment_results(baseline_results, treatment_results, metric_keys)
+
+    with open(output_file, 'w') as f:
+        json.dump(metrics.comparison_to_json(comparison), f)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,168 @@
+from datetime import datetime
+import mmap
+import os
+
+import numpy
+
+# Stream.Flow files are written one timestep block at a time, each block
+#   listing the SAVE segments in the same order (optionally closed by a
+#   '"Totals"' line). The index records where every block starts and where
+#   each segment's row sits inside it, so readers can seek straight to a time
+#   window or a subset of segments instead of scanning the whole file.
+
+INDEX_SUFFIX = '.idx.npz'
+TOTALS_SEGMENT = 'Totals'
+TIMESTAMP_FORMAT = "%m.%d.%Y-%H:%M:%S"
+
+def get_index_path(flow_file):
+    return "%s%s" % (flow_file, INDEX_SUFFIX)
+
+def build_stream_flow_index(flow_file):
+    block_timestamps = []
+    block_offsets = []
+    row_offsets = []        # per block: offset of each row from the block start
+    segment_ids = None
+    block_segments = []
+    current_timestamp = None
+    position = 0
+    with open(flow_file, 'rb') as f:
+        for line in f:
+            data = line.split()
+            if not data:
+                position += len(line)
+                continue
+            timestamp = data[0].decode()
+            if timestamp != current_timestamp:
+                if current_timestamp != None:
+                    segment_ids = check_block_segments(segment_ids, block_segments, current_timestamp)
+                block_timestamps.append(timestamp)
+                block_offsets.append(position)
+                row_offsets.append([])
+                block_segments = []
+                current_timestamp = timestamp
+            row_offsets[-1].append(position - block_offsets[-1])
+            block_segments.append(line.rsplit(b'"', 2)[-2].decode())
+            position += len(line)
+    if current_timestamp != None:
+        segment_ids = check_block_segments(segment_ids, block_segments, current_timestamp)
+    block_offsets.append(position)
+
+    return {
+        'timestamps': numpy.array(block_timestamps, dtype=str),
+        'times': numpy.array([datetime.strptime(x, TIMESTAMP_FORMAT) for x in block_timestamps], dtype='datetime64[s]'),
+        'block_offsets': numpy.array(block_offsets, dtype=numpy.int64),
+        'row_offsets': numpy.array(row_offsets, dtype=numpy.int64).reshape(len(block_timestamps), len(segment_ids) if segment_ids else 0),
+        'segment_ids': numpy.array(segment_ids if segment_ids else [], dtype=str),
+        'file_size': numpy.int64(position),
+        'file_mtime': numpy.float64(os.path.getmtime(flow_file)),
+    }
+
+def check_block_segments(segment_ids, block_segments, timestamp):
+    if segment_ids == None:
+        return block_segments
+    if block_segments != segment_ids:
+        raise ValueError("Timestep %s does not list the same segments as the first timestep" % timestamp)
+    return segment_ids
+
+def save_stream_flow_index(index, index_file):
+    with open(index_file, 'wb') as f:
+        numpy.savez(f, **index)
+
+def load_stream_flow_index(index_file):
+    with numpy.load(index_file) as index_data:
+        return {key: index_data[key] for key in index_data.files}
+
+def is_index_current(index, flow_file):
+    stat = os.stat(flow_file)
+    return int(index['file_size']) == stat.st_size and float(index['file_mtime']) == stat.st_mtime
+
+def get_stream_flow_index(flow_file, build=True):
+    # Load the side-car index if it still matches the flow file, otherwise
+    #   (re)build it. Returns None when there is no current index and build is False.
+    index_file = get_index_path(flow_file)
+    if os.path.isfile(index_file):
+        index = load_stream_flow_index(index_file)
+        if is_index_current(index, flow_file):
+            return index
+    if not build:
+        return None
+    index = build_stream_flow_index(flow_file)
+    try:
+        save_stream_flow_index(index, index_file)
+    except OSError as e:
+        print("Unable to save Stream.Flow index %s: %s" % (index_file, e))
+    return index
+
+def to_datetime64(value):
+    if value == None:
+        return None
+    if isinstance(value, str):
+        value = datetime.strptime(value, TIMESTAMP_FORMAT)
+    if getattr(value, 'tzinfo', None):
+        # Stream.Flow timestamps are naive local model time
+        value = value.replace(tzinfo=None)
+    return numpy.datetime64(value, 's')
+
+def get_block_range(index, start=None, end=None):
+    # [first, last) block positions with start <= time <= end; start and end
+    #   may be Stream.Flow timestamp strings or datetimes
+    times = index['times']
+    first = 0 if start == None else int(numpy.searchsorted(times, to_datetime64(start), side='left'))
+    last = times.size if end == None else int(numpy.searchsorted(times, to_datetime64(end), side='right'))
+    return (first, max(first, last))
+
+def get_segment_ids(index):
+    # the file's SAVE segments: every indexed row except the network '"Totals"'
+    return [str(x) for x in index['segment_ids'] if str(x) != TOTALS_SEGMENT]
+
+def get_row_positions(index, segment_ids):
+    segment_list = list(index['segment_ids'])
+    positions = []
+    for segment_id in segment_ids:
+        if segment_id in segment_list:
+            positions.append(segment_list.index(segment_id))
+    return sorted(set(positions))
+
+def iter_indexed_rows(flow_file, index, segment_ids=None, start=None, end=None):
+    # Yield (block, line) for the requested segments (all when None) within the
+    #   requested time window, touching only those bytes of the file.
+    (first, last) = get_block_range(index, start, end)
+    block_offsets = index['block_offsets']
+    if first >= last or block_offsets[-1] == 0:
+        return
+    row_offsets = index['row_offsets']
+    row_count = row_offsets.shape[1]
+    rows = None if segment_ids == None else get_row_positions(index, segment_ids)
+    with open(flow_file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as flow_map:
+            for block in range(first, last):
+                block_start = block_offsets[block]
+                if rows == None:
+                    for line in flow_map[block_start:block_offsets[block+1]].decode().splitlines(True):
+                        if line.strip():
+                            yield (block, line)
+                    continue
+                for row in rows:
+                    line_start = block_start + row_offsets[block, row]
+                    if row + 1 < row_count:
+                        line_end = block_start + row_offsets[block, row+1]
+                    else:
+                        line_end = block_offsets[block+1]
+                    yield (block, flow_map[line_start:line_end].decode())
+
+def read_indexed_lines(flow_file, index, segment_ids=None, start=None, end=None):
+    for (block, line) in iter_indexed_rows(flow_file, index, segment_ids, start, end):
+        yield line
+
+def iter_indexed_batches(flow_file, index, segment_ids=None, start=None, end=None, batch_size=10000):
+    # Batches shaped like utils.iterStreamFlowBatches: (lines, bytes covered so far)
+    block_offsets = index['block_offsets']
+    batch = []
+    block = None
+    for (block, line) in iter_indexed_rows(flow_file, index, segment_ids, start, end):
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield (batch, int(block_offsets[block+1]))
+            batch = []
+    if batch:
+        yield (batch, int(block_offsets[block+1]))
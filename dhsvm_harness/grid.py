@@ -0,0 +1,148 @@
+import os
+
+import numpy
+
+from dhsvm_harness.settings import SUPERBASINS
+
+# DHSVM binary grids (*.asc.bin) are headerless dumps of the grid values, row
+#   by row from the northern edge, in the machine's native byte order: the same
+#   bytes myconvert writes from an AAIGrid with its 6-line header removed.
+#   Grid dimensions and georeferencing live in the DHSVM INPUT file instead.
+
+# myconvert data type: numpy dtype written for each value
+DHSVM_DATA_TYPES = {
+    'character': numpy.uint8,
+    'short_integer': numpy.int16,
+    'integer': numpy.int32,
+    'float': numpy.float32,
+    'double': numpy.float64,
+}
+
+# myconvert data type and nodata value of each basin input grid, by the part
+#   of the file name following the basin name
+#   ASSUMPTION: basin name never contains '_'
+GRID_DATA_TYPES = {
+    "_dem": {
+        "type": "float",
+        "nodata": -9999
+    },
+    "_dir": {
+        "type": "character",
+        "nodata": 0
+    },
+    "_mask": {
+        "type": "character",
+        "nodata": 0
+    },
+    "_soild": {
+        "type": "float",
+        "nodata": -9999
+    },
+    "_soiltype": {
+        "type": "character",
+        "nodata": 0
+    },
+    "_veg": {
+        "type": "character",
+        "nodata": 0
+    }
+}
+
+DEFAULT_CELLSIZE = 90
+
+def get_grid_array(array):
+    # rasterio reads are (band, row, col): DHSVM grids are a single band
+    array = numpy.asarray(array)
+    if array.ndim == 3:
+        if array.shape[0] != 1:
+            raise ValueError("Expected a single band grid, got %d bands" % array.shape[0])
+        array = array[0]
+    if array.ndim != 2:
+        raise ValueError("Expected a 2 dimensional grid, got shape %s" % (array.shape,))
+    return array
+
+def write_dhsvm_binary(array, out_file, data_type='character'):
+    if not data_type in DHSVM_DATA_TYPES.keys():
+        raise ValueError("Unknown DHSVM data type '%s'. Choose from: %s" % (data_type, ', '.join(DHSVM_DATA_TYPES.keys())))
+    array = get_grid_array(array)
+    dtype = numpy.dtype(DHSVM_DATA_TYPES[data_type])
+    if dtype.kind in 'iu' and array.size:
+        (low, high) = (numpy.iinfo(dtype).min, numpy.iinfo(dtype).max)
+        if array.min() < low or array.max() > high:
+            raise ValueError("Grid values fall outside the range of DHSVM type '%s' (%s to %s)" % (data_type, low, high))
+    numpy.ascontiguousarray(array, dtype=dtype).tofile(out_file)
+    return out_file
+
+def read_dhsvm_binary(bin_file, nrows, ncols, data_type='character'):
+    dtype = numpy.dtype(DHSVM_DATA_TYPES[data_type])
+    expected_size = nrows*ncols*dtype.itemsize
+    if os.path.getsize(bin_file) != expected_size:
+        raise ValueError("%s is not a %d x %d '%s' grid" % (bin_file, nrows, ncols, data_type))
+    return numpy.fromfile(bin_file, dtype=dtype).reshape(nrows, ncols)
+
+# ======================================
+# MEMORY-MAPPED GRIDS
+# ======================================
+
+def get_grid_data_type(file_name):
+    # GRID_DATA_TYPES entry for a basin input file, or None if it isn't a grid
+    grid_data_type = None
+    for key in GRID_DATA_TYPES.keys():
+        if key in os.path.basename(file_name):
+            grid_data_type = GRID_DATA_TYPES[key]
+    return grid_data_type
+
+def get_grid_shape(grid_def):
+    # (nrows, ncols) from a SUPERBASINS entry or a masks/parent_basin.py dict
+    if not 'nrows' in grid_def or not 'ncols' in grid_def:
+        raise ValueError("Grid dimensions (nrows, ncols) are not defined for %s" % grid_def.get('name', 'this basin'))
+    return (int(grid_def['nrows']), int(grid_def['ncols']))
+
+def get_superbasin_grid_def(superbasin_code):
+    grid_def = SUPERBASINS[superbasin_code]
+    get_grid_shape(grid_def)
+    return grid_def
+
+def open_dhsvm_grid(bin_file, grid_def, data_type=None, mode='r'):
+    # A *.asc.bin as a (nrows, ncols) numpy.memmap: slices are views onto the
+    #   file, so windowed reads and writes never copy the whole grid. data_type
+    #   defaults to the GRID_DATA_TYPES entry matching the file name. mode 'w+'
+    #   creates (or overwrites) the file.
+    if data_type == None:
+        grid_data_type = get_grid_data_type(bin_file)
+        if grid_data_type == None:
+            raise ValueError("No DHSVM data type known for %s" % bin_file)
+        data_type = grid_data_type['type']
+    dtype = numpy.dtype(DHSVM_DATA_TYPES[data_type])
+    (nrows, ncols) = get_grid_shape(grid_def)
+    if mode != 'w+' and os.path.getsize(bin_file) != nrows*ncols*dtype.itemsize:
+        raise ValueError("%s is not a %d x %d '%s' grid" % (bin_file, nrows, ncols, data_type))
+    return numpy.memmap(bin_file, dtype=dtype, mode=mode, shape=(nrows, ncols))
+
+def get_extreme_north(grid_def):
+    if 'extreme_north' in grid_def:
+        return float(grid_def['extreme_north'])
+    return float(grid_def['yllcorner']) + int(grid_def['nrows'])*float(grid_def.get('cellsize', DEFAULT_CELLSIZE))
+
+def get_grid_window(grid_def, sub_grid_def):
+    # (row offset, col offset, nrows, ncols) of sub_grid_def within grid_def.
+    #   Both grids share a cell size and alignment; rows count down from the north.
+    cellsize = float(grid_def.get('cellsize', DEFAULT_CELLSIZE))
+    col_offset = int(round((float(sub_grid_def['xllcorner']) - float(grid_def['xllcorner']))/cellsize))
+    row_offset = int(round((get_extreme_north(grid_def) - get_extreme_north(sub_grid_def))/cellsize))
+    (nrows, ncols) = get_grid_shape(sub_grid_def)
+    (grid_nrows, grid_ncols) = get_grid_shape(grid_def)
+    if row_offset < 0 or col_offset < 0 or row_offset + nrows > grid_nrows or col_offset + ncols > grid_ncols:
+        raise ValueError("Window (%d, %d, %d, %d) falls outside the %d x %d grid" % (row_offset, col_offset, nrows, ncols, grid_nrows, grid_ncols))
+    return (row_offset, col_offset, nrows, ncols)
+
+def read_grid_window(grid, window):
+    # a view: nothing is read from disk until the values are used
+    (row_offset, col_offset, nrows, ncols) = window
+    return grid[row_offset:row_offset+nrows, col_offset:col_offset+ncols]
+
+def write_grid_window(grid, window, values):
+    (row_offset, col_offset, nrows, ncols) = window
+    grid[row_offset:row_offset+nrows, col_offset:col_offset+ncols] = values
+    if isinstance(grid, numpy.memmap):
+        grid.flush()
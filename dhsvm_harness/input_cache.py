@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from dhsvm_harness.settings import INPUTS_CACHE_DIR, INPUTS_CACHE_MAX_BYTES
+
+# Generated run inputs (the contents of a run's ts_inputs dir: treated veg
+#   layer, stream network, mask) are stored under <cache dir>/<key>/, where the
+#   key hashes everything they are generated from. A run whose key is already
+#   cached gets its ts_inputs as hardlinks instead of regenerating them.
+#   Cached files are shared between runs, so they must never be written in
+#   place: AAIGrid (.asc) files, which binAsciis rewrites, are not cached.
+#   An entry's directory mtime is touched on each hit and drives LRU eviction
+#   once the cache grows past its byte budget. Hardlinked files are charged to
+#   the cache, not to the run dirs sharing them (see scratch.get_dir_size).
+
+MANIFEST_FILE = 'manifest.json'
+UNCACHED_EXTENSIONS = ['.asc']
+
+def get_inputs_key(key_data):
+    # key_data: any JSON-serializable description of what the inputs are built from
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode()).hexdigest()
+
+def get_file_signature(file_path):
+    # (path, size, mtime) so that replacing a source raster invalidates its entries
+    if not os.path.isfile(file_path):
+        return [file_path, None, None]
+    stat = os.stat(file_path)
+    return [file_path, stat.st_size, stat.st_mtime]
+
+def link_file(source_path, target_path):
+    # hardlink where possible, copy across filesystems
+    if os.path.lexists(target_path):
+        os.remove(target_path)
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copy2(source_path, target_path)
+
+def get_input_files(source_dir):
+    # names of the files in source_dir that can be shared between runs
+    return [x for x in sorted(os.listdir(source_dir)) if os.path.isfile(os.path.join(source_dir, x)) and not os.path.splitext(x)[-1] in UNCACHED_EXTENSIONS]
+
+def link_inputs(source_dir, target_dir, file_names=None):
+    # Link a run's generated inputs into another run's ts_inputs. Returns the
+    #   file names linked.
+    if file_names == None:
+        file_names = get_input_files(source_dir)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    for file_name in file_names:
+        link_file(os.path.join(source_dir, file_name), os.path.join(target_dir, file_name))
+    return file_names
+
+def fetch_inputs(key, target_dir, cache_dir=INPUTS_CACHE_DIR):
+    # Link a cached input set into target_dir. Returns the file names linked,
+    #   or None on a miss (or when caching is disabled).
+    if not cache_dir:
+        return None
+    entry_dir = os.path.join(cache_dir, key)
+    manifest_file = os.path.join(entry_dir, MANIFEST_FILE)
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file, 'r') as f:
+        file_names = json.load(f)
+    for file_name in file_names:
+        if not os.path.isfile(os.path.join(entry_dir, file_name)):
+            return None
+    link_inputs(entry_dir, target_dir, file_names)
+    os.utime(entry_dir)
+    return file_names
+
+def store_inputs(key, source_dir, cache_dir=INPUTS_CACHE_DIR, max_bytes=INPUTS_CACHE_MAX_BYTES):
+    # Cache the files in source_dir under key. The entry is assembled in a
+    #   temporary dir and renamed into place, so readers never see a partial
+    #   input set; if another run stored the same key first, that entry is kept.
+    if not cache_dir:
+        return None
+    entry_dir = os.path.join(cache_dir, key)
+    if os.path.isfile(os.path.join(entry_dir, MANIFEST_FILE)):
+        return entry_dir
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.%s.' % key)
+    try:
+        file_names = link_inputs(source_dir, tmp_dir)
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+            json.dump(file_names, f)
+        if os.path.isdir(entry_dir):
+            # an incomplete entry left by an interrupted run
+            shutil.rmtree(entry_dir)
+        os.rename(tmp_dir, entry_dir)
+    except OSError as e:
+        print("Unable to cache run inputs %s: %s" % (key, e))
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+    evict_entries(cache_dir, max_bytes, keep=entry_dir)
+    return entry_dir
+
+def get_entry_size(entry_dir):
+    size = 0
+    for file_name in os.listdir(entry_dir):
+        size += os.path.getsize(os.path.join(entry_dir, file_name))
+    return size
+
+def evict_entries(cache_dir, max_bytes, keep=None):
+    # Remove least recently used entries (by directory mtime) until the cache
+    #   fits in max_bytes. 'keep' (the entry just written) and entries still
+    #   being written (.<key>.* temp dirs) are never evicted.
+    entries = []
+    for entry_name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, entry_name)
+        if not entry_name.startswith('.') and os.path.isdir(entry_dir):
+            entries.append((os.path.getmtime(entry_dir), get_entry_size(entry_dir), entry_dir))
+    total = sum([x[1] for x in entries])
+    evicted = []
+    for (mtime, size, entry_dir) in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep and os.path.realpath(entry_dir) == os.path.realpath(keep):
+            continue
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+        evicted.append(entry_dir)
+    return evicted
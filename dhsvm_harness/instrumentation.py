@@ -0,0 +1,142 @@
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+import json
+import os
+import resource
+import statistics
+import time
+
+from dhsvm_harness.settings import RUN_TRACES_DIR
+
+# Per-stage resource use of a harness run. Each stage records wall time, CPU
+#   time of this process and of the child processes it waited for (DHSVM's
+#   mpiexec, import workers), the peak RSS so far and the bytes read/written
+#   from /proc/self/io, which also counts waited-for children. A run's trace
+#   is written as JSON to RUN_TRACES_DIR/<run>_<start time>.json; see
+#   summarize_traces to aggregate them.
+
+IO_FIELDS = {
+    'read_bytes': 'read_bytes',       # from storage
+    'write_bytes': 'write_bytes',
+    'rchar': 'read_chars',            # including page cache hits, pipes
+    'wchar': 'write_chars',
+}
+
+def read_proc_io():
+    # {field: bytes} from /proc/self/io, or {} where it isn't available
+    counters = {}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                (field, value) = line.split(':')
+                if field in IO_FIELDS.keys():
+                    counters[IO_FIELDS[field]] = int(value)
+    except (OSError, ValueError):
+        return {}
+    return counters
+
+def get_usage_snapshot():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'wall': time.perf_counter(),
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'children_cpu': children_usage.ru_utime + children_usage.ru_stime,
+        # kilobytes on Linux; high-water marks, not per stage
+        'max_rss_kb': usage.ru_maxrss,
+        'children_max_rss_kb': children_usage.ru_maxrss,
+        'io': read_proc_io(),
+    }
+
+def get_usage_delta(start, end):
+    record = {
+        'wall_seconds': end['wall'] - start['wall'],
+        'cpu_seconds': end['cpu'] - start['cpu'],
+        'children_cpu_seconds': end['children_cpu'] - start['children_cpu'],
+        'max_rss_kb': end['max_rss_kb'],
+        'children_max_rss_kb': end['children_max_rss_kb'],
+    }
+    for field in IO_FIELDS.values():
+        if field in start['io'] and field in end['io']:
+            record[field] = end['io'][field] - start['io'][field]
+        else:
+            record[field] = None
+    return record
+
+class RunTrace(object):
+    # with trace.stage('setVegLayers'): ... records one stage; trace.write()
+    #   saves the run's stages once it is done
+    def __init__(self, run_name, trace_dir=RUN_TRACES_DIR, **context):
+        self.run_name = run_name
+        self.trace_dir = trace_dir
+        self.context = context
+        self.started = datetime.now()
+        self.start_usage = get_usage_snapshot()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        start_usage = get_usage_snapshot()
+        started = datetime.now()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            record = {'stage': name, 'started': started.isoformat()}
+            record.update(get_usage_delta(start_usage, get_usage_snapshot()))
+            if error:
+                record['error'] = error
+            self.stages.append(record)
+
+    def to_dict(self):
+        total = {'stage': 'total', 'started': self.started.isoformat()}
+        total.update(get_usage_delta(self.start_usage, get_usage_snapshot()))
+        return {
+            'run': self.run_name,
+            'pid': os.getpid(),
+            'context': self.context,
+            'stages': self.stages,
+            'total': total,
+        }
+
+    def write(self, trace_dir=None):
+        # path of the JSON trace, or None when tracing to disk is disabled
+        trace_dir = trace_dir if trace_dir else self.trace_dir
+        if not trace_dir:
+            return None
+        if not os.path.isdir(trace_dir):
+            os.makedirs(trace_dir)
+        trace_file = os.path.join(trace_dir, '%s_%s.json' % (self.run_name, self.started.strftime('%Y%m%d%H%M%S%f')))
+        with open(trace_file, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        return trace_file
+
+def trace_stage(trace, name):
+    # trace.stage(name), or nothing for untraced calls
+    return trace.stage(name) if trace != None else nullcontext()
+
+def load_traces(trace_dir=RUN_TRACES_DIR):
+    traces = []
+    for file_name in sorted(os.listdir(trace_dir)):
+        if file_name.endswith('.json'):
+            with open(os.path.join(trace_dir, file_name), 'r') as f:
+                traces.append(json.load(f))
+    return traces
+
+def summarize_traces(traces, field='wall_seconds'):
+    # {stage: {count, total, mean, median, max}} of one field across traces
+    values = {}
+    for trace in traces:
+        for record in trace['stages'] + [trace['total']]:
+            if record.get(field) != None:
+                values.setdefault(record['stage'], []).append(record[field])
+    return dict([(stage, {
+        'count': len(stage_values),
+        'total': sum(stage_values),
+        'mean': statistics.mean(stage_values),
+        'median': statistics.median(stage_values),
+        'max': max(stage_values),
+    }) for (stage, stage_values) in values.items()])
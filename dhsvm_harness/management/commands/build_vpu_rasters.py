@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dhsvm_harness.settings import SUPERBASINS
+from dhsvm_harness.utils import buildVpuRaster
+
+class Command(BaseCommand):
+    help = 'Rasterize VegPlanningUnit ids onto each superbasin veg grid for id-based treatment layers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('superbasins', nargs='*', help='superbasin codes to build (default: all)')
+
+    def handle(self, *args, **options):
+        superbasin_codes = options['superbasins'] if options['superbasins'] else list(SUPERBASINS.keys())
+        for superbasin_code in superbasin_codes:
+            if not superbasin_code in SUPERBASINS.keys():
+                raise CommandError("Unknown superbasin '%s'. Choose from: %s" % (superbasin_code, ', '.join(SUPERBASINS.keys())))
+        for superbasin_code in superbasin_codes:
+            vpu_raster_file = buildVpuRaster(superbasin_code)
+            self.stdout.write("Wrote %s" % vpu_raster_file)
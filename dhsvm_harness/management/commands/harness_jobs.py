@@ -0,0 +1,51 @@
+from datetime import datetime
+from django.conf import settings as ucsrb_settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dhsvm_harness import scheduler
+from dhsvm_harness.settings import SCHEDULER_CORES
+
+class Command(BaseCommand):
+    help = 'Queue harness runs, show their state, or run the job scheduler'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['submit', 'status', 'cancel', 'run'])
+        parser.add_argument('job_ids', nargs='*', type=int, help='jobs to show (status) or cancel (default: all jobs for status)')
+        parser.add_argument('--scenario', type=int, help='TreatmentScenario id to submit')
+        parser.add_argument('--basin', help='basin name to submit a baseline run for')
+        parser.add_argument('--weather-year', default=ucsrb_settings.NORMAL_YEAR_LABEL, help='weather year to submit (default: %(default)s)')
+        parser.add_argument('--cores', type=int, default=SCHEDULER_CORES, help='core budget for the scheduler (default: %(default)s)')
+        parser.add_argument('--until-empty', action='store_true', help='stop the scheduler once no job is waiting or running')
+
+    def handle(self, *args, **options):
+        if options['action'] == 'submit':
+            if (options['scenario'] == None) == (options['basin'] == None):
+                raise CommandError("Submit either --scenario or --basin")
+            try:
+                job_id = scheduler.submit_job(options['scenario'], options['basin'], options['weather_year'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write("Queued job %d" % job_id)
+        elif options['action'] == 'status':
+            jobs = [scheduler.get_job(x) for x in options['job_ids']] if options['job_ids'] else scheduler.list_jobs()
+            for job in jobs:
+                if job:
+                    self.stdout.write(self.format_job(job))
+        elif options['action'] == 'cancel':
+            for job_id in options['job_ids']:
+                if scheduler.cancel_job(job_id):
+                    self.stdout.write("Cancelled job %d" % job_id)
+                else:
+                    self.stderr.write("Job %d is not waiting to be prepared or modelled" % job_id)
+        elif options['action'] == 'run':
+            if options['cores'] < 1:
+                raise CommandError("--cores must be a positive integer")
+            scheduler.JobScheduler(cores=options['cores']).run(until_empty=options['until_empty'])
+
+    def format_job(self, job):
+        subject = 'scenario %s' % job['treatment_scenario_id'] if job['treatment_scenario_id'] != None else 'baseline %s' % job['basin']
+        since = job['finished'] if job['finished'] else job['stage_started'] if job['stage_started'] else job['submitted']
+        line = "%d\t%s\t%s\t%s since %s" % (job['id'], subject, job['weather_year'], job['state'], datetime.fromtimestamp(since).strftime('%Y-%m-%d %H:%M:%S'))
+        if job['error']:
+            line += '\n%s' % job['error']
+        return line
@@ -0,0 +1,498 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import struct
+import tempfile
+import zipfile
+
+import numpy
+import numpy.lib.format
+
+from dhsvm_harness.settings import FLOW_METRICS, TIMESTEP, ABSOLUTE_FLOW_METRIC
+
+# ======================================
+# PARSE STREAM FLOW SERIES
+# ======================================
+
+def format_segment_id(segment_id):
+    # A Stream.Flow segment title from a numeric id (3726, '3726': 'shed_3726')
+    #   or a full title ('metw_3726', 'shed_3726'), as given on the command line
+    segment_id = str(segment_id).strip()
+    if segment_id.isdigit():
+        return "shed_%s" % segment_id
+    elif '_' in segment_id and segment_id.split('_')[-1].isdigit():
+        return segment_id
+    raise ValueError("Unknown segment ID value: '%s'" % segment_id)
+
+def parse_flow_series(inlines, segment_ids=None):
+    # Stream Flow Columns:
+    #   https://www.pnnl.gov/sites/default/files/media/file/Network%20segment%20output%20file.pdf
+    #   0   str     Time Stamp
+    #   4   float   outflow (m^3/timestep)
+    #   -1  str     segment title, or "Totals" for the network summary line
+    # Returns an OrderedDict of segment_id: (timestamps, float64 flow rates)
+    if segment_ids:
+        segment_ids = set(segment_ids)
+    timestamps = OrderedDict()
+    readings = OrderedDict()
+    for line in inlines:
+        data = line.split()
+        if not data:
+            continue
+        segment_name = data[-1].split('"')[1]
+        if segment_ids:
+            if not segment_name in segment_ids:
+                continue
+        elif segment_name == 'Totals':
+            continue
+        if not segment_name in readings:
+            timestamps[segment_name] = []
+            readings[segment_name] = []
+        timestamps[segment_name].append(data[0])
+        readings[segment_name].append(data[4])
+
+    series = OrderedDict()
+    for segment_name in readings.keys():
+        flow = numpy.array(readings[segment_name], dtype=numpy.float64)/float(TIMESTEP)
+        series[segment_name] = (timestamps[segment_name], flow)
+    return series
+
+# ======================================
+# ROLLING WINDOW KERNELS
+# ======================================
+
+def get_window_length(metric_def):
+    # number of readings covered by a metric's period, including the current one
+    readings_per_day = 24/TIMESTEP
+    return max(1, int(metric_def['period']*readings_per_day))
+
+def rolling_mean(values, window):
+    # Mean of the trailing 'window' readings (fewer at the start of the series)
+    #   from a cumulative sum: O(n) regardless of window length.
+    count = values.size
+    result = numpy.empty(count, dtype=numpy.float64)
+    if count == 0:
+        return result
+    cumulative = numpy.cumsum(values, dtype=numpy.float64)
+    head = min(window, count)
+    result[:head] = cumulative[:head]/numpy.arange(1, head+1)
+    if count > window:
+        result[window:] = (cumulative[window:] - cumulative[:-window])/window
+    return result
+
+def rolling_low(values, window):
+    # Minimum of the trailing 'window' readings (fewer at the start of the
+    #   series) using the van Herk/Gil-Werman block prefix/suffix minima: O(n)
+    #   regardless of window length.
+    count = values.size
+    if count == 0 or window <= 1:
+        return numpy.array(values, dtype=numpy.float64)
+    block_count = -(-count//window)
+    blocks = numpy.full(block_count*window, numpy.inf)
+    blocks[:count] = values
+    blocks = blocks.reshape(block_count, window)
+    prefix = numpy.minimum.accumulate(blocks, axis=1).ravel()
+    suffix = numpy.minimum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    result = prefix[:count].copy()
+    if count >= window:
+        result[window-1:] = numpy.minimum(suffix[:count-window+1], prefix[window-1:count])
+    return result
+
+def rolling_delta(values):
+    # change since the previous reading; the first reading has no change
+    result = numpy.zeros(values.size, dtype=numpy.float64)
+    if values.size > 1:
+        result[1:] = numpy.diff(values)
+    return result
+
+# ======================================
+# METRIC REGISTRY
+# ======================================
+
+# rolling kernel for each non-delta FLOW_METRICS 'measure'
+MEASURE_KERNELS = {
+    'mean': rolling_mean,
+    'low': rolling_low,
+}
+
+def get_metric_dependencies(metric_key):
+    # delta -> its source metric -> absolute flow rate
+    if not metric_key in FLOW_METRICS.keys():
+        raise ValueError("Unknown flow metric '%s'" % metric_key)
+    metric_def = FLOW_METRICS[metric_key]
+    if metric_def['delta']:
+        return [metric_def.get('source_metric', ABSOLUTE_FLOW_METRIC)]
+    elif metric_def['measure'] == 'abs':
+        return []
+    return [ABSOLUTE_FLOW_METRIC]
+
+def resolve_metrics(metric_keys=None):
+    # The requested metrics (all of FLOW_METRICS when None) plus everything
+    #   they depend on, ordered so each metric follows its dependencies.
+    if metric_keys == None:
+        metric_keys = list(FLOW_METRICS.keys())
+    ordered = []
+    def visit(metric_key, path):
+        if metric_key in ordered:
+            return
+        if metric_key in path:
+            raise ValueError("Circular flow metric dependency: %s" % ' -> '.join(path + [metric_key]))
+        for dependency in get_metric_dependencies(metric_key):
+            visit(dependency, path + [metric_key])
+        ordered.append(metric_key)
+    for metric_key in metric_keys:
+        visit(metric_key, [])
+    return ordered
+
+def evaluate_metric(metric_key, flow, series):
+    # series holds the already-evaluated dependencies of metric_key
+    metric_def = FLOW_METRICS[metric_key]
+    if metric_def['delta']:
+        return rolling_delta(series[get_metric_dependencies(metric_key)[0]])
+    elif metric_def['measure'] == 'abs':
+        return flow
+    return MEASURE_KERNELS[metric_def['measure']](flow, get_window_length(metric_def))
+
+# ======================================
+# METRIC ENGINE
+# ======================================
+
+def compute_flow_metrics(flow, metric_keys=None, cache=None):
+    # Compute the requested FLOW_METRICS series (all when None) for a single
+    #   segment's flow rates, evaluating only what they depend on. Pass the
+    #   same 'cache' dict for a segment to reuse series across calls.
+    if cache == None:
+        cache = {}
+    for metric_key in resolve_metrics(metric_keys):
+        if not metric_key in cache:
+            cache[metric_key] = evaluate_metric(metric_key, flow, cache)
+    if metric_keys == None:
+        metric_keys = list(FLOW_METRICS.keys())
+    results = OrderedDict()
+    for metric_key in metric_keys:
+        results[metric_key] = cache[metric_key]
+    return results
+
+def get_max_window_length():
+    # readings of history needed before every metric's window is full
+    return max([get_window_length(FLOW_METRICS[x]) for x in FLOW_METRICS.keys()])
+
+class RollingFlowMetrics(object):
+    # Streaming equivalent of compute_flow_metrics for a single segment: push
+    #   one flow rate at a time and get every FLOW_METRICS value for that
+    #   timestep. Rolling means keep a running sum and rolling lows keep a
+    #   monotonic deque, so each push is O(1) amortized per metric.
+    def __init__(self):
+        self.count = 0
+        self.windows = {}           # window length: deque of recent flows
+        self.sums = {}              # window length: sum of that deque
+        self.lows = {}              # window length: deque of (position, flow), increasing flows
+        self.previous = {}          # source metric: value at the previous timestep
+        # deltas are computed after their source metrics, whatever FLOW_METRICS' order
+        self.metric_keys = resolve_metrics()
+        for metric_key in self.metric_keys:
+            metric_def = FLOW_METRICS[metric_key]
+            if not metric_def['delta'] and metric_def['measure'] != 'abs':
+                window = get_window_length(metric_def)
+                if metric_def['measure'] == 'mean':
+                    self.windows[window] = deque()
+                    self.sums[window] = 0.0
+                else:
+                    self.lows[window] = deque()
+
+    def push(self, flow):
+        position = self.count
+        self.count += 1
+        for window in self.windows.keys():
+            self.windows[window].append(flow)
+            self.sums[window] += flow
+            if len(self.windows[window]) > window:
+                self.sums[window] -= self.windows[window].popleft()
+        for window in self.lows.keys():
+            lows = self.lows[window]
+            while lows and lows[-1][1] >= flow:
+                lows.pop()
+            lows.append((position, flow))
+            while lows[0][0] <= position - window:
+                lows.popleft()
+
+        results = OrderedDict()
+        for metric_key in self.metric_keys:
+            metric_def = FLOW_METRICS[metric_key]
+            if metric_def['delta']:
+                source_metric = metric_def.get('source_metric', ABSOLUTE_FLOW_METRIC)
+                if source_metric in self.previous:
+                    results[metric_key] = results[source_metric] - self.previous[source_metric]
+                else:
+                    results[metric_key] = 0.0
+            elif metric_def['measure'] == 'abs':
+                results[metric_key] = flow
+            elif metric_def['measure'] == 'mean':
+                window = get_window_length(metric_def)
+                results[metric_key] = self.sums[window]/len(self.windows[window])
+            else:
+                results[metric_key] = self.lows[get_window_length(metric_def)][0][1]
+        for metric_key in results.keys():
+            self.previous[metric_key] = results[metric_key]
+        return results
+
+def metrics_to_json(timestamps, metrics):
+    # {metric: [{'timestep': str, 'value': float}, ...]} as written by get_flow_metrics.py
+    segment_json = {}
+    for metric_key in metrics.keys():
+        values = metrics[metric_key].tolist()
+        segment_json[metric_key] = [{'timestep': timestamp, 'value': value} for (timestamp, value) in zip(timestamps, values)]
+    return segment_json
+
+def get_segment_results(inlines, segment_ids=None, metric_keys=None, workers=1):
+    # OrderedDict of segment_id: (timestamps, {metric: values})
+    series = parse_flow_series(inlines, segment_ids)
+    segment_metrics = compute_series_metrics(series, metric_keys, workers)
+    results = OrderedDict()
+    for segment_name in series.keys():
+        results[segment_name] = (series[segment_name][0], segment_metrics[segment_name])
+    return results
+
+def get_metric_flow(inlines, segment_ids=None, metric_keys=None, workers=1):
+    return segment_results_to_json(get_segment_results(inlines, segment_ids, metric_keys, workers))
+
+def segment_results_to_json(segment_results):
+    segments = {}
+    for segment_name in segment_results.keys():
+        (timestamps, segment_metrics) = segment_results[segment_name]
+        segments[segment_name] = metrics_to_json(timestamps, segment_metrics)
+    return segments
+
+# ======================================
+# PARALLEL ENGINE
+# ======================================
+
+def compute_series_metrics(series, metric_keys=None, workers=1):
+    # {segment_id: compute_flow_metrics(...)} for parsed series, fanned out
+    #   across 'workers' processes when there is more than one segment
+    if workers > 1 and len(series) > 1:
+        return compute_series_metrics_parallel(series, metric_keys, workers)
+    segment_metrics = OrderedDict()
+    for segment_name in series.keys():
+        segment_metrics[segment_name] = compute_flow_metrics(series[segment_name][1], metric_keys)
+    return segment_metrics
+
+def compute_segment_range(flow_file, results_file, offsets, metric_keys, first, last):
+    # Worker: map the concatenated flows and the (metric x reading) results
+    #   file and fill in segments [first, last). Only file names and offsets
+    #   cross the process boundary; the series themselves are never pickled.
+    total = int(offsets[-1])
+    flows = numpy.memmap(flow_file, dtype=numpy.float64, mode='r', shape=(total,))
+    results = numpy.memmap(results_file, dtype=numpy.float64, mode='r+', shape=(len(metric_keys), total))
+    for segment in range(first, last):
+        (start, end) = (int(offsets[segment]), int(offsets[segment+1]))
+        segment_metrics = compute_flow_metrics(numpy.asarray(flows[start:end]), metric_keys)
+        for (index, metric_key) in enumerate(metric_keys):
+            results[index, start:end] = segment_metrics[metric_key]
+    results.flush()
+    del flows, results
+    return last - first
+
+def compute_series_metrics_parallel(series, metric_keys=None, workers=2):
+    if metric_keys == None:
+        metric_keys = list(FLOW_METRICS.keys())
+    segment_names = list(series.keys())
+    offsets = numpy.zeros(len(segment_names)+1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([series[x][1].size for x in segment_names])
+    total = int(offsets[-1])
+    # several chunks per worker so uneven segments still balance out
+    chunks = [x for x in numpy.array_split(numpy.arange(len(segment_names)), workers*4) if x.size]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        flow_file = os.path.join(tmp_dir, 'flows.dat')
+        results_file = os.path.join(tmp_dir, 'results.dat')
+        flows = numpy.memmap(flow_file, dtype=numpy.float64, mode='w+', shape=(max(total, 1),))
+        for (index, segment_name) in enumerate(segment_names):
+            flows[offsets[index]:offsets[index+1]] = series[segment_name][1]
+        flows.flush()
+        del flows
+        results = numpy.memmap(results_file, dtype=numpy.float64, mode='w+', shape=(len(metric_keys), max(total, 1)))
+        del results
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(compute_segment_range, flow_file, results_file, offsets, metric_keys, int(x[0]), int(x[-1])+1) for x in chunks]
+            for future in futures:
+                future.result()
+
+        results = numpy.array(numpy.memmap(results_file, dtype=numpy.float64, mode='r', shape=(len(metric_keys), max(total, 1))))
+
+    segment_metrics = OrderedDict()
+    for (index, segment_name) in enumerate(segment_names):
+        segment_metrics[segment_name] = OrderedDict()
+        for (metric_index, metric_key) in enumerate(metric_keys):
+            segment_metrics[segment_name][metric_key] = results[metric_index, offsets[index]:offsets[index+1]]
+    return segment_metrics
+
+# ======================================
+# TREATMENT VS BASELINE
+# ======================================
+
+def align_timestamps(baseline_timestamps, treatment_timestamps):
+    # Positions in each series of the timesteps both share, in baseline order.
+    #   Works on Stream.Flow timestamp strings or datetime64 arrays alike.
+    (shared, baseline_positions, treatment_positions) = numpy.intersect1d(
+        numpy.asarray(baseline_timestamps),
+        numpy.asarray(treatment_timestamps),
+        assume_unique=True,
+        return_indices=True
+    )
+    order = numpy.argsort(baseline_positions)
+    return (baseline_positions[order], treatment_positions[order])
+
+def compare_segment_results(baseline_results, treatment_results, metric_keys=None):
+    # Treatment minus baseline for segments present in both
+    #   get_segment_results-style inputs. Returns an OrderedDict of
+    #   segment_id: (shared timestamps, {metric: {'baseline', 'treatment',
+    #   'difference', 'percent'}}); percent is NaN where the baseline is 0.
+    if metric_keys == None:
+        metric_keys = list(FLOW_METRICS.keys())
+    # Segments from one run share their timesteps, so each distinct pair of
+    #   timestamp series is joined once and every segment in that group is
+    #   diffed as a (segment x timestep) matrix per metric.
+    groups = []
+    for segment_name in baseline_results.keys():
+        if not segment_name in treatment_results:
+            continue
+        baseline_timestamps = baseline_results[segment_name][0]
+        treatment_timestamps = treatment_results[segment_name][0]
+        for group in groups:
+            if numpy.array_equal(group['baseline'], baseline_timestamps) and numpy.array_equal(group['treatment'], treatment_timestamps):
+                group['segments'].append(segment_name)
+                break
+        else:
+            groups.append({'baseline': baseline_timestamps, 'treatment': treatment_timestamps, 'segments': [segment_name]})
+
+    comparison = OrderedDict()
+    for group in groups:
+        (baseline_positions, treatment_positions) = align_timestamps(group['baseline'], group['treatment'])
+        timestamps = list(numpy.asarray(group['baseline'])[baseline_positions])
+        for segment_name in group['segments']:
+            comparison[segment_name] = (timestamps, OrderedDict())
+        for metric_key in metric_keys:
+            baseline = numpy.array([baseline_results[x][1][metric_key] for x in group['segments']], dtype=numpy.float64)[:, baseline_positions]
+            treatment = numpy.array([treatment_results[x][1][metric_key] for x in group['segments']], dtype=numpy.float64)[:, treatment_positions]
+            difference = treatment - baseline
+            percent = numpy.full(difference.shape, numpy.nan)
+            numpy.divide(difference*100.0, baseline, out=percent, where=baseline != 0)
+            for (index, segment_name) in enumerate(group['segments']):
+                comparison[segment_name][1][metric_key] = {
+                    'baseline': baseline[index],
+                    'treatment': treatment[index],
+                    'difference': difference[index],
+                    'percent': percent[index],
+                }
+    return comparison
+
+def compare_flow_lines(baseline_inlines, treatment_inlines, segment_ids=None, metric_keys=None, workers=1):
+    return compare_segment_results(
+        get_segment_results(baseline_inlines, segment_ids, metric_keys, workers),
+        get_segment_results(treatment_inlines, segment_ids, metric_keys, workers),
+        metric_keys
+    )
+
+def comparison_to_json(comparison):
+    # {segment: {metric: [{'timestep', 'baseline', 'treatment', 'difference', 'percent'}, ...]}}
+    #   with percent None where the baseline is 0
+    segments = {}
+    for segment_name in comparison.keys():
+        (timestamps, segment_comparison) = comparison[segment_name]
+        segments[segment_name] = {}
+        for metric_key in segment_comparison.keys():
+            columns = segment_comparison[metric_key]
+            percent = [None if numpy.isnan(x) else x for x in columns['percent'].tolist()]
+            segments[segment_name][metric_key] = [
+                {
+                    'timestep': str(timestamp),
+                    'baseline': baseline,
+                    'treatment': treatment,
+                    'difference': difference,
+                    'percent': percent_difference,
+                }
+                for (timestamp, baseline, treatment, difference, percent_difference) in zip(
+                    timestamps,
+                    columns['baseline'].tolist(),
+                    columns['treatment'].tolist(),
+                    columns['difference'].tolist(),
+                    percent
+                )
+            ]
+    return segments
+
+# ======================================
+# COLUMNAR OUTPUT
+# ======================================
+
+def get_flow_metric_arrays(inlines, segment_ids=None, metric_keys=None, workers=1):
+    # Columnar form of get_metric_flow: a shared timestamp vector, the segment
+    #   order, and a float32 (segment x timestep) matrix per metric.
+    return stack_segment_results(get_segment_results(inlines, segment_ids, metric_keys, workers), metric_keys)
+
+def stack_segment_results(segment_results, metric_keys=None):
+    if metric_keys == None:
+        metric_keys = list(FLOW_METRICS.keys())
+    segment_names = list(segment_results.keys())
+    timestamps = list(segment_results[segment_names[0]][0]) if segment_names else []
+    metric_arrays = OrderedDict()
+    for metric_key in metric_keys:
+        metric_arrays[metric_key] = numpy.empty((len(segment_names), len(timestamps)), dtype=numpy.float32)
+    for (index, segment_name) in enumerate(segment_names):
+        (segment_timestamps, segment_metrics) = segment_results[segment_name]
+        if list(segment_timestamps) != timestamps:
+            raise ValueError("Segment '%s' does not share the flow file's timesteps" % segment_name)
+        for metric_key in metric_keys:
+            metric_arrays[metric_key][index] = segment_metrics[metric_key]
+    return (timestamps, segment_names, metric_arrays)
+
+def write_flow_metrics_npz(out_file, timestamps, segment_names, metric_arrays):
+    # Written uncompressed so that load_flow_metrics_npz can memory-map members
+    arrays = {
+        'timestamps': numpy.array(timestamps, dtype=str),
+        'segment_ids': numpy.array(segment_names, dtype=str),
+        'metrics': numpy.array(list(metric_arrays.keys()), dtype=str),
+    }
+    for (index, metric_key) in enumerate(metric_arrays.keys()):
+        arrays['metric_%d' % index] = metric_arrays[metric_key]
+    with open(out_file, 'wb') as f:
+        numpy.savez(f, **arrays)
+
+def memmap_npz_member(npz_file, member_name):
+    # numpy.load ignores mmap_mode for .npz, but members written by savez are
+    #   stored uncompressed, so each one can be mapped straight from the zip.
+    with zipfile.ZipFile(npz_file) as archive:
+        info = archive.getinfo(member_name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("'%s' is compressed and can't be memory-mapped" % member_name)
+    with open(npz_file, 'rb') as f:
+        # local file header: 30 fixed bytes, then the name and extra fields
+        f.seek(info.header_offset + 26)
+        (name_length, extra_length) = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = numpy.lib.format.read_magic(f)
+        if version == (1, 0):
+            (shape, fortran_order, dtype) = numpy.lib.format.read_array_header_1_0(f)
+        else:
+            (shape, fortran_order, dtype) = numpy.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if len(shape) == 0 or 0 in shape:
+        # nothing to map
+        return numpy.zeros(shape, dtype=dtype)
+    return numpy.memmap(npz_file, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+def load_flow_metrics_npz(npz_file):
+    # Returns {'timestamps', 'segment_ids', 'metrics': {metric: matrix}} where
+    #   every array is a read-only memory map into the file.
+    metric_names = memmap_npz_member(npz_file, 'metrics.npy')
+    metric_arrays = OrderedDict()
+    for (index, metric_key) in enumerate(metric_names):
+        metric_arrays[str(metric_key)] = memmap_npz_member(npz_file, 'metric_%d.npy' % index)
+    return {
+        'timestamps': memmap_npz_member(npz_file, 'timestamps.npy'),
+        'segment_ids': memmap_npz_member(npz_file, 'segment_ids.npy'),
+        'metrics': metric_arrays,
+    }
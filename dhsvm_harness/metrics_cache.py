@@ -0,0 +1,214 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from urllib.parse import quote
+
+import numpy
+
+from dhsvm_harness import flow_index, metrics
+from dhsvm_harness.settings import FLOW_METRICS, TIMESTEP, METRICS_CACHE_DIR, METRICS_CACHE_MAX_BYTES
+
+# Computed flow metrics are stored per segment under
+#   <cache dir>/<entry key>/<segment>.npz, where the entry key hashes the
+#   Stream.Flow contents together with TIMESTEP and FLOW_METRICS, so any change
+#   to the file or the metric definitions misses. Every FLOW_METRICS series is
+#   stored for a segment regardless of which metrics were asked for. An entry's
+#   directory mtime is touched on each hit and drives LRU eviction. Requested
+#   segments the file doesn't have are recorded too, so they aren't looked
+#   for again.
+
+HASH_MEMO_FILE = 'file_hashes.json'
+HASH_MEMO_MAX_FILES = 1000
+TIMESTAMPS_FILE = 'timestamps.npy'
+SEGMENTS_FILE = 'segments.json'
+ABSENT_FILE = 'absent.json'
+HASH_CHUNK_BYTES = 8*1024*1024
+
+def get_file_digest(flow_file, cache_dir=METRICS_CACHE_DIR):
+    # sha256 of the file contents, memoized by path, size and mtime so an
+    #   unchanged multi-GB Stream.Flow is hashed only once
+    flow_file = os.path.realpath(flow_file)
+    stat = os.stat(flow_file)
+    memo = read_json(os.path.join(cache_dir, HASH_MEMO_FILE), {})
+    if flow_file in memo and memo[flow_file][:2] == [stat.st_size, stat.st_mtime]:
+        return memo[flow_file][2]
+    digest = hashlib.sha256()
+    with open(flow_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    memo.pop(flow_file, None)
+    memo[flow_file] = [stat.st_size, stat.st_mtime, digest.hexdigest()]
+    write_json(os.path.join(cache_dir, HASH_MEMO_FILE), prune_hash_memo(memo))
+    return memo[flow_file][2]
+
+def prune_hash_memo(memo, max_files=HASH_MEMO_MAX_FILES):
+    # Drop files that no longer exist, then the oldest hashed ones past
+    #   max_files (newly hashed files are added last)
+    paths = [x for x in memo.keys() if os.path.isfile(x)]
+    return OrderedDict([(x, memo[x]) for x in paths[-max_files:]])
+
+def get_entry_key(flow_file, cache_dir=METRICS_CACHE_DIR):
+    definition = json.dumps([TIMESTEP, list(FLOW_METRICS.items())], sort_keys=True)
+    key = hashlib.sha256()
+    key.update(get_file_digest(flow_file, cache_dir).encode())
+    key.update(definition.encode())
+    return key.hexdigest()
+
+def get_segment_path(entry_dir, segment_name):
+    return os.path.join(entry_dir, "%s.npz" % quote(segment_name, safe=''))
+
+def read_json(json_file, default=None):
+    try:
+        with open(json_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def write_json(json_file, data):
+    # write-then-rename so concurrent readers never see a partial file
+    (handle, tmp_file) = tempfile.mkstemp(dir=os.path.dirname(json_file), suffix='.tmp')
+    with os.fdopen(handle, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_file, json_file)
+
+# ======================================
+# READ / WRITE ENTRIES
+# ======================================
+
+def read_cached_segment(entry_dir, segment_name, timestamps):
+    segment_file = get_segment_path(entry_dir, segment_name)
+    if not os.path.isfile(segment_file):
+        return None
+    with numpy.load(segment_file) as segment_data:
+        values = segment_data['values']
+        if 'timestamps' in segment_data.files:
+            timestamps = list(segment_data['timestamps'])
+        metric_names = list(segment_data['metrics'])
+    segment_metrics = OrderedDict()
+    for (index, metric_key) in enumerate(metric_names):
+        segment_metrics[str(metric_key)] = values[index]
+    return (timestamps, segment_metrics)
+
+def write_cached_segment(entry_dir, segment_name, timestamps, segment_metrics, shared_timestamps):
+    arrays = {
+        'metrics': numpy.array(list(segment_metrics.keys()), dtype=str),
+        'values': numpy.array(list(segment_metrics.values()), dtype=numpy.float64),
+    }
+    if list(timestamps) != shared_timestamps:
+        arrays['timestamps'] = numpy.array(timestamps, dtype=str)
+    (handle, tmp_file) = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as f:
+        numpy.savez(f, **arrays)
+    os.replace(tmp_file, get_segment_path(entry_dir, segment_name))
+
+def read_flow_lines(flow_file, segment_ids=None):
+    if segment_ids == None:
+        with open(flow_file, 'r') as f:
+            return f.readlines()
+    index = flow_index.get_stream_flow_index(flow_file)
+    return list(flow_index.read_indexed_lines(flow_file, index, segment_ids))
+
+def get_cached_segment_results(flow_file, segment_ids=None, metric_keys=None, workers=1, cache_dir=METRICS_CACHE_DIR, max_bytes=METRICS_CACHE_MAX_BYTES):
+    # Same shape as metrics.get_segment_results, for every segment when
+    #   segment_ids is None. Cached segments are loaded without parsing the
+    #   Stream.Flow; only the missing ones are read and computed, then stored.
+    if not cache_dir:
+        return metrics.get_segment_results(read_flow_lines(flow_file, segment_ids), segment_ids, metric_keys, workers)
+    if metric_keys == None:
+        metric_keys = list(FLOW_METRICS.keys())
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    entry_dir = os.path.join(cache_dir, get_entry_key(flow_file, cache_dir))
+    if not os.path.isdir(entry_dir):
+        os.makedirs(entry_dir)
+    os.utime(entry_dir)
+
+    timestamps_file = os.path.join(entry_dir, TIMESTAMPS_FILE)
+    shared_timestamps = list(numpy.load(timestamps_file)) if os.path.isfile(timestamps_file) else None
+    all_segments = read_json(os.path.join(entry_dir, SEGMENTS_FILE))
+    requested = segment_ids if segment_ids != None else all_segments
+    # segments known not to be in the Stream.Flow
+    absent = set(read_json(os.path.join(entry_dir, ABSENT_FILE), []))
+    if requested != None and all_segments != None:
+        absent.update(set(requested) - set(all_segments))
+
+    cached = OrderedDict()
+    missing = []
+    if requested != None and shared_timestamps != None:
+        for segment_name in requested:
+            if segment_name in absent:
+                continue
+            segment_result = read_cached_segment(entry_dir, segment_name, shared_timestamps)
+            if segment_result == None:
+                missing.append(segment_name)
+            else:
+                cached[segment_name] = segment_result
+    elif requested != None:
+        missing = [x for x in requested if not x in absent]
+    else:
+        missing = None
+
+    computed = OrderedDict()
+    if missing == None or len(missing) > 0:
+        computed = metrics.get_segment_results(read_flow_lines(flow_file, missing), missing, None, workers)
+        if shared_timestamps == None and len(computed) > 0:
+            shared_timestamps = list(computed[list(computed.keys())[0]][0])
+            with open(timestamps_file, 'wb') as f:
+                numpy.save(f, numpy.array(shared_timestamps, dtype=str))
+        for segment_name in computed.keys():
+            (segment_timestamps, segment_metrics) = computed[segment_name]
+            write_cached_segment(entry_dir, segment_name, segment_timestamps, segment_metrics, shared_timestamps)
+        if requested == None:
+            requested = list(computed.keys())
+            write_json(os.path.join(entry_dir, SEGMENTS_FILE), requested)
+        else:
+            not_found = [x for x in missing if not x in computed]
+            if not_found:
+                write_json(os.path.join(entry_dir, ABSENT_FILE), sorted(absent.union(not_found)))
+        evict_cache_entries(cache_dir, max_bytes, keep=entry_dir)
+
+    results = OrderedDict()
+    for segment_name in requested:
+        if segment_name in cached:
+            segment_result = cached[segment_name]
+        elif segment_name in computed:
+            segment_result = computed[segment_name]
+        else:
+            # not in the Stream.Flow
+            continue
+        (segment_timestamps, segment_metrics) = segment_result
+        results[segment_name] = (segment_timestamps, OrderedDict([(x, segment_metrics[x]) for x in metric_keys]))
+    return results
+
+# ======================================
+# EVICTION
+# ======================================
+
+def get_entry_size(entry_dir):
+    size = 0
+    for file_name in os.listdir(entry_dir):
+        size += os.path.getsize(os.path.join(entry_dir, file_name))
+    return size
+
+def evict_cache_entries(cache_dir=METRICS_CACHE_DIR, max_bytes=METRICS_CACHE_MAX_BYTES, keep=None):
+    # Remove least recently used entries until the cache fits in max_bytes.
+    #   'keep' (the entry just written) is never evicted.
+    entries = []
+    for entry_name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, entry_name)
+        if os.path.isdir(entry_dir):
+            entries.append((os.path.getmtime(entry_dir), get_entry_size(entry_dir), entry_dir))
+    total = sum([x[1] for x in entries])
+    evicted = []
+    for (mtime, size, entry_dir) in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep and os.path.realpath(entry_dir) == os.path.realpath(keep):
+            continue
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+        evicted.append(entry_dir)
+    return evicted
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from dhsvm_harness.input_cache import link_file, evict_entries
+from dhsvm_harness.settings import RESULTS_STORE_DIR, RESULTS_STORE_MAX_BYTES, TIMESTEP, DHSVM_BUILD
+
+# Stream.Flow files of finished model runs, archived under
+#   <store dir>/<key>/Stream.Flow. The key covers the run's generated inputs
+#   (the input_cache key), its weather year and that year's model start and
+#   end (rendered into the INPUT file), and the INPUT template, so a scenario
+#   with the same effective inputs can import the archived output instead of
+#   running DHSVM again. Like the inputs cache, entries are evicted least
+#   recently used first (fetches touch the entry dir) past the byte budget.
+
+FLOW_FILE_NAME = 'Stream.Flow'
+
+def get_template_digest(template_file):
+    digest = hashlib.sha256()
+    with open(template_file, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+def get_result_key(inputs_key, weather_year, template_file, start, end):
+    # start/end: the weather year's MODEL_YEARS dates, which a label may outlive
+    key_data = {
+        'inputs': inputs_key,
+        'weather_year': weather_year,
+        'start': str(start),
+        'end': str(end),
+        'template': get_template_digest(template_file),
+        'timestep': TIMESTEP,
+        'dhsvm_build': DHSVM_BUILD,
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+def fetch_result_flow(key, store_dir=RESULTS_STORE_DIR):
+    # path to the archived Stream.Flow, or None on a miss (or when disabled)
+    if not store_dir:
+        return None
+    flow_file = os.path.join(store_dir, key, FLOW_FILE_NAME)
+    if not os.path.isfile(flow_file):
+        return None
+    os.utime(os.path.join(store_dir, key))
+    return flow_file
+
+def store_result_flow(key, flow_file, store_dir=RESULTS_STORE_DIR, max_bytes=RESULTS_STORE_MAX_BYTES):
+    # Archive a finished run's Stream.Flow (hardlinked where possible, so the
+    #   run dir can still be removed). Written to a temp dir and renamed into
+    #   place, so a half-copied file is never served.
+    if not store_dir or not os.path.isfile(flow_file):
+        return None
+    entry_dir = os.path.join(store_dir, key)
+    if os.path.isfile(os.path.join(entry_dir, FLOW_FILE_NAME)):
+        return os.path.join(entry_dir, FLOW_FILE_NAME)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    tmp_dir = tempfile.mkdtemp(dir=store_dir, prefix='.%s.' % key)
+    try:
+        link_file(flow_file, os.path.join(tmp_dir, FLOW_FILE_NAME))
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.rename(tmp_dir, entry_dir)
+    except OSError as e:
+        print("Unable to archive %s: %s" % (flow_file, e))
+        return None
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+    evict_entries(store_dir, max_bytes, keep=entry_dir)
+    return os.path.join(entry_dir, FLOW_FILE_NAME)
@@ -0,0 +1,336 @@
+from collections import OrderedDict
+from contextlib import closing
+from django.conf import settings as ucsrb_settings
+from django.db import connections
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+import traceback
+
+from dhsvm_harness import scratch
+from dhsvm_harness.settings import SCHEDULER_DB, SCHEDULER_CORES, SCHEDULER_POLL_SECONDS, RUN_CORES, IMPORT_WORKERS
+from dhsvm_harness.utils import prepareHarnessRun, startHarnessModel, importHarnessResults, finishHarnessRun, getRunTrace
+from ucsrb.models import TreatmentScenario
+
+# Queued harness runs. Requests submit a job (a scenario or baseline basin and a
+#   weather year) to a SQLite job table instead of calling runHarnessConfig;
+#   one scheduler process (manage.py harness_jobs run) works through the table.
+#   Each job runs as three stages -- prepare (inputs), model (DHSVM) and import
+#   (Stream.Flow) -- and a stage only starts once its cores fit within
+#   SCHEDULER_CORES alongside the stages already running. Later stages of
+#   earlier jobs go first, and no stage overtakes one that is waiting for cores,
+#   so jobs finish in the order they were submitted.
+#   Prepare and import stages run in forked processes, the model stage as the
+#   mpiexec process itself; each job records its stage's pid. Stages
+#   interrupted by a scheduler restart are run again, once their process (which
+#   may outlive the scheduler) has exited. Imports always read the finished
+#   Stream.Flow (FLOW_FOLLOW_IMPORT only applies to runHarnessConfig).
+
+QUEUED = 'queued'
+PREPARING = 'preparing'
+PREPARED = 'prepared'
+MODELLING = 'modelling'
+MODELLED = 'modelled'
+IMPORTING = 'importing'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# stage: state of jobs waiting for it, state while it runs. In admission order.
+STAGES = OrderedDict()
+STAGES['import'] = {'waiting': MODELLED, 'running': IMPORTING}
+STAGES['model'] = {'waiting': PREPARED, 'running': MODELLING}
+STAGES['prepare'] = {'waiting': QUEUED, 'running': PREPARING}
+
+STAGE_CORES = {
+    'prepare': 1,
+    'model': RUN_CORES,
+    'import': IMPORT_WORKERS,
+}
+
+WAITING_STATES = [x['waiting'] for x in STAGES.values()]
+RUNNING_STATES = [x['running'] for x in STAGES.values()]
+
+JOBS_TABLE = '''CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    treatment_scenario_id INTEGER,
+    basin TEXT,
+    weather_year TEXT NOT NULL,
+    state TEXT NOT NULL,
+    run TEXT,
+    returncode INTEGER,
+    error TEXT,
+    submitted REAL NOT NULL,
+    stage_started REAL,
+    finished REAL,
+    updated REAL NOT NULL,
+    pid INTEGER
+)'''
+
+JOB_FIELDS = ['treatment_scenario_id', 'basin', 'weather_year', 'state', 'run', 'returncode', 'error', 'submitted', 'stage_started', 'finished', 'updated', 'pid']
+
+def get_connection(db_path=SCHEDULER_DB):
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+    db = sqlite3.connect(db_path, timeout=30)
+    db.row_factory = sqlite3.Row
+    # WAL: status reads from web requests don't block the scheduler's writes
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute(JOBS_TABLE)
+    if not 'pid' in [x['name'] for x in db.execute('PRAGMA table_info(jobs)')]:
+        # job tables created before stage pids were recorded
+        db.execute('ALTER TABLE jobs ADD COLUMN pid INTEGER')
+    return db
+
+def get_job_dict(row):
+    job = dict(row)
+    job['run'] = json.loads(job['run']) if job['run'] else None
+    return job
+
+def get_job(job_id, db_path=SCHEDULER_DB):
+    with closing(get_connection(db_path)) as db:
+        row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    return get_job_dict(row) if row else None
+
+def list_jobs(states=None, db_path=SCHEDULER_DB):
+    # jobs in submission order, optionally only those in the given states
+    query = 'SELECT * FROM jobs'
+    params = []
+    if states:
+        query += ' WHERE state IN (%s)' % ','.join(['?']*len(states))
+        params = list(states)
+    with closing(get_connection(db_path)) as db:
+        rows = db.execute(query + ' ORDER BY id', params).fetchall()
+    return [get_job_dict(row) for row in rows]
+
+def update_job(job_id, db_path=SCHEDULER_DB, from_states=None, **fields):
+    # from_states: only update the job while it is in one of these states.
+    #   Returns whether the job was updated.
+    for field in fields.keys():
+        if not field in JOB_FIELDS:
+            raise ValueError("Unknown job field '%s'" % field)
+    if 'run' in fields and not isinstance(fields['run'], (str, type(None))):
+        fields['run'] = json.dumps(fields['run'])
+    fields['updated'] = time.time()
+    if fields.get('state') in [DONE, FAILED, CANCELLED]:
+        fields['finished'] = fields['updated']
+    elif fields.get('state') in RUNNING_STATES:
+        fields['stage_started'] = fields['updated']
+    columns = sorted(fields.keys())
+    query = 'UPDATE jobs SET %s WHERE id = ?' % ', '.join(['%s = ?' % x for x in columns])
+    params = [fields[x] for x in columns] + [job_id]
+    if from_states != None:
+        query += ' AND state IN (%s)' % ','.join(['?']*len(from_states))
+        params += list(from_states)
+    with closing(get_connection(db_path)) as db, db:
+        return db.execute(query, params).rowcount > 0
+
+def submit_job(treatment_scenario=None, basin=None, weather_year=ucsrb_settings.NORMAL_YEAR_LABEL, db_path=SCHEDULER_DB):
+    # treatment_scenario: a TreatmentScenario or its id; basin: a baseline basin
+    #   name, as for runHarnessConfig. Returns the job id.
+    if hasattr(treatment_scenario, 'id'):
+        treatment_scenario = treatment_scenario.id
+    if treatment_scenario == None and not basin:
+        raise ValueError("A job needs a treatment scenario or a baseline basin")
+    if not weather_year in ucsrb_settings.MODEL_YEARS.keys():
+        raise ValueError("Unknown weather year '%s'. Choose from: %s" % (weather_year, ', '.join(ucsrb_settings.MODEL_YEARS.keys())))
+    now = time.time()
+    with closing(get_connection(db_path)) as db, db:
+        cursor = db.execute(
+            'INSERT INTO jobs (treatment_scenario_id, basin, weather_year, state, submitted, updated) VALUES (?, ?, ?, ?, ?, ?)',
+            (treatment_scenario, None if treatment_scenario != None else basin, weather_year, QUEUED, now, now)
+        )
+        return cursor.lastrowid
+
+def cancel_job(job_id, db_path=SCHEDULER_DB):
+    # Only jobs waiting for their prepare or model stage can be cancelled. The
+    #   update is conditional, so a stage the scheduler starts meanwhile wins.
+    job = get_job(job_id, db_path)
+    if job == None or not update_job(job_id, db_path, from_states=[QUEUED, PREPARED], state=CANCELLED):
+        return False
+    if job['run'] and os.path.isdir(job['run']['run_dir']):
+        scratch.release_run(job['run']['run_dir'])
+    return True
+
+def recover_jobs(db_path=SCHEDULER_DB):
+    # Return stages left running by a previous scheduler to their waiting state,
+    #   re-claiming the run dirs that later stages still need. Stages whose
+    #   process is still alive (e.g. an orphaned mpiexec) stay running and are
+    #   returned, so the scheduler waits for them instead of starting a second
+    #   model in the same run dir.
+    orphaned = []
+    for job in list_jobs(RUNNING_STATES + [PREPARED, MODELLED], db_path):
+        if job['state'] in RUNNING_STATES and job['pid'] and scratch.is_process_alive(job['pid']):
+            if job['run'] and os.path.isdir(job['run']['run_dir']):
+                scratch.claim_run(job['run']['run_dir'])
+            orphaned.append(job)
+            continue
+        state = [x['waiting'] for x in STAGES.values() if job['state'] in x.values()][0]
+        if state != QUEUED and not os.path.isdir(job['run']['run_dir']):
+            state = QUEUED
+        elif state != QUEUED:
+            scratch.claim_run(job['run']['run_dir'])
+        if state != job['state']:
+            update_job(job['id'], db_path, state=state)
+    return orphaned
+
+# ======================================
+# STAGES
+# ======================================
+
+def get_job_scenario(job):
+    if job['treatment_scenario_id'] == None:
+        return None
+    return TreatmentScenario.objects.get(pk=job['treatment_scenario_id'])
+
+def get_job_trace(job, stage):
+    # each forked stage writes its own trace, tagged with the job and stage
+    trace = getRunTrace(get_job_scenario(job), job['basin'], job['weather_year'])
+    trace.context.update({'job_id': job['id'], 'scheduler_stage': stage})
+    return trace
+
+def run_prepare_stage(job_id, db_path=SCHEDULER_DB):
+    trace = None
+    try:
+        job = get_job(job_id, db_path)
+        trace = get_job_trace(job, 'prepare')
+        harness_run = prepareHarnessRun(get_job_scenario(job), job['basin'], job['weather_year'], trace=trace)
+        # the run dir must outlive this process: it is the scheduler's until imported
+        scratch.claim_run(harness_run['run_dir'], os.getppid())
+        # archived results skip the model stage
+        state = MODELLED if harness_run['archived_flow_file'] else PREPARED
+        update_job(job_id, db_path, state=state, run=harness_run)
+    except Exception:
+        update_job(job_id, db_path, state=FAILED, error=traceback.format_exc())
+    finally:
+        if trace != None:
+            trace.write()
+        connections.close_all()
+
+def run_import_stage(job_id, db_path=SCHEDULER_DB):
+    job = None
+    trace = None
+    try:
+        job = get_job(job_id, db_path)
+        trace = get_job_trace(job, 'import')
+        harness_run = job['run']
+        importHarnessResults(harness_run, get_job_scenario(job), job['returncode'] if job['returncode'] else 0, trace=trace)
+        update_job(job_id, db_path, state=DONE)
+    except Exception:
+        update_job(job_id, db_path, state=FAILED, error=traceback.format_exc())
+    finally:
+        if job and job['run']:
+            finishHarnessRun(job['run'], job['returncode'] if job['returncode'] else 0)
+        if trace != None:
+            trace.write()
+        connections.close_all()
+
+STAGE_TARGETS = {
+    'prepare': run_prepare_stage,
+    'import': run_import_stage,
+}
+
+def get_returncode(process):
+    # exit status of a subprocess.Popen or multiprocessing.Process, None while running
+    if isinstance(process, multiprocessing.process.BaseProcess):
+        return None if process.is_alive() else process.exitcode
+    return process.poll()
+
+class OrphanedStage(object):
+    # A stage process left running by a previous scheduler. It isn't our
+    #   child, so only whether it is still alive is known, not how it exited.
+    def __init__(self, pid):
+        self.pid = pid
+
+    def poll(self):
+        return None if scratch.is_process_alive(self.pid) else 0
+
+class JobScheduler(object):
+    def __init__(self, cores=SCHEDULER_CORES, db_path=SCHEDULER_DB, poll_seconds=SCHEDULER_POLL_SECONDS):
+        self.cores = cores
+        self.db_path = db_path
+        self.poll_seconds = poll_seconds
+        # job id: (stage, cores, process)
+        self.tasks = OrderedDict()
+
+    def get_stage_cores(self, stage):
+        # a stage wider than the whole budget runs once nothing else is running
+        return min(STAGE_CORES[stage], self.cores)
+
+    def get_cores_in_use(self):
+        return sum([x[1] for x in self.tasks.values()])
+
+    def start_stage(self, job, stage):
+        # False if the job left its waiting state meanwhile (e.g. was cancelled)
+        if not update_job(job['id'], self.db_path, from_states=[STAGES[stage]['waiting']], state=STAGES[stage]['running']):
+            return False
+        process = self.launch_stage(job, stage)
+        update_job(job['id'], self.db_path, pid=process.pid)
+        self.tasks[job['id']] = (stage, self.get_stage_cores(stage), process)
+        return True
+
+    def launch_stage(self, job, stage):
+        if stage == 'model':
+            return startHarnessModel(job['run'])
+        # forked stages open their own database connections
+        connections.close_all()
+        process = multiprocessing.get_context('fork').Process(target=STAGE_TARGETS[stage], args=(job['id'], self.db_path))
+        process.start()
+        return process
+
+    def adopt_stages(self, jobs):
+        # wait for stages a previous scheduler left running, holding their cores
+        for job in jobs:
+            stage = [x for x in STAGES.keys() if STAGES[x]['running'] == job['state']][0]
+            self.tasks[job['id']] = (stage, self.get_stage_cores(stage), OrphanedStage(job['pid']))
+
+    def finish_stage(self, job_id, stage, returncode):
+        job = get_job(job_id, self.db_path)
+        if stage == 'model':
+            if returncode == 0:
+                update_job(job_id, self.db_path, state=MODELLED, returncode=returncode)
+            else:
+                update_job(job_id, self.db_path, state=FAILED, returncode=returncode, error='DHSVM exited with status %s' % returncode)
+                finishHarnessRun(job['run'], returncode)
+        elif job['state'] == STAGES[stage]['running']:
+            # the stage process died without recording an outcome
+            update_job(job_id, self.db_path, state=FAILED, error='%s stage exited with status %s' % (stage, returncode))
+
+    def reap(self):
+        for (job_id, (stage, cores, process)) in list(self.tasks.items()):
+            returncode = get_returncode(process)
+            if returncode != None:
+                del self.tasks[job_id]
+                if isinstance(process, OrphanedStage):
+                    # its outcome is unknown unless it recorded one: run it again
+                    update_job(job_id, self.db_path, from_states=[STAGES[stage]['running']], state=STAGES[stage]['waiting'])
+                else:
+                    self.finish_stage(job_id, stage, returncode)
+
+    def admit(self):
+        # Start waiting stages, latest stage and earliest job first, while they
+        #   fit in the core budget. The first stage that doesn't fit stops
+        #   admission, so small stages never starve a waiting model run.
+        for stage in STAGES.keys():
+            for job in list_jobs([STAGES[stage]['waiting']], self.db_path):
+                if job['id'] in self.tasks.keys():
+                    continue
+                if self.tasks and self.get_cores_in_use() + self.get_stage_cores(stage) > self.cores:
+                    return
+                self.start_stage(job, stage)
+
+    def step(self):
+        self.reap()
+        self.admit()
+
+    def run(self, until_empty=False):
+        # until_empty: return once no job is waiting or running
+        self.adopt_stages(recover_jobs(self.db_path))
+        while True:
+            self.step()
+            if until_empty and not self.tasks and not list_jobs(WAITING_STATES, self.db_path):
+                return
+            time.sleep(self.poll_seconds)
@@ -0,0 +1,155 @@
+import os
+import shutil
+import stat
+
+from dhsvm_harness.settings import RUNS_DIR, RUN_OUTPUTS_DIR, RUNS_MAX_BYTES
+
+# Run directories are kept after a run finishes, so its inputs and output can
+#   be re-imported or debugged without running DHSVM again. Each run dir
+#   (RUNS_DIR/run_<scenario>_<weather year>) holds its ts_inputs; its output
+#   dir lives under RUN_OUTPUTS_DIR when that is set (e.g. inputs on tmpfs,
+#   outputs on disk), linked in as 'output'. Once the runs together use more
+#   than RUNS_MAX_BYTES, the least recently used ones are removed. Runs still
+#   in progress are never removed.
+
+LAST_USED_FILE = '.last_used'
+ACTIVE_FILE = '.active'
+RUN_DIR_PREFIX = 'run_'
+
+def get_run_dir_name(scenario_id, weather_year):
+    return '%s%s_%s' % (RUN_DIR_PREFIX, scenario_id, weather_year)
+
+def get_run_dir(scenario_id, weather_year, runs_dir=RUNS_DIR):
+    return os.path.join(runs_dir, get_run_dir_name(scenario_id, weather_year))
+
+def get_output_dir(run_dir, outputs_dir=RUN_OUTPUTS_DIR):
+    if outputs_dir:
+        return os.path.join(outputs_dir, os.path.basename(run_dir))
+    return os.path.join(run_dir, 'output')
+
+def touch_run(run_dir):
+    with open(os.path.join(run_dir, LAST_USED_FILE), 'w'):
+        pass
+
+def get_last_used(run_dir):
+    marker = os.path.join(run_dir, LAST_USED_FILE)
+    if os.path.isfile(marker):
+        return os.path.getmtime(marker)
+    return os.path.getmtime(run_dir)
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def is_run_active(run_dir):
+    # a run is active while the process that created it is alive
+    try:
+        with open(os.path.join(run_dir, ACTIVE_FILE), 'r') as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        return False
+    return is_process_alive(pid)
+
+def remove_run(run_dir, outputs_dir=RUN_OUTPUTS_DIR):
+    output_dir = get_output_dir(run_dir, outputs_dir)
+    if outputs_dir and os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+
+def create_run_dir(scenario_id, weather_year, runs_dir=RUNS_DIR, outputs_dir=RUN_OUTPUTS_DIR, max_bytes=RUNS_MAX_BYTES):
+    # A fresh run dir with empty ts_inputs and output dirs, marked active until
+    #   release_run. An earlier run of the same scenario and year is replaced.
+    for scratch_dir in [runs_dir, outputs_dir]:
+        if scratch_dir and not os.path.isdir(scratch_dir):
+            os.makedirs(scratch_dir)
+    run_dir = get_run_dir(scenario_id, weather_year, runs_dir)
+    remove_run(run_dir, outputs_dir)
+    os.mkdir(run_dir)
+    os.mkdir(os.path.join(run_dir, 'ts_inputs'))
+    output_dir = get_output_dir(run_dir, outputs_dir)
+    os.mkdir(output_dir)
+    if outputs_dir:
+        os.symlink(output_dir, os.path.join(run_dir, 'output'))
+    claim_run(run_dir)
+    touch_run(run_dir)
+    evict_runs(runs_dir, outputs_dir, max_bytes, keep=[run_dir])
+    return run_dir
+
+def claim_run(run_dir, pid=None):
+    # mark the run active for as long as process pid (default: this one) lives
+    with open(os.path.join(run_dir, ACTIVE_FILE), 'w') as f:
+        f.write(str(pid if pid else os.getpid()))
+
+def release_run(run_dir, runs_dir=RUNS_DIR, outputs_dir=RUN_OUTPUTS_DIR, max_bytes=RUNS_MAX_BYTES):
+    # The run is finished (or failed): keep it for reuse, subject to the byte budget
+    if not os.path.isdir(run_dir):
+        return
+    active_file = os.path.join(run_dir, ACTIVE_FILE)
+    if os.path.isfile(active_file):
+        os.remove(active_file)
+    touch_run(run_dir)
+    evict_runs(runs_dir, outputs_dir, max_bytes)
+
+def find_run(scenario_id, weather_year, runs_dir=RUNS_DIR):
+    # The kept run dir for a scenario and weather year, or None
+    run_dir = get_run_dir(scenario_id, weather_year, runs_dir)
+    if not os.path.isdir(run_dir):
+        return None
+    touch_run(run_dir)
+    return run_dir
+
+def get_run_flow_file(scenario_id, weather_year, runs_dir=RUNS_DIR):
+    run_dir = find_run(scenario_id, weather_year, runs_dir)
+    if run_dir == None:
+        return None
+    flow_file = os.path.join(run_dir, 'output', 'Stream.Flow')
+    return flow_file if os.path.isfile(flow_file) else None
+
+def get_dir_size(scratch_dir):
+    # bytes that removing scratch_dir would free: symlinks are not followed (a
+    #   run's 'inputs' link points at the shared basin inputs), and files
+    #   hardlinked elsewhere (st_nlink > 1: the inputs cache, results store or
+    #   another year's run) stay on disk, so they are left out
+    size = 0
+    for (dir_path, dir_names, file_names) in os.walk(scratch_dir):
+        for file_name in file_names:
+            file_stat = os.lstat(os.path.join(dir_path, file_name))
+            if not stat.S_ISLNK(file_stat.st_mode) and file_stat.st_nlink == 1:
+                size += file_stat.st_size
+    return size
+
+def get_run_size(run_dir, outputs_dir=RUN_OUTPUTS_DIR):
+    size = get_dir_size(run_dir)
+    if outputs_dir:
+        size += get_dir_size(get_output_dir(run_dir, outputs_dir))
+    return size
+
+def evict_runs(runs_dir=RUNS_DIR, outputs_dir=RUN_OUTPUTS_DIR, max_bytes=RUNS_MAX_BYTES, keep=None):
+    # Remove the least recently used inactive runs until all runs fit in max_bytes.
+    #   Run dirs in 'keep' (the run just created) are never evicted.
+    if keep == None:
+        keep = []
+    if not os.path.isdir(runs_dir):
+        return []
+    runs = []
+    for run_name in os.listdir(runs_dir):
+        run_dir = os.path.join(runs_dir, run_name)
+        if run_name.startswith(RUN_DIR_PREFIX) and os.path.isdir(run_dir) and not os.path.islink(run_dir):
+            runs.append((get_last_used(run_dir), get_run_size(run_dir, outputs_dir), run_dir))
+    total = sum([x[1] for x in runs])
+    evicted = []
+    for (last_used, size, run_dir) in sorted(runs):
+        if total <= max_bytes:
+            break
+        if run_dir in keep or is_run_active(run_dir):
+            continue
+        remove_run(run_dir, outputs_dir)
+        total -= size
+        evicted.append(run_dir)
+    return evicted
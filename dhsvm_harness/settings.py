@@ -3,11 +3,39 @@ import os
 from collections import OrderedDict
 
 RUN_CORES = 4
+# Worker processes (each with its own DB connection) used to import a Stream.Flow
+IMPORT_WORKERS = 1
+# Queued runs (see dhsvm_harness.scheduler): job database, and the cores that
+#   running stages may use between them. A prepare stage takes 1 core, a model
+#   stage RUN_CORES and an import stage IMPORT_WORKERS. SCHEDULER_CORES also
+#   bounds the concurrent model runs of runHarnessConfigYears.
+SCHEDULER_DB = '/tmp/dhsvm_harness_jobs.sqlite3'
+SCHEDULER_CORES = os.cpu_count() or RUN_CORES
+SCHEDULER_POLL_SECONDS = 5
 
 BASINS = ['entiat', 'methow', 'okan', 'wena']
 DEFAULT_BASIN_NAME = 'entiat'
 BASINS_DIR='/usr/local/apps/marineplanner-core/apps/uc-dhsvm-harness/basins'
 RUNS_DIR='/tmp/runs'
+# Finished run dirs are kept (see dhsvm_harness.scratch) until together they
+#   exceed RUNS_MAX_BYTES; least recently used runs are removed first. Set
+#   RUN_OUTPUTS_DIR to keep run outputs apart from RUNS_DIR (e.g. inputs on
+#   tmpfs, outputs on disk); None keeps them in each run dir.
+RUN_OUTPUTS_DIR=None
+RUNS_MAX_BYTES=20*1024*1024*1024
+# Content-addressed cache of generated run inputs (ts_inputs), hardlinked into
+#   run dirs. Keep it on the same filesystem as RUNS_DIR. None disables it.
+#   Least recently used entries are removed past INPUTS_CACHE_MAX_BYTES.
+INPUTS_CACHE_DIR='/tmp/run_inputs_cache'
+INPUTS_CACHE_MAX_BYTES=10*1024*1024*1024
+# Archived Stream.Flow of finished runs, reused by runs with identical inputs,
+#   weather year and INPUT template instead of running DHSVM. None disables it.
+#   Least recently used results are removed past RESULTS_STORE_MAX_BYTES.
+RESULTS_STORE_DIR='/tmp/run_results_store'
+RESULTS_STORE_MAX_BYTES=20*1024*1024*1024
+# JSON traces of each run's per-stage wall/CPU time, peak RSS and I/O (see
+#   dhsvm_harness.instrumentation). None disables writing them.
+RUN_TRACES_DIR='/tmp/run_traces'
 DHSVM_BUILD='SET IN LOCAL SETTINGS'
 SUPERBASINS = {
     'enti': {
@@ -36,6 +64,11 @@ SUPERBASINS = {
 
 MASK_RUNS = False
 
+# Treatment and focus area geometries are stored in Web Mercator; basin rasters
+#   and DHSVM inputs use the USFS R6 Albers projection.
+GEOMETRY_PROJECTION = 'epsg:3857'
+PROJECTION = 'PROJCS["NAD_1983_USFS_R6_Albers",GEOGCS["GCS_North_American_1983",DATUM["D_North_American_1983",SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],PROJECTION["Albers"],PARAMETER["False_Easting",600000.0],PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",-120.0],PARAMETER["Standard_Parallel_1",43.0],PARAMETER["Standard_Parallel_2",48.0],PARAMETER["Latitude_Of_Origin",34.0],UNIT["Meter",1.0]]'
+
 ABSOLUTE_FLOW_METRIC = 'Absolute Flow Rate'
 DELTA_FLOW_METRIC = 'Change in Flow Rate'
 
@@ -53,4 +86,20 @@ FLOW_METRICS['Change in 1 Day Mean Flow Rate'] = {'measure': 'mean', 'delta':Tru
 
 TIMESTEP = 6
 
+# Number of Stream.Flow lines handed to the database per import batch
+FLOW_IMPORT_BATCH_SIZE = 10000
+# Size of the in-memory CSV buffer sent to PostgreSQL per COPY statement
+FLOW_COPY_BUFFER_BYTES = 8*1024*1024
+# Write every FLOW_METRICS series at import time, not just ABSOLUTE_FLOW_METRIC
+IMPORT_ALL_FLOW_METRICS = False
+# Import Stream.Flow while DHSVM is still writing it, one timestep block at a time
+FLOW_FOLLOW_IMPORT = False
+FLOW_FOLLOW_POLL_SECONDS = 5
+
+# On-disk cache of computed flow metrics, keyed by Stream.Flow content,
+#   TIMESTEP and FLOW_METRICS. Least recently used entries are evicted once
+#   the cache grows past METRICS_CACHE_MAX_BYTES. Set the dir to None to disable.
+METRICS_CACHE_DIR = '/tmp/flow_metrics_cache'
+METRICS_CACHE_MAX_BYTES = 2*1024*1024*1024
+
 from dhsvm_harness.local_settings import *
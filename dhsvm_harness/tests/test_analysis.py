@@ -1,15 +1,18 @@
-import json, datetime, statistics
+import json, datetime, os, statistics, tempfile
+from unittest import mock
 
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
+from django.utils.timezone import get_current_timezone
 from django.contrib.auth.models import User
 from django.contrib.gis.geos import GEOSGeometry
 
 from ucsrb.models import StreamFlowReading, FocusArea, TreatmentScenario, ScenarioState
 from django.core.management import call_command
 
+from dhsvm_harness import flow_index
 from dhsvm_harness import settings as harness_settings
 from dhsvm_harness.tests import testing_settings as settings
-from dhsvm_harness.utils import readStreamFlowData, cleanStreamFlowData, runHarnessConfig
+from dhsvm_harness.utils import readStreamFlowData, cleanStreamFlowData, runHarnessConfig, getFlowFileEndLines, getStreamFlowByteRanges, iterStreamFlowBatches, getSegmentIdList, getStreamFlowBlockShards, followStreamFlowData, localizeFlowTimestamp
 
 class ImportTestCase(TestCase):
     def setUp(self):
@@ -227,6 +230,35 @@ class ImportTestCase(TestCase):
 
         # Test all 3726 flows are greater than 3729 flows
 
+    def test_follow_failed_run(self):
+        # a followed import of a model run that fails leaves the earlier readings
+        readStreamFlowData(settings.FLOW_FILE, segment_ids=[settings.BASIN_1_ID], all_metrics=False)
+        readings = StreamFlowReading.objects.filter(segment_id=settings.BASIN_1_ID, is_baseline=True, treatment=None)
+        before = list(readings.order_by('time').values_list('time', 'value'))
+        self.assertTrue(before)
+        with open(settings.FLOW_FILE, 'r') as f:
+            inlines = f.readlines()
+        tz = get_current_timezone()
+        start_time = localizeFlowTimestamp(inlines[0].split()[0], tz)
+        end_time = localizeFlowTimestamp(inlines[-1].split()[0], tz)
+
+        class FailedProcess(object):
+            returncode = 1
+
+            def poll(self):
+                return self.returncode
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # DHSVM wrote a few timesteps of different flows, then failed
+            flow_file = os.path.join(tmp_dir, 'Stream.Flow')
+            with open(flow_file, 'w') as f:
+                for line in inlines[:10]:
+                    data = line.split()
+                    f.write('%s\n' % ' '.join(data[:4] + ['0'] + data[5:]))
+            row_count = followStreamFlowData(flow_file, FailedProcess(), start_time, end_time, segment_ids=[settings.BASIN_1_ID], poll_interval=0, all_metrics=False)
+        self.assertEqual(row_count, 0)
+        self.assertEqual(list(readings.order_by('time').values_list('time', 'value')), before)
+
     ############################################################################
     # RDH: 3/8/2021 - this isn't a real test case, just a way to build test data
     #       ...We probably will want to test this function if we don't export
@@ -240,3 +272,85 @@ class ImportTestCase(TestCase):
     #     out_file = "/usr/local/apps/snow2flow/uc-dhsvm-harness/dhsvm_harness/tests/test_data/Test_Methow_Stream.Flow"
     #     BASINS = [settings.BASIN_1_ID, settings.BASIN_2_ID]
     #     cleanStreamFlowData(flow_file, out_file, BASINS)
+
+class RecordingLoader(object):
+    # Stands in for StreamFlowCopyLoader: keeps the rows instead of COPYing them
+    def __init__(self):
+        self.rows = []
+        self.row_count = 0
+
+    def addRow(self, row):
+        self.rows.append(row)
+        self.row_count += 1
+
+    def flush(self):
+        pass
+
+class StreamFlowReaderTestCase(SimpleTestCase):
+    def test_indexed_import_skips_totals(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            flow_file = os.path.join(tmp_dir, 'Stream.Flow')
+            with open(flow_file, 'w') as f:
+                for timestamp in ['10.01.2001-00:00:00', '10.01.2001-03:00:00']:
+                    f.write('%s 3726 1 1 3 0 "%s"\n' % (timestamp, settings.BASIN_1_ID))
+                    f.write('%s 3739 1 1 6 0 "%s"\n' % (timestamp, settings.BASIN_2_ID))
+                    f.write('%s 0 2 2 9 0 "Totals"\n' % timestamp)
+            loader = RecordingLoader()
+            # a windowed import builds and reads through the side-car index
+            with mock.patch('dhsvm_harness.utils.purgeStreamFlowReadings') as purge:
+                readStreamFlowData(flow_file, start='10.01.2001-00:00:00', all_metrics=False, loader=loader)
+            self.assertEqual(purge.call_args[0][2], [settings.BASIN_1_ID, settings.BASIN_2_ID])
+            self.assertEqual(sorted(set([x[2] for x in loader.rows])), [settings.BASIN_1_ID, settings.BASIN_2_ID])
+            self.assertEqual(len(loader.rows), 4)
+
+    def test_flow_file_end_lines(self):
+        with open(settings.FLOW_FILE, 'r') as f:
+            inlines = f.readlines()
+        (first_line, last_line) = getFlowFileEndLines(settings.FLOW_FILE, chunk_size=16)
+        self.assertEqual(first_line, inlines[0])
+        self.assertEqual(last_line.strip(), inlines[-1].strip())
+
+    def test_segment_id_list(self):
+        # the test file has no '"Totals"' rows: the list ends with the first timestep
+        with open(settings.FLOW_FILE, 'r') as f:
+            self.assertEqual(getSegmentIdList(f), [settings.BASIN_1_ID, settings.BASIN_2_ID])
+        totals_lines = [
+            '10.01.2001-00:00:00 3726 1 1 1 0 "metw_3726"\n',
+            '10.01.2001-00:00:00 0 1 1 1 0 "Totals"\n',
+            '10.01.2001-03:00:00 3726 1 1 1 0 "metw_3726"\n',
+        ]
+        self.assertEqual(getSegmentIdList(totals_lines), ['metw_3726'])
+
+    def test_byte_ranges_cover_every_line_once(self):
+        with open(settings.FLOW_FILE, 'r') as f:
+            inlines = f.readlines()
+        for shard_count in [1, 2, 3, 7]:
+            shards = getStreamFlowByteRanges(settings.FLOW_FILE, shard_count)
+            shard_lines = []
+            for (start, end) in shards:
+                for (batch, bytes_read) in iterStreamFlowBatches(settings.FLOW_FILE, batch_size=1000, start=start, end=end):
+                    shard_lines += batch
+            self.assertEqual(shard_lines, inlines)
+
+    def test_indexed_reads(self):
+        with open(settings.FLOW_FILE, 'r') as f:
+            inlines = f.readlines()
+        index = flow_index.build_stream_flow_index(settings.FLOW_FILE)
+        self.assertEqual(list(index['segment_ids']), [settings.BASIN_1_ID, settings.BASIN_2_ID])
+        self.assertEqual(list(flow_index.read_indexed_lines(settings.FLOW_FILE, index)), inlines)
+        segment_lines = [x for x in inlines if '"%s"' % settings.BASIN_2_ID in x]
+        self.assertEqual(list(flow_index.read_indexed_lines(settings.FLOW_FILE, index, [settings.BASIN_2_ID])), segment_lines)
+        window_lines = list(flow_index.read_indexed_lines(settings.FLOW_FILE, index, [settings.BASIN_1_ID], start='10.02.2001-00:00:00', end='10.02.2001-21:00:00'))
+        self.assertEqual(len(window_lines), 8)
+        self.assertTrue(window_lines[0].startswith('10.02.2001-00:00:00'))
+        self.assertTrue(window_lines[-1].startswith('10.02.2001-21:00:00'))
+
+        # parallel imports of an indexed file split the selected blocks between workers
+        (first_block, last_block) = flow_index.get_block_range(index, '10.02.2001-00:00:00', '10.02.2001-21:00:00')
+        shards = getStreamFlowBlockShards(index, 3, 2, first_block, last_block)
+        self.assertEqual([x[1] for x in shards], sorted(set([x[1] for x in shards])))
+        self.assertEqual(shards[0][1], first_block)
+        self.assertEqual(shards[-1][2], last_block)
+        for (previous, shard) in zip(shards[:-1], shards[1:]):
+            self.assertEqual(previous[2], shard[1])
+            self.assertEqual(shard[0], shard[1] - 2)
@@ -1,15 +1,25 @@
 import json
+import math
 import os
+import tempfile
 
+import numpy
+import pyproj
+import rasterio
+from rasterio.transform import from_origin
+
+from django.conf import settings as ucsrb_settings
 from django.test import TestCase
 from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.auth.models import User, AnonymousUser
+from shapely.geometry import Point, box, shape
 
 from ucsrb.models import TreatmentScenario, FocusArea
 
+from dhsvm_harness import scratch
 from dhsvm_harness import settings as harness_settings
 from dhsvm_harness.tests import testing_settings as settings
-from dhsvm_harness.utils import getRunDir, runHarnessConfig, getTargetBasin, setVegLayers
+from dhsvm_harness.utils import getRunDir, runHarnessConfig, prepareHarnessYearRuns, readStreamFlowYears, getTargetBasin, setVegLayers, getTransformer, reprojectShape, compositeVegLayers, compositeVegLayersFromVpuGrid
 
 class ConfigRunTest(TestCase):
 
@@ -94,3 +104,99 @@ class ConfigRunTest(TestCase):
         # self.assertTrue(ts_target_basin)
 
         runHarnessConfig(treatment_scenario1)
+
+    def test_prepare_year_runs(self):
+        treatment_scenario1 = TreatmentScenario.objects.get(name="treatment_scenario1")
+        harness_runs = prepareHarnessYearRuns(treatment_scenario1)
+        self.assertEqual([x['weather_year'] for x in harness_runs], list(ucsrb_settings.MODEL_YEARS.keys()))
+
+        # every year has its own INPUT file, but the generated inputs are shared
+        self.assertEqual(len(set([x['input_file'] for x in harness_runs])), len(harness_runs))
+        veg_files = [os.path.join(x['run_dir'], 'ts_inputs', 'ts_clipped_treatment_layer.asc.bin') for x in harness_runs]
+        for veg_file in veg_files[1:]:
+            self.assertTrue(os.path.samefile(veg_file, veg_files[0]))
+        for harness_run in harness_runs:
+            with open(harness_run['input_file'], 'r') as f:
+                self.assertIn(harness_run['run_dir'], f.read())
+
+        # nothing was modelled: nothing is archived or imported
+        readStreamFlowYears(harness_runs, treatment_scenario1, dict([(x['weather_year'], 1) for x in harness_runs]))
+
+        # releasing is left to the caller (runHarnessConfigYears)
+        for harness_run in harness_runs:
+            self.assertTrue(os.path.isfile(os.path.join(harness_run['run_dir'], scratch.ACTIVE_FILE)))
+            scratch.release_run(harness_run['run_dir'])
+            self.assertFalse(os.path.exists(os.path.join(harness_run['run_dir'], scratch.ACTIVE_FILE)))
+
+    def test_reproject_shape(self):
+        treatment_scenario1 = TreatmentScenario.objects.get(name="treatment_scenario1")
+        feature_shape = shape(json.loads(treatment_scenario1.geometry_dissolved.json))
+
+        transformer = getTransformer(harness_settings.GEOMETRY_PROJECTION, harness_settings.PROJECTION)
+        self.assertIs(transformer, getTransformer(harness_settings.GEOMETRY_PROJECTION, harness_settings.PROJECTION))
+
+        # the Albers origin (120W, 34N), in web mercator, lands on its false
+        #   easting and northing (within the NAD83/WGS84 datum shift)
+        earth_radius = 6378137.0
+        origin = Point(math.radians(-120)*earth_radius, earth_radius*math.log(math.tan(math.pi/4 + math.radians(34)/2)))
+        ts_origin = reprojectShape(origin)
+        self.assertAlmostEqual(ts_origin.x, 600000.0, delta=5)
+        self.assertAlmostEqual(ts_origin.y, 0.0, delta=5)
+
+        # every vertex matches a Transformer built independently of getTransformer
+        reference = pyproj.Transformer.from_crs(harness_settings.GEOMETRY_PROJECTION, harness_settings.PROJECTION, always_xy=True)
+        ts_shape = reprojectShape(feature_shape)
+        self.assertEqual(ts_shape.geom_type, feature_shape.geom_type)
+        for (polygon, ts_polygon) in zip(feature_shape.geoms, ts_shape.geoms):
+            for (point, ts_point) in zip(polygon.exterior.coords, ts_polygon.exterior.coords):
+                expected = reference.transform(point[0], point[1])
+                self.assertAlmostEqual(ts_point[0], expected[0], places=6)
+                self.assertAlmostEqual(ts_point[1], expected[1], places=6)
+
+    def test_composite_veg_layers(self):
+        profile = {
+            'driver': 'GTiff',
+            'width': 10,
+            'height': 10,
+            'count': 1,
+            'dtype': rasterio.uint8,
+            'nodata': 0,
+            'transform': from_origin(0, 10, 1, 1),
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            layers = {}
+            for (rx_id, value) in [('notr', 1), ('rx_a', 5), ('rx_b', 7)]:
+                data = numpy.full((10, 10), value, dtype=numpy.uint8)
+                layer_profile = profile
+                if rx_id == 'rx_b':
+                    # 0 and nodata cells in a treatment layer leave the base untouched
+                    layer_profile = dict(profile, nodata=255)
+                    data[9, :] = 0
+                    data[8, :] = 255
+                with rasterio.open(os.path.join(tmp_dir, '%s.tif' % rx_id), 'w', **layer_profile) as dst:
+                    dst.write(data, 1)
+                layers[rx_id] = rasterio.open(os.path.join(tmp_dir, '%s.tif' % rx_id), 'r')
+
+            # rx_a covers cols 2-4 of rows 2-4; rx_b covers cols 3-7 of rows 3-9
+            composite = compositeVegLayers(layers['notr'], [
+                (layers['rx_a'], box(2, 5, 5, 8)),
+                (layers['rx_b'], box(3, 0, 8, 7)),
+            ])
+            # the same treatments as VPUs 1 and 2-3 on a VPU id grid
+            vpu_grid = numpy.zeros((10, 10), dtype=numpy.int32)
+            vpu_grid[3:10, 3:8] = 2
+            vpu_grid[6:10, 3:8] = 3
+            vpu_grid[2:5, 2:5] = 1
+            vpu_composite = compositeVegLayersFromVpuGrid(layers['notr'], vpu_grid, [
+                (layers['rx_a'], [1]),
+                (layers['rx_b'], [2, 3]),
+            ])
+            for layer in layers.values():
+                layer.close()
+
+        expected = numpy.ones((10, 10), dtype=numpy.uint8)
+        expected[3:10, 3:8] = 7
+        expected[8:10, 3:8] = 1
+        expected[2:5, 2:5] = 5
+        self.assertTrue(numpy.array_equal(composite, expected))
+        self.assertTrue(numpy.array_equal(vpu_composite, expected))
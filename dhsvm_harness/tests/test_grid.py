@@ -0,0 +1,50 @@
+import os
+import tempfile
+
+import numpy
+from django.test import SimpleTestCase
+
+from dhsvm_harness import grid
+
+class DhsvmGridTestCase(SimpleTestCase):
+    def test_binary_round_trip(self):
+        veg = numpy.arange(12, dtype=numpy.int64).reshape(1, 3, 4)
+        dem = numpy.linspace(100, 2000, 12).reshape(3, 4)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            veg_file = grid.write_dhsvm_binary(veg, os.path.join(tmp_dir, 'veg.asc.bin'), 'character')
+            dem_file = grid.write_dhsvm_binary(dem, os.path.join(tmp_dir, 'dem.asc.bin'), 'float')
+            # one byte per cell, northern row first, as myconvert writes it
+            with open(veg_file, 'rb') as f:
+                self.assertEqual(f.read(), bytes(range(12)))
+            self.assertEqual(os.path.getsize(dem_file), 12*4)
+            self.assertTrue(numpy.array_equal(grid.read_dhsvm_binary(veg_file, 3, 4), veg[0]))
+            self.assertTrue(numpy.allclose(grid.read_dhsvm_binary(dem_file, 3, 4, 'float'), dem))
+            with self.assertRaises(ValueError):
+                grid.read_dhsvm_binary(dem_file, 4, 4, 'float')
+            with self.assertRaises(ValueError):
+                grid.write_dhsvm_binary(veg*100, os.path.join(tmp_dir, 'bad.asc.bin'), 'character')
+
+    def test_memmap_windows(self):
+        parent_def = {'nrows': 6, 'ncols': 5, 'xllcorner': 1000.0, 'yllcorner': 2000.0, 'cellsize': 90}
+        # 3 x 2 grid, one column in from the west edge and two rows down from the north
+        sub_def = {'nrows': 3, 'ncols': 2, 'xllcorner': 1090.0, 'yllcorner': 2090.0, 'cellsize': 90}
+        window = grid.get_grid_window(parent_def, sub_def)
+        self.assertEqual(window, (2, 1, 3, 2))
+        self.assertEqual(grid.get_grid_data_type('metw_soild.asc.bin')['type'], 'float')
+        self.assertEqual(grid.get_grid_data_type('metw_soiltype.asc.bin')['type'], 'character')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dem_file = os.path.join(tmp_dir, 'metw_dem.asc.bin')
+            dem = numpy.arange(30, dtype=numpy.float32).reshape(6, 5)
+            grid.write_dhsvm_binary(dem, dem_file, 'float')
+            dem_grid = grid.open_dhsvm_grid(dem_file, parent_def)
+            self.assertIsInstance(dem_grid, numpy.memmap)
+            self.assertTrue(numpy.array_equal(grid.read_grid_window(dem_grid, window), dem[2:5, 1:3]))
+            del dem_grid
+
+            dem_grid = grid.open_dhsvm_grid(dem_file, parent_def, mode='r+')
+            grid.write_grid_window(dem_grid, window, -9999)
+            del dem_grid
+            dem[2:5, 1:3] = -9999
+            self.assertTrue(numpy.array_equal(grid.read_dhsvm_binary(dem_file, 6, 5, 'float'), dem))
+            with self.assertRaises(ValueError):
+                grid.get_grid_window(sub_def, parent_def)
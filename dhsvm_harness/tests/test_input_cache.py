@@ -0,0 +1,86 @@
+from datetime import datetime
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+
+from dhsvm_harness import input_cache, result_store
+
+class RunInputsCacheTestCase(SimpleTestCase):
+    def test_store_and_fetch(self):
+        key = input_cache.get_inputs_key({'superbasin': 'metw', 'rx_vpu_ids': {'flow': [3, 1]}, 'save_segments': 'all'})
+        self.assertEqual(key, input_cache.get_inputs_key({'save_segments': 'all', 'rx_vpu_ids': {'flow': [3, 1]}, 'superbasin': 'metw'}))
+        self.assertNotEqual(key, input_cache.get_inputs_key({'superbasin': 'metw', 'rx_vpu_ids': {'flow': [3, 2]}, 'save_segments': 'all'}))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            run_inputs = os.path.join(tmp_dir, 'run_1', 'ts_inputs')
+            os.makedirs(run_inputs)
+            for (file_name, contents) in [('ts_clipped_treatment_layer.asc.bin', b'\x01\x02'), ('stream.network.dat', b'1\t2\n'), ('leftover.asc', b'ncols 1\n')]:
+                with open(os.path.join(run_inputs, file_name), 'wb') as f:
+                    f.write(contents)
+
+            self.assertIsNone(input_cache.fetch_inputs(key, os.path.join(tmp_dir, 'run_2', 'ts_inputs'), cache_dir))
+            input_cache.store_inputs(key, run_inputs, cache_dir)
+            linked = input_cache.fetch_inputs(key, os.path.join(tmp_dir, 'run_2', 'ts_inputs'), cache_dir)
+            self.assertEqual(linked, ['stream.network.dat', 'ts_clipped_treatment_layer.asc.bin'])
+            veg_file = os.path.join(tmp_dir, 'run_2', 'ts_inputs', 'ts_clipped_treatment_layer.asc.bin')
+            with open(veg_file, 'rb') as f:
+                self.assertEqual(f.read(), b'\x01\x02')
+            self.assertTrue(os.path.samefile(veg_file, os.path.join(run_inputs, 'ts_clipped_treatment_layer.asc.bin')))
+            self.assertIsNone(input_cache.fetch_inputs(key, run_inputs, None))
+
+            # another weather year of the same run links them directly
+            linked = input_cache.link_inputs(run_inputs, os.path.join(tmp_dir, 'run_1_wet', 'ts_inputs'))
+            self.assertEqual(linked, ['stream.network.dat', 'ts_clipped_treatment_layer.asc.bin'])
+            self.assertFalse(os.path.exists(os.path.join(tmp_dir, 'run_1_wet', 'ts_inputs', 'leftover.asc')))
+
+    def test_evict_entries(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            run_inputs = os.path.join(tmp_dir, 'ts_inputs')
+            os.makedirs(run_inputs)
+            with open(os.path.join(run_inputs, 'stream.network.dat'), 'wb') as f:
+                f.write(b'\x00' * 400)
+            entry_dirs = []
+            for (index, key) in enumerate(['a', 'b', 'c']):
+                entry_dirs.append(input_cache.store_inputs(key, run_inputs, cache_dir, 10000))
+                os.utime(entry_dirs[-1], (index, index))
+            # 'a' was fetched most recently, so 'b' goes first
+            input_cache.fetch_inputs('a', os.path.join(tmp_dir, 'run_a'), cache_dir)
+            entry_dirs.append(input_cache.store_inputs('d', run_inputs, cache_dir, 1000))
+            self.assertEqual(sorted(os.listdir(cache_dir)), ['a', 'd'])
+            self.assertEqual(input_cache.evict_entries(cache_dir, 0, keep=entry_dirs[3]), [entry_dirs[0]])
+
+    def test_result_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store_dir = os.path.join(tmp_dir, 'results')
+            template_file = os.path.join(tmp_dir, 'INPUT.UCSRB.methow')
+            with open(template_file, 'w') as f:
+                f.write('Model Start = {{ START }}\n')
+            start = datetime(2001, 10, 1)
+            end = datetime(2002, 9, 30, 21)
+            key = result_store.get_result_key('inputs', 'normal', template_file, start, end)
+            self.assertNotEqual(key, result_store.get_result_key('inputs', 'wet', template_file, start, end))
+            # the dates behind a weather year label changed
+            self.assertNotEqual(key, result_store.get_result_key('inputs', 'normal', template_file, datetime(2003, 10, 1), end))
+
+            flow_file = os.path.join(tmp_dir, 'Stream.Flow')
+            with open(flow_file, 'w') as f:
+                f.write('10.01.2001-00:00:00 1 0 0 6 0 "shed_1"\n')
+            self.assertIsNone(result_store.fetch_result_flow(key, store_dir))
+            result_store.store_result_flow(key, flow_file, store_dir)
+            archived_flow_file = result_store.fetch_result_flow(key, store_dir)
+            os.remove(flow_file)
+            with open(archived_flow_file, 'r') as f:
+                self.assertIn('"shed_1"', f.read())
+
+            with open(template_file, 'a') as f:
+                f.write('Model End = {{ STOP }}\n')
+            self.assertIsNone(result_store.fetch_result_flow(result_store.get_result_key('inputs', 'normal', template_file, start, end), store_dir))
+
+            # a result past the budget evicts the older one
+            with open(flow_file, 'w') as f:
+                f.write('10.01.2001-00:00:00 1 0 0 6 0 "shed_2"\n')
+            result_store.store_result_flow('other', flow_file, store_dir, 50)
+            self.assertIsNone(result_store.fetch_result_flow(key, store_dir))
+            self.assertIsNotNone(result_store.fetch_result_flow('other', store_dir))
@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+from django.test import SimpleTestCase
+
+from dhsvm_harness import instrumentation
+
+class RunTraceTestCase(SimpleTestCase):
+    def test_run_trace(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace = instrumentation.RunTrace('run_12_normal', tmp_dir, treatment_scenario_id=12)
+            with trace.stage('binAsciis'):
+                with open(os.path.join(tmp_dir, 'mask.asc.bin'), 'wb') as f:
+                    f.write(b'\x01' * 100000)
+            with trace.stage('model'):
+                subprocess.run([sys.executable, '-c', 'sum(range(2000000))'], check=True)
+            with self.assertRaises(ValueError):
+                with trace.stage('readStreamFlowData'):
+                    raise ValueError('no flow file')
+            with instrumentation.trace_stage(None, 'untraced'):
+                pass
+
+            self.assertEqual([x['stage'] for x in trace.stages], ['binAsciis', 'model', 'readStreamFlowData'])
+            for record in trace.stages:
+                self.assertGreaterEqual(record['wall_seconds'], 0)
+                self.assertGreaterEqual(record['cpu_seconds'], 0)
+                self.assertGreater(record['max_rss_kb'], 0)
+            self.assertGreater(trace.stages[1]['children_cpu_seconds'], 0)
+            if trace.stages[0]['write_chars'] != None:
+                self.assertGreaterEqual(trace.stages[0]['write_chars'], 100000)
+            self.assertIn('ValueError', trace.stages[2]['error'])
+
+            trace_file = trace.write()
+            self.assertTrue(trace_file.startswith(os.path.join(tmp_dir, 'run_12_normal_')))
+            self.assertIsNone(instrumentation.RunTrace('run_12_normal', None).write())
+            traces = instrumentation.load_traces(tmp_dir)
+            self.assertEqual(traces[0]['context'], {'treatment_scenario_id': 12})
+
+            summary = instrumentation.summarize_traces(traces + traces)
+            self.assertEqual(set(summary.keys()), set(['binAsciis', 'model', 'readStreamFlowData', 'total']))
+            self.assertEqual(summary['model']['count'], 2)
+            self.assertAlmostEqual(summary['model']['total'], 2*trace.stages[1]['wall_seconds'])
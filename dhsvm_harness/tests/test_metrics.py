@@ -0,0 +1,163 @@
+import os
+import statistics
+import tempfile
+from unittest import mock
+
+import numpy
+from django.test import SimpleTestCase
+
+from dhsvm_harness import metrics, metrics_cache
+from dhsvm_harness import settings as harness_settings
+from dhsvm_harness.tests import testing_settings as settings
+
+class FlowMetricsTestCase(SimpleTestCase):
+    def setUp(self):
+        with open(settings.FLOW_FILE, 'r') as f:
+            self.inlines = f.readlines()
+        self.segment_ids = [settings.BASIN_1_ID, settings.BASIN_2_ID]
+
+    def test_format_segment_id(self):
+        for segment_id in [3726, '3726', 'shed_3726']:
+            self.assertEqual(metrics.format_segment_id(segment_id), 'shed_3726')
+        self.assertEqual(metrics.format_segment_id('metw_3726'), 'metw_3726')
+        for segment_id in ['metw', 'shed_37a', '']:
+            with self.assertRaises(ValueError):
+                metrics.format_segment_id(segment_id)
+
+    def test_rolling_kernels(self):
+        values = numpy.random.RandomState(0).uniform(0, 100, 500)
+        for window in [1, 4, 28, 499, 500, 600]:
+            lows = metrics.rolling_low(values, window)
+            means = metrics.rolling_mean(values, window)
+            for index in range(values.size):
+                readings = list(values[max(0, index-window+1):index+1])
+                self.assertEqual(lows[index], min(readings))
+                self.assertAlmostEqual(means[index], statistics.mean(readings))
+
+    def test_metric_flow_shape(self):
+        segments = metrics.get_metric_flow(self.inlines, self.segment_ids)
+        self.assertEqual(sorted(segments.keys()), sorted(self.segment_ids))
+        for segment_id in self.segment_ids:
+            lines = [x for x in self.inlines if '"%s"' % segment_id in x]
+            self.assertEqual(list(segments[segment_id].keys()), list(harness_settings.FLOW_METRICS.keys()))
+            for metric_key in harness_settings.FLOW_METRICS.keys():
+                readings = segments[segment_id][metric_key]
+                self.assertEqual(len(readings), len(lines))
+                self.assertEqual(readings[-1]['timestep'], lines[-1].split()[0])
+            absolute = segments[segment_id][harness_settings.ABSOLUTE_FLOW_METRIC]
+            self.assertEqual(absolute[-1]['value'], float(lines[-1].split()[4])/float(harness_settings.TIMESTEP))
+            seven_low = segments[segment_id]['Seven Day Low Flow']
+            seven_low_change = segments[segment_id]['Change in 7 Day Low Flow Rate']
+            self.assertEqual(seven_low_change[0]['value'], 0)
+            self.assertAlmostEqual(seven_low_change[-1]['value'], seven_low[-1]['value']-seven_low[-2]['value'])
+
+    def test_npz_round_trip(self):
+        (timestamps, segment_names, metric_arrays) = metrics.get_flow_metric_arrays(self.inlines, self.segment_ids)
+        segments = metrics.get_metric_flow(self.inlines, self.segment_ids)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_file = os.path.join(tmp_dir, 'flow_metrics.npz')
+            metrics.write_flow_metrics_npz(out_file, timestamps, segment_names, metric_arrays)
+            loaded = metrics.load_flow_metrics_npz(out_file)
+            self.assertIsInstance(loaded['metrics'][harness_settings.ABSOLUTE_FLOW_METRIC], numpy.memmap)
+            self.assertEqual(list(loaded['timestamps']), timestamps)
+            for (index, segment_id) in enumerate(loaded['segment_ids']):
+                for metric_key in harness_settings.FLOW_METRICS.keys():
+                    expected = numpy.array([x['value'] for x in segments[str(segment_id)][metric_key]], dtype=numpy.float32)
+                    self.assertTrue(numpy.array_equal(loaded['metrics'][metric_key][index], expected))
+            del loaded
+
+    def test_metric_dependencies(self):
+        self.assertEqual(metrics.resolve_metrics(['One Day Low Flow']), [harness_settings.ABSOLUTE_FLOW_METRIC, 'One Day Low Flow'])
+        self.assertEqual(
+            metrics.resolve_metrics(['Change in 7 Day Mean Flow Rate']),
+            [harness_settings.ABSOLUTE_FLOW_METRIC, 'Seven Day Mean Flow', 'Change in 7 Day Mean Flow Rate']
+        )
+        with self.assertRaises(ValueError):
+            metrics.resolve_metrics(['Fourteen Day Low Flow'])
+
+        segments = metrics.get_metric_flow(self.inlines, self.segment_ids)
+        requested = metrics.get_metric_flow(self.inlines, self.segment_ids, ['Change in 1 Day Low Flow Rate'])
+        for segment_id in self.segment_ids:
+            self.assertEqual(list(requested[segment_id].keys()), ['Change in 1 Day Low Flow Rate'])
+            self.assertEqual(requested[segment_id]['Change in 1 Day Low Flow Rate'], segments[segment_id]['Change in 1 Day Low Flow Rate'])
+
+    def test_rolling_metric_order(self):
+        # deltas listed before their source metric still see this timestep's value
+        flows = [float(x.split()[2]) for x in self.inlines if '"%s"' % settings.BASIN_1_ID in x][:100]
+        expected = metrics.RollingFlowMetrics()
+        expected_values = [expected.push(x) for x in flows]
+        reordered = type(harness_settings.FLOW_METRICS)(reversed(list(harness_settings.FLOW_METRICS.items())))
+        with mock.patch.object(metrics, 'FLOW_METRICS', reordered):
+            rolling = metrics.RollingFlowMetrics()
+            for (flow, values) in zip(flows, expected_values):
+                self.assertEqual(dict(rolling.push(flow)), dict(values))
+
+    def test_parallel_metric_flow(self):
+        segments = metrics.get_metric_flow(self.inlines, self.segment_ids)
+        parallel = metrics.get_metric_flow(self.inlines, self.segment_ids, workers=2)
+        self.assertEqual(parallel, segments)
+
+    def test_metrics_cache(self):
+        segments = metrics.get_metric_flow(self.inlines, self.segment_ids)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for segment_ids in [self.segment_ids[:1], None, self.segment_ids]:
+                # partial miss, full miss for unlisted segments, then a hit
+                results = metrics_cache.get_cached_segment_results(settings.FLOW_FILE, segment_ids, cache_dir=cache_dir)
+                cached = metrics.segment_results_to_json(results)
+                for segment_id in segment_ids if segment_ids else self.segment_ids:
+                    self.assertEqual(cached[segment_id], segments[segment_id])
+            results = metrics_cache.get_cached_segment_results(settings.FLOW_FILE, self.segment_ids[1:], ['One Day Low Flow'], cache_dir=cache_dir)
+            self.assertEqual(list(results[self.segment_ids[1]][1].keys()), ['One Day Low Flow'])
+
+            entry_dir = os.path.join(cache_dir, metrics_cache.get_entry_key(settings.FLOW_FILE, cache_dir))
+            stale_dir = os.path.join(cache_dir, 'stale')
+            os.makedirs(stale_dir)
+            with open(os.path.join(stale_dir, 'segment.npz'), 'wb') as f:
+                f.write(b'0'*1024)
+            os.utime(stale_dir, (0, 0))
+            evicted = metrics_cache.evict_cache_entries(cache_dir, metrics_cache.get_entry_size(entry_dir), keep=entry_dir)
+            self.assertEqual(evicted, [stale_dir])
+            self.assertTrue(os.path.isdir(entry_dir))
+
+    def test_metrics_cache_misses(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # a segment the file doesn't have is only looked for once
+            segment_ids = [self.segment_ids[0], 'metw_9999']
+            results = metrics_cache.get_cached_segment_results(settings.FLOW_FILE, segment_ids, cache_dir=cache_dir)
+            self.assertEqual(list(results.keys()), [self.segment_ids[0]])
+            with mock.patch.object(metrics, 'get_segment_results', side_effect=AssertionError('re-parsed')):
+                results = metrics_cache.get_cached_segment_results(settings.FLOW_FILE, segment_ids, cache_dir=cache_dir)
+            self.assertEqual(list(results.keys()), [self.segment_ids[0]])
+
+            memo = {settings.FLOW_FILE: [0, 0, 'digest'], os.path.join(cache_dir, 'removed.Flow'): [0, 0, 'digest']}
+            for file_name in ['a', 'b']:
+                memo[os.path.join(cache_dir, file_name)] = [0, 0, 'digest']
+                with open(os.path.join(cache_dir, file_name), 'w'):
+                    pass
+            self.assertEqual(list(metrics_cache.prune_hash_memo(memo, 2).keys()), [os.path.join(cache_dir, 'a'), os.path.join(cache_dir, 'b')])
+
+    def test_compare_flow_lines(self):
+        # treatment doubles every outflow and drops the first timestep
+        first_timestamp = self.inlines[0].split()[0]
+        treatment_inlines = []
+        for line in self.inlines:
+            data = line.split()
+            if data[0] == first_timestamp:
+                continue
+            if data[-1] != '"Totals"':
+                data[4] = str(float(data[4])*2)
+            treatment_inlines.append(' '.join(data) + '\n')
+        baseline = metrics.get_segment_results(self.inlines, self.segment_ids)
+        comparison = metrics.compare_flow_lines(self.inlines, treatment_inlines, self.segment_ids)
+        for segment_id in self.segment_ids:
+            (timestamps, segment_comparison) = comparison[segment_id]
+            self.assertEqual(timestamps, baseline[segment_id][0][1:])
+            absolute = segment_comparison[harness_settings.ABSOLUTE_FLOW_METRIC]
+            self.assertTrue(numpy.allclose(absolute['baseline'], baseline[segment_id][1][harness_settings.ABSOLUTE_FLOW_METRIC][1:]))
+            self.assertTrue(numpy.allclose(absolute['difference'], absolute['baseline']))
+            nonzero = absolute['baseline'] != 0
+            self.assertTrue(numpy.allclose(absolute['percent'][nonzero], 100.0))
+            self.assertTrue(numpy.isnan(absolute['percent'][~nonzero]).all())
+            self.assertEqual(list(segment_comparison.keys()), list(harness_settings.FLOW_METRICS.keys()))
+        segments = metrics.comparison_to_json(comparison)
+        self.assertEqual(segments[self.segment_ids[0]][harness_settings.ABSOLUTE_FLOW_METRIC][0]['timestep'], timestamps[0])
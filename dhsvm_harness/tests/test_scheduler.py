@@ -0,0 +1,119 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+from django.test import SimpleTestCase
+
+from dhsvm_harness import scheduler
+
+class StubProcess(object):
+    pid = None
+    returncode = None
+
+    def poll(self):
+        return self.returncode
+
+class StubJobScheduler(scheduler.JobScheduler):
+    # Runs stages as stub processes that the test finishes by hand
+    def launch_stage(self, job, stage):
+        return StubProcess()
+
+    def finish_stage(self, job_id, stage, returncode):
+        if stage == 'prepare':
+            scheduler.update_job(job_id, self.db_path, state=scheduler.PREPARED, run={'run_dir': '/tmp/runs/run_%d_normal' % job_id})
+        elif stage == 'model':
+            scheduler.update_job(job_id, self.db_path, state=scheduler.MODELLED, returncode=returncode)
+        else:
+            scheduler.update_job(job_id, self.db_path, state=scheduler.DONE)
+
+    def finish_running(self, stage):
+        for (job_id, (task_stage, cores, process)) in self.tasks.items():
+            if task_stage == stage:
+                process.returncode = 0
+
+    def get_running(self):
+        return sorted([(job_id, x[0]) for (job_id, x) in self.tasks.items()])
+
+class JobSchedulerTestCase(SimpleTestCase):
+    def test_job_queue(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'jobs.sqlite3')
+            job_id = scheduler.submit_job(12, weather_year='normal', db_path=db_path)
+            baseline_id = scheduler.submit_job(basin='methow', weather_year='wet', db_path=db_path)
+            with self.assertRaises(ValueError):
+                scheduler.submit_job(db_path=db_path)
+            with self.assertRaises(ValueError):
+                scheduler.submit_job(12, weather_year='monsoon', db_path=db_path)
+
+            job = scheduler.get_job(job_id, db_path)
+            self.assertEqual((job['treatment_scenario_id'], job['basin'], job['state']), (12, None, scheduler.QUEUED))
+            self.assertEqual(scheduler.get_job(baseline_id, db_path)['basin'], 'methow')
+            self.assertEqual([x['id'] for x in scheduler.list_jobs([scheduler.QUEUED], db_path)], [job_id, baseline_id])
+
+            self.assertTrue(scheduler.cancel_job(baseline_id, db_path))
+            self.assertFalse(scheduler.cancel_job(baseline_id, db_path))
+            self.assertEqual(scheduler.get_job(baseline_id, db_path)['state'], scheduler.CANCELLED)
+            self.assertIsNotNone(scheduler.get_job(baseline_id, db_path)['finished'])
+
+            # a stage that started first wins over a cancel
+            self.assertTrue(scheduler.update_job(job_id, db_path, from_states=[scheduler.QUEUED], state=scheduler.PREPARING))
+            self.assertFalse(scheduler.update_job(job_id, db_path, from_states=[scheduler.QUEUED], state=scheduler.PREPARING))
+            self.assertFalse(scheduler.cancel_job(job_id, db_path))
+
+            # a scheduler restart returns interrupted stages to the queue
+            scheduler.recover_jobs(db_path)
+            self.assertEqual(scheduler.get_job(job_id, db_path)['state'], scheduler.QUEUED)
+
+    def test_recover_running_model(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'jobs.sqlite3')
+            run_dir = os.path.join(tmp_dir, 'run_12_normal')
+            os.makedirs(run_dir)
+            job_id = scheduler.submit_job(12, weather_year='normal', db_path=db_path)
+            model = subprocess.Popen([sys.executable, '-c', 'import sys; sys.stdin.read()'], stdin=subprocess.PIPE)
+            scheduler.update_job(job_id, db_path, state=scheduler.MODELLING, run={'run_dir': run_dir}, pid=model.pid)
+
+            # the model outlived the scheduler: it keeps its state and cores
+            orphaned = scheduler.recover_jobs(db_path)
+            self.assertEqual([x['id'] for x in orphaned], [job_id])
+            self.assertEqual(scheduler.get_job(job_id, db_path)['state'], scheduler.MODELLING)
+            job_scheduler = StubJobScheduler(db_path=db_path)
+            job_scheduler.adopt_stages(orphaned)
+            job_scheduler.step()
+            self.assertEqual(job_scheduler.get_running(), [(job_id, 'model')])
+
+            # once it exits the model stage runs again
+            model.communicate()
+            job_scheduler.step()
+            self.assertEqual(scheduler.get_job(job_id, db_path)['state'], scheduler.MODELLING)
+            self.assertEqual(job_scheduler.get_running(), [(job_id, 'model')])
+            self.assertIsInstance(job_scheduler.tasks[job_id][2], StubProcess)
+
+    def test_core_budget(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'jobs.sqlite3')
+            job_ids = [scheduler.submit_job(x, weather_year='normal', db_path=db_path) for x in range(1, 5)]
+            job_scheduler = StubJobScheduler(cores=scheduler.STAGE_CORES['model'] + 1, db_path=db_path)
+
+            job_scheduler.step()
+            self.assertEqual(job_scheduler.get_running(), [(x, 'prepare') for x in job_ids])
+            self.assertEqual(job_scheduler.get_cores_in_use(), 4)
+
+            # the first model stage waits for cores; later prepares don't overtake it
+            job_scheduler.finish_running('prepare')
+            job_scheduler.step()
+            self.assertEqual(job_scheduler.get_running(), [(job_ids[0], 'model')])
+            self.assertEqual(scheduler.get_job(job_ids[0], db_path)['state'], scheduler.MODELLING)
+
+            # the finished model's import starts before the next model
+            job_scheduler.finish_running('model')
+            job_scheduler.step()
+            self.assertEqual(job_scheduler.get_running(), [(job_ids[0], 'import'), (job_ids[1], 'model')])
+            self.assertLessEqual(job_scheduler.get_cores_in_use(), job_scheduler.cores)
+
+            for stage in ['import', 'model', 'import', 'model', 'import', 'model', 'import']:
+                job_scheduler.finish_running(stage)
+                job_scheduler.step()
+            self.assertEqual(job_scheduler.tasks, {})
+            self.assertEqual([x['state'] for x in scheduler.list_jobs(db_path=db_path)], [scheduler.DONE]*4)
@@ -0,0 +1,57 @@
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+
+from dhsvm_harness import scratch
+
+class ScratchRunsTestCase(SimpleTestCase):
+    def write_output(self, run_dir, size):
+        with open(os.path.join(run_dir, 'output', 'Stream.Flow'), 'wb') as f:
+            f.write(b'\x00' * size)
+
+    def test_run_dirs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            runs_dir = os.path.join(tmp_dir, 'runs')
+            outputs_dir = os.path.join(tmp_dir, 'outputs')
+            run_dir = scratch.create_run_dir(12, 'normal', runs_dir, outputs_dir, 1000)
+            self.assertEqual(run_dir, os.path.join(runs_dir, 'run_12_normal'))
+            self.assertTrue(os.path.isdir(os.path.join(run_dir, 'ts_inputs')))
+            self.assertTrue(os.path.islink(os.path.join(run_dir, 'output')))
+            self.assertTrue(scratch.is_run_active(run_dir))
+            self.write_output(run_dir, 100)
+
+            scratch.release_run(run_dir, runs_dir, outputs_dir, 1000)
+            self.assertFalse(scratch.is_run_active(run_dir))
+            self.assertEqual(scratch.get_run_size(run_dir, outputs_dir), 100)
+            # files shared with a cache (or another run) aren't freed by evicting the run
+            os.link(os.path.join(run_dir, 'output', 'Stream.Flow'), os.path.join(tmp_dir, 'Stream.Flow'))
+            self.assertEqual(scratch.get_run_size(run_dir, outputs_dir), 0)
+            self.assertEqual(scratch.find_run(12, 'normal', runs_dir), run_dir)
+            self.assertEqual(scratch.get_run_flow_file(12, 'normal', runs_dir), os.path.join(run_dir, 'output', 'Stream.Flow'))
+            self.assertIsNone(scratch.find_run(12, 'wet', runs_dir))
+            self.assertIsNone(scratch.get_run_flow_file('baseline_metw', 'normal', runs_dir))
+            # releasing a run that has already been evicted is harmless
+            scratch.release_run(os.path.join(runs_dir, 'run_13_normal'), runs_dir, outputs_dir, 1000)
+
+            # re-running a scenario and year starts from an empty run dir
+            run_dir = scratch.create_run_dir(12, 'normal', runs_dir, outputs_dir, 1000)
+            self.assertEqual(os.listdir(os.path.join(run_dir, 'output')), [])
+
+    def test_evict_runs(self):
+        with tempfile.TemporaryDirectory() as runs_dir:
+            run_dirs = []
+            for (index, weather_year) in enumerate(['dry', 'normal', 'wet']):
+                run_dir = scratch.create_run_dir('baseline_metw', weather_year, runs_dir, None, 10000)
+                self.write_output(run_dir, 400)
+                scratch.release_run(run_dir, runs_dir, None, 10000)
+                os.utime(os.path.join(run_dir, scratch.LAST_USED_FILE), (index, index))
+                run_dirs.append(run_dir)
+            # 'dry' was used least recently, so it goes first; 'normal' is in use
+            scratch.find_run('baseline_metw', 'dry', runs_dir)
+            os.utime(os.path.join(run_dirs[0], scratch.LAST_USED_FILE), (5, 5))
+            with open(os.path.join(run_dirs[1], scratch.ACTIVE_FILE), 'w') as f:
+                f.write(str(os.getpid()))
+            evicted = scratch.evict_runs(runs_dir, None, 500)
+            self.assertEqual(evicted, [run_dirs[2], run_dirs[0]])
+            self.assertEqual(sorted(os.listdir(runs_dir)), ['run_baseline_metw_normal'])
@@ -1,39 +1,64 @@
 # import configparser
+from collections import OrderedDict
 from datetime import datetime
 from django.conf import settings as ucsrb_settings
 from django.template import Template, Context
 from django.utils.timezone import get_current_timezone
-from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
+from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Polygon
 from django.contrib.gis.gdal.error import GDALException
 from django.contrib.gis.db.models.aggregates import Union
-from django.db import transaction, connection
-from functools import partial
+from django.db import transaction, connection, connections
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache, partial
+import csv
+import io
 import json
-# import numpy
+import multiprocessing
+import numpy
 import os
 import tempfile
 import pyproj
 import rasterio
+from rasterio.errors import WindowError
+import rasterio.features
 from rasterio.mask import mask
-from rasterio.merge import merge
+from rasterio.windows import Window
 import shapely
 from shapely.geometry import shape
 import shapely.ops
 import shutil
 import statistics
+import subprocess
 import sys
+import time
 from ucsrb.models import StreamFlowReading, TreatmentScenario, FocusArea, TreatmentArea, VegPlanningUnit
 from ucsrb.views import break_up_multipolygons
-from dhsvm_harness.settings import FLOW_METRICS, TIMESTEP, ABSOLUTE_FLOW_METRIC, DELTA_FLOW_METRIC, BASINS_DIR, RUNS_DIR, SUPERBASINS, DHSVM_BUILD, RUN_CORES, MASK_RUNS
+from dhsvm_harness import flow_index, input_cache, result_store, scratch
+from dhsvm_harness.grid import write_dhsvm_binary
+from dhsvm_harness.instrumentation import RunTrace, trace_stage
+from dhsvm_harness.metrics import RollingFlowMetrics, get_max_window_length, compute_flow_metrics, compare_segment_results
+from dhsvm_harness.settings import FLOW_METRICS, TIMESTEP, ABSOLUTE_FLOW_METRIC, DELTA_FLOW_METRIC, BASINS_DIR, RUNS_DIR, SUPERBASINS, DHSVM_BUILD, RUN_CORES, IMPORT_WORKERS, SCHEDULER_CORES, SCHEDULER_POLL_SECONDS, MASK_RUNS, FLOW_IMPORT_BATCH_SIZE, FLOW_COPY_BUFFER_BYTES, FLOW_FOLLOW_IMPORT, FLOW_FOLLOW_POLL_SECONDS, IMPORT_ALL_FLOW_METRICS, GEOMETRY_PROJECTION, PROJECTION
 
 
 def getSegmentIdList(inlines):
+    # The segments of the first timestep block, which ends at '"Totals"' or,
+    #   in files without totals (e.g. cleanStreamFlowData output), at the next
+    #   timestamp
     segment_id = []
+    first_timestamp = None
     for line in inlines:
         line_list = line.split()
+        if not line_list:
+            continue
         if line_list[-1] == '"Totals"':
             return segment_id
-        segment_id.append(line_list[-1].split('"')[1])
+        if first_timestamp == None:
+            first_timestamp = line_list[0]
+        elif line_list[0] != first_timestamp:
+            return segment_id
+        segment = line_list[-1].split('"')[1]
+        if not segment in segment_id:
+            segment_id.append(segment)
     return segment_id
 
 def check_stream_segment_ids(inlines, segment_ids=None):
@@ -57,160 +82,513 @@ def cleanStreamFlowData(flow_file, out_file, segment_ids=None):
         shutil.copyfile(flow_file, out_file)
         return True
     else:
-        with open(flow_file, 'r') as f:
-            inlines=f.readlines()
-
-        segment_ids = check_stream_segment_ids(inlines, segment_ids)
-
+        segment_ids = check_stream_segment_ids([], segment_ids)
+        # only the requested segments' rows are read, and ids are matched
+        #   exactly: 'metw_37' no longer picks up 'metw_3726'
+        index = flow_index.get_stream_flow_index(flow_file)
         with open(out_file, 'w') as f:
-            for line in inlines:
-                for id in segment_ids:
-                    if id in line:
-                        f.write(line)
+            for line in flow_index.read_indexed_lines(flow_file, index, segment_ids):
+                f.write(line)
         return True
 
-def getBasinLineInsertTuple(line, basin_name, is_baseline, scenario):
-    tz = get_current_timezone()
-    data = line.split()
-    reading = data[4]
-    timestamp = data[0]
-    treatment_id = scenario.pk if scenario else "NULL"
-
-    return "('{TIMESTAMP}', '{TIME}'::timestamptz, '{SEGMENT_ID}', '{METRIC}', {IS_BASELINE}, {TREATMENT_ID}, {VALUE})".format(
-        TIMESTAMP=timestamp,
-        TIME='T'.join(str(tz.localize(datetime.strptime(timestamp, "%m.%d.%Y-%H:%M:%S"))).split(' ')),
-        SEGMENT_ID=basin_name,
-        METRIC=ABSOLUTE_FLOW_METRIC,
-        IS_BASELINE=str(is_baseline).lower(),
-        TREATMENT_ID=treatment_id,
-        VALUE=float(reading)/float(TIMESTEP)
-    )
-
-def importBasinLines(inlines, segment_ids, scenario, is_baseline):
-    insert_command_start = ('INSERT INTO '
-                        '"ucsrb_streamflowreading" ( '
-                        '"timestamp", "time", "segment_id", '
-                        '"metric", "is_baseline", '
-                        '"treatment_id", "value"'
-                        ') VALUES '
+class StreamFlowCopyLoader(object):
+    # Bulk loader for StreamFlowReading rows.
+    #   Rows are written as CSV into an in-memory buffer and streamed to
+    #   PostgreSQL with COPY ... FROM STDIN whenever the buffer grows past
+    #   max_bytes, so batch size follows row width rather than line count.
+    #   The loader does not commit: wrap it in transaction.atomic() to load a
+    #   run as a single transaction.
+    COPY_COMMAND = ('COPY "ucsrb_streamflowreading" ('
+                    '"timestamp", "time", "segment_id", '
+                    '"metric", "is_baseline", '
+                    '"treatment_id", "value"'
+                    ') FROM STDIN WITH (FORMAT csv)'
     )
 
-    insert_command_end = ''
-    insert_command_lines = []
+    def __init__(self, cursor=None, max_bytes=FLOW_COPY_BUFFER_BYTES):
+        self.cursor = cursor if cursor else connection.cursor()
+        self.max_bytes = max_bytes
+        self.row_count = 0
+        self._reset()
+
+    def _reset(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator='\n')
+
+    def addRow(self, row):
+        # row: (timestamp, time, segment_id, metric, is_baseline, treatment_id, value)
+        #   a treatment_id of None is written as an unquoted empty field: NULL
+        self.writer.writerow(row)
+        self.row_count += 1
+        if self.buffer.tell() >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.buffer.tell() > 0:
+            self.buffer.seek(0)
+            self.cursor.copy_expert(self.COPY_COMMAND, self.buffer)
+            self._reset()
+
+    def close(self):
+        self.flush()
+        self.cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.cursor.close()
+        return False
+
+# Every timestamp in a Stream.Flow repeats once per SAVE segment, so parsing
+#   and localizing is memoized: datetime work is per timestep, not per line.
+#   A year of 3 hour timesteps is under 3000 entries.
+@lru_cache(maxsize=65536)
+def localizeFlowTimestamp(timestamp, tz):
+    return tz.localize(datetime.strptime(timestamp, "%m.%d.%Y-%H:%M:%S"))
+
+@lru_cache(maxsize=65536)
+def getFlowTimestampIso(timestamp, tz):
+    return localizeFlowTimestamp(timestamp, tz).isoformat()
+
+def parseBasinLine(line, tz):
+    # (timestamp, localized ISO time, flow rate) for a single segment line
+    data = line.split()
+    timestamp = data[0]
+    return (timestamp, getFlowTimestampIso(timestamp, tz), float(data[4])/float(TIMESTEP))
 
+def getImportTargets(scenario, is_baseline):
+    # (treatment_id, is_baseline) pairs that every imported reading is written as
+    targets = []
+    if scenario:
+        targets.append((scenario.pk, is_baseline))
+    if is_baseline: # if not scenario or scenario.prescription_treatment_selection == 'notr':
+        targets.append((None, True))
+    return targets
+
+def importBasinLines(inlines, segment_ids, targets, loader, rolling_metrics=None):
+    # Each line is tokenized once and written for every target, so a reset run
+    #   loads its treatment and baseline rows in the same pass.
+    # rolling_metrics: {segment_id: RollingFlowMetrics} carried across batches
+    #   to write every FLOW_METRICS series; None writes only absolute flow.
+    #   With no targets the lines just advance the rolling windows.
+    tz = get_current_timezone()
     for line in inlines:
         try:
             basin_name = line.split('"')[1]
-            if basin_name in segment_ids:
-                insert_command_lines.append(getBasinLineInsertTuple(line, basin_name, is_baseline, scenario))
         except IndexError as e:
             # handle empty lines (why would we have these?)
-            pass
+            continue
         if basin_name in segment_ids:
-            insert_command_lines.append(getBasinLineInsertTuple(line, basin_name, is_baseline, scenario))
-
-    connection.cursor().execute("{START} {VALUES} {END}; COMMIT;".format(
-        START=insert_command_start,
-        VALUES=','.join(insert_command_lines),
-        END=insert_command_end
-    ))
+            (timestamp, time, value) = parseBasinLine(line, tz)
+            if rolling_metrics == None:
+                for (treatment_id, target_is_baseline) in targets:
+                    loader.addRow((timestamp, time, basin_name, ABSOLUTE_FLOW_METRIC, target_is_baseline, treatment_id, value))
+            else:
+                if not basin_name in rolling_metrics:
+                    rolling_metrics[basin_name] = RollingFlowMetrics()
+                metric_values = rolling_metrics[basin_name].push(value)
+                for (treatment_id, target_is_baseline) in targets:
+                    for metric_key in metric_values.keys():
+                        loader.addRow((timestamp, time, basin_name, metric_key, target_is_baseline, treatment_id, metric_values[metric_key]))
+
+def getFlowFileEndLines(flow_file, chunk_size=8192):
+    # Return the first and last non-empty lines of a flow file without reading
+    #   everything in between: the head is a single readline, the tail is found
+    #   by reading backwards from EOF until a full line has been seen.
+    with open(flow_file, 'rb') as f:
+        first_line = f.readline()
+        while first_line and not first_line.strip():
+            first_line = f.readline()
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = b''
+        while position > 0:
+            read_size = min(chunk_size, position)
+            position -= read_size
+            f.seek(position)
+            tail = f.read(read_size) + tail
+            # need at least one newline in front of the last non-empty line
+            if tail.rstrip().count(b'\n') > 0:
+                break
+        tail_lines = [x for x in tail.splitlines() if x.strip()]
+        last_line = tail_lines[-1] if tail_lines else first_line
+    return (first_line.decode(), last_line.decode())
+
+def iterStreamFlowBatches(flow_file, batch_size=FLOW_IMPORT_BATCH_SIZE, start=0, end=None):
+    # Yield (lines, bytes_read) batches of at most batch_size lines so that
+    #   only a single batch is held in memory at a time.
+    #   start/end limit reading to the lines beginning in [start, end): both
+    #   must be line boundaries, see getStreamFlowByteRanges.
+    with open(flow_file, 'rb') as f:
+        f.seek(start)
+        position = start
+        batch = []
+        for line in f:
+            if end != None and position >= end:
+                break
+            position += len(line)
+            batch.append(line.decode())
+            if len(batch) >= batch_size:
+                yield (batch, position)
+                batch = []
+        if batch:
+            yield (batch, position)
+
+def getStreamFlowByteRanges(flow_file, shard_count):
+    # Split a flow file into roughly equal, line-aligned [start, end) byte ranges
+    file_size = os.path.getsize(flow_file)
+    boundaries = [0]
+    with open(flow_file, 'rb') as f:
+        for shard in range(1, shard_count):
+            f.seek(max(boundaries[-1], int(file_size*shard/shard_count)))
+            # move forward to the start of the next full line
+            f.readline()
+            boundaries.append(min(f.tell(), file_size))
+    boundaries.append(file_size)
+    return [(start, end) for (start, end) in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+def getStreamFlowBlockShards(index, shard_count, warmup_blocks, first_block=0, last_block=None):
+    # Split the index's blocks [first_block, last_block) into timestep-aligned
+    #   (warm_first, first, last) shards, where blocks [warm_first, first) are
+    #   only read to fill rolling windows.
+    if last_block == None:
+        last_block = len(index['block_offsets']) - 1
+    block_count = last_block - first_block
+    shards = []
+    for shard in range(shard_count):
+        first = first_block + int(block_count*shard/shard_count)
+        last = first_block + int(block_count*(shard+1)/shard_count)
+        if last > first:
+            shards.append((max(0, first - warmup_blocks), first, last))
+    return shards
+
+def importStreamFlowRange(flow_file, start, end, segment_ids, targets):
+    # Worker process entry point: loads one byte range of a flow file over the
+    #   worker's own database connection and returns the number of rows written.
+    try:
+        with transaction.atomic():
+            with StreamFlowCopyLoader() as loader:
+                for (inlines, bytes_read) in iterStreamFlowBatches(flow_file, start=start, end=end):
+                    importBasinLines(inlines, segment_ids, targets, loader)
+    finally:
+        connection.close()
+    return loader.row_count
+
+def importStreamFlowBlocks(flow_file, index, warm_first, first, last, indexed_segment_ids, segment_ids, targets, all_metrics=False):
+    # Worker process entry point for indexed files: loads timestep blocks
+    #   [first, last), reading only the rows of indexed_segment_ids (all when
+    #   None), after replaying blocks [warm_first, first) into the rolling metrics.
+    rolling_metrics = {} if all_metrics else None
+    timestamps = index['timestamps']
+    try:
+        if all_metrics and warm_first < first:
+            warm_lines = flow_index.read_indexed_lines(flow_file, index, indexed_segment_ids, str(timestamps[warm_first]), str(timestamps[first-1]))
+            importBasinLines(warm_lines, segment_ids, [], None, rolling_metrics)
+        with transaction.atomic():
+            with StreamFlowCopyLoader() as loader:
+                for (inlines, bytes_read) in flow_index.iter_indexed_batches(flow_file, index, indexed_segment_ids, str(timestamps[first]), str(timestamps[last-1]), batch_size=FLOW_IMPORT_BATCH_SIZE):
+                    importBasinLines(inlines, segment_ids, targets, loader, rolling_metrics)
+    finally:
+        connection.close()
+    return loader.row_count
+
+def importStreamFlowParallel(flow_file, segment_ids, targets, workers, status_log=None, all_metrics=False, index=None, indexed_segment_ids=None, first_block=0, last_block=None):
+    # Fan the file out across a process pool. Tokenizing is the bottleneck,
+    #   so each worker parses and COPYs its own share. Every line lands in
+    #   exactly one share, so the rows written match the serial import.
+    #   With an index (always built for all_metrics, whose rolling windows
+    #   need whole timesteps and some history) the shares are runs of blocks
+    #   within [first_block, last_block), and workers read only the rows of
+    #   indexed_segment_ids; otherwise they are line-aligned byte ranges.
+    if index is None and all_metrics:
+        index = flow_index.get_stream_flow_index(flow_file)
+    if index is not None:
+        warmup_blocks = get_max_window_length()+1 if all_metrics else 0
+        shards = getStreamFlowBlockShards(index, workers, warmup_blocks, first_block, last_block)
+        tasks = [(importStreamFlowBlocks, (flow_file, index, warm_first, first, last, indexed_segment_ids, segment_ids, targets, all_metrics)) for (warm_first, first, last) in shards]
+    else:
+        tasks = [(importStreamFlowRange, (flow_file, start, end, segment_ids, targets)) for (start, end) in getStreamFlowByteRanges(flow_file, workers)]
+    # forked children must not share the parent's database socket
+    connections.close_all()
+    row_count = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = [executor.submit(target, *args) for (target, args) in tasks]
+        for (shard_number, future) in enumerate(as_completed(futures)):
+            row_count += future.result()
+            progress = int(((shard_number+1)/len(futures))*100)
+            print('Imported shard %d of %d at %s' % (shard_number+1, len(futures), str(datetime.now())))
+            if status_log:
+                with open(status_log, "w+") as f:
+                    f.write(str(progress))
+    return row_count
+
+def purgeStreamFlowReadings(start_time, end_time, segment_ids, scenario, is_baseline):
+    if scenario:
+        old_records = StreamFlowReading.objects.filter(time__gte=start_time, time__lte=end_time, segment_id__in=segment_ids, treatment=scenario)
+        print('purging {} obsolete records...'.format(old_records.count()))
+        old_records.delete()
+    if is_baseline: # if not scenario or scenario.prescription_treatment_selection == 'notr':
+        StreamFlowReading.objects.filter(time__gte=start_time, time__lte=end_time, segment_id__in=segment_ids, is_baseline=True, treatment=None).delete()
 
 # RDH 2021-09-03
 # Prior to using raw SQL for bulk inserts, 'atomic'' saved a lot of time.
 # However, it doesn't seem much faster now we have bulk inserts, and not
 # dealing with locking the table seems a good strategy.
-# @transaction.atomic
-def readStreamFlowData(flow_file, segment_ids=None, scenario=None, is_baseline=True):
+# COPY loads stream straight into the table, so a run's purge and load are
+# now wrapped in a single transaction: readers never see a half-imported run.
+def readStreamFlowData(flow_file, segment_ids=None, scenario=None, is_baseline=True, workers=IMPORT_WORKERS, start=None, end=None, all_metrics=IMPORT_ALL_FLOW_METRICS, loader=None):
+    # start/end (Stream.Flow timestamps or datetimes) re-import only that time
+    #   window. Windowed imports, and imports of a segment subset from a file
+    #   that already has a side-car index, read only the rows they need.
+    # all_metrics computes and stores every FLOW_METRICS series in the same pass.
+    # loader: load through the caller's StreamFlowCopyLoader, inside the
+    #   caller's transaction, rather than a new one (see readStreamFlowYears)
     flow_file_dir = os.path.split(flow_file)[0]
     status_log = os.path.join(flow_file_dir, 'dhsvm_status.log')
     # readings_per_day = 24/TIMESTEP
     tz = get_current_timezone()
 
-
     print("Reading in flow data...")
-    with open(flow_file, 'r') as f:
-        inlines=f.readlines()
-
-    segment_ids = check_stream_segment_ids(inlines, segment_ids)
+    if segment_ids == None:
+        # every segment in the file: the index lists them, otherwise read the
+        #   first timestep block
+        index = flow_index.get_stream_flow_index(flow_file, build=start != None or end != None)
+        if index != None:
+            segment_ids = flow_index.get_segment_ids(index)
+        else:
+            with open(flow_file, 'r') as f:
+                segment_ids = check_stream_segment_ids(f, segment_ids)
+        indexed_segment_ids = None
+    else:
+        segment_ids = check_stream_segment_ids([], segment_ids)
+        index = flow_index.get_stream_flow_index(flow_file, build=start != None or end != None)
+        indexed_segment_ids = segment_ids
+
+    if index != None:
+        (first_block, last_block) = flow_index.get_block_range(index, start, end)
+        if first_block >= last_block:
+            print('No flow data found between {} and {}'.format(start, end))
+            return
+        start_timestamp = str(index['timestamps'][first_block])
+        end_timestamp = str(index['timestamps'][last_block-1])
+    else:
+        (first_line, last_line) = getFlowFileEndLines(flow_file)
+        start_timestamp = first_line.split()[0]
+        end_timestamp = last_line.split()[0]
+    start_time = localizeFlowTimestamp(start_timestamp, tz)
+    end_time = localizeFlowTimestamp(end_timestamp, tz)
+
+    file_size = os.path.getsize(flow_file)
+    segment_id_set = set(segment_ids)
+    targets = getImportTargets(scenario, is_baseline)
+
+    if index != None:
+        batches = flow_index.iter_indexed_batches(flow_file, index, indexed_segment_ids, start, end, batch_size=FLOW_IMPORT_BATCH_SIZE)
+    else:
+        batches = iterStreamFlowBatches(flow_file)
+
+    rolling_metrics = {} if all_metrics else None
+    if rolling_metrics != None and index != None and first_block > 0:
+        # fill the rolling windows from the timesteps before a re-import window
+        warm_start = str(index['timestamps'][max(0, first_block-get_max_window_length()-1)])
+        warm_end = str(index['timestamps'][first_block-1])
+        warm_lines = flow_index.read_indexed_lines(flow_file, index, indexed_segment_ids, warm_start, warm_end)
+        importBasinLines(warm_lines, segment_id_set, [], None, rolling_metrics)
+
+    if loader != None:
+        # buffered rows from earlier files go in before this file's purge
+        loader.flush()
+        purgeStreamFlowReadings(start_time, end_time, segment_ids, scenario, is_baseline)
+        print('Importing data records from {} ({} bytes)...'.format(flow_file, file_size))
+        row_count = loader.row_count
+        loadStreamFlowBatches(batches, file_size, status_log, segment_id_set, targets, loader, rolling_metrics)
+        print('Imported {} records'.format(loader.row_count - row_count))
+        return
+
+    if workers and workers > 1:
+        # Each worker commits its own range, so the purge has to be committed
+        #   before they start rather than sharing a transaction with the load.
+        with transaction.atomic():
+            purgeStreamFlowReadings(start_time, end_time, segment_ids, scenario, is_baseline)
+        print('Importing data records from {} ({} bytes) with {} workers...'.format(flow_file, file_size, workers))
+        if index is not None:
+            row_count = importStreamFlowParallel(flow_file, segment_id_set, targets, workers, status_log, all_metrics, index, indexed_segment_ids, first_block, last_block)
+        else:
+            row_count = importStreamFlowParallel(flow_file, segment_id_set, targets, workers, status_log, all_metrics)
+        print('Imported {} records'.format(row_count))
+        return
+
+    with transaction.atomic():
+        purgeStreamFlowReadings(start_time, end_time, segment_ids, scenario, is_baseline)
+
+        print('Importing data records from {} ({} bytes)...'.format(flow_file, file_size))
+        with StreamFlowCopyLoader() as loader:
+            loadStreamFlowBatches(batches, file_size, status_log, segment_id_set, targets, loader, rolling_metrics)
+        print('Imported {} records'.format(loader.row_count))
+
+def loadStreamFlowBatches(batches, file_size, status_log, segment_id_set, targets, loader, rolling_metrics=None):
+    batch_count = 1
+    for (inlines, bytes_read) in batches:
+        progress = int((bytes_read/file_size)*100) if file_size else 100
+        print('Reading batch %d (%d%%) at %s' % (batch_count, progress, str(datetime.now())))
+        with open(status_log, "w+") as f:
+            f.write(str(progress))
+
+        importBasinLines(inlines, segment_id_set, targets, loader, rolling_metrics)
+
+        batch_count += 1
+
+def followStreamFlowData(flow_file, process, start_time, end_time, segment_ids=None, scenario=None, is_baseline=True, poll_interval=FLOW_FOLLOW_POLL_SECONDS, all_metrics=IMPORT_ALL_FLOW_METRICS):
+    # Tail a Stream.Flow while DHSVM writes it, importing each timestep block as
+    #   soon as the next one starts, then flush the last block once 'process'
+    #   has exited. start_time/end_time bound the purge of obsolete records, as
+    #   the file's own range isn't known until the model finishes.
+    #   The purge and every block share one transaction, committed only if
+    #   DHSVM exits with status 0: a failed run leaves the previous readings.
+    flow_file_dir = os.path.split(flow_file)[0]
+    status_log = os.path.join(flow_file_dir, 'dhsvm_status.log')
+    tz = get_current_timezone()
+    targets = getImportTargets(scenario, is_baseline)
+    segment_id_set = None if segment_ids == None else set(check_stream_segment_ids([], segment_ids))
+    total_seconds = (end_time - start_time).total_seconds()
+    rolling_metrics = {} if all_metrics else None
+
+    partial_line = ''
+    pending_lines = []      # lines of the newest, possibly unfinished, timestep
+    pending_timestamp = None
+    position = 0
+    row_count = 0
+    finished = False
+
+    def importBlock(lines, loader):
+        nonlocal segment_id_set
+        if segment_id_set == None:
+            # first complete block lists every SAVE segment, ending at '"Totals"'
+            segment_id_set = set(getSegmentIdList(lines))
+            purgeStreamFlowReadings(start_time, end_time, segment_id_set, scenario, is_baseline)
+        block_start_count = loader.row_count
+        importBasinLines(lines, segment_id_set, targets, loader, rolling_metrics)
+        # COPY each block now (uncommitted), so the load keeps pace with the model
+        loader.flush()
+        return loader.row_count - block_start_count
+
+    with transaction.atomic():
+        if segment_id_set != None:
+            purgeStreamFlowReadings(start_time, end_time, segment_id_set, scenario, is_baseline)
+
+        print('Following %s...' % flow_file)
+        with StreamFlowCopyLoader() as loader:
+            while not finished:
+                # read everything after one last pass once the model has exited
+                finished = process.poll() != None
+                ready_lines = []
+                if os.path.isfile(flow_file):
+                    with open(flow_file, 'rb') as f:
+                        f.seek(position)
+                        data = f.read()
+                    position += len(data)
+                    lines = (partial_line + data.decode()).split('\n')
+                    partial_line = lines.pop()
+                    if finished and partial_line.strip():
+                        lines.append(partial_line)
+                        partial_line = ''
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        timestamp = line.split(None, 1)[0]
+                        if timestamp != pending_timestamp and pending_lines:
+                            ready_lines += pending_lines
+                            pending_lines = []
+                        pending_timestamp = timestamp
+                        pending_lines.append(line)
+                if finished:
+                    ready_lines += pending_lines
+                    pending_lines = []
+                if ready_lines:
+                    row_count += importBlock(ready_lines, loader)
+                    block_time = localizeFlowTimestamp(ready_lines[-1].split(None, 1)[0], tz)
+                    progress = int(((block_time - start_time).total_seconds()/total_seconds)*100) if total_seconds else 100
+                    with open(status_log, "w+") as f:
+                        f.write(str(max(0, min(progress, 100))))
+                if not finished:
+                    time.sleep(poll_interval)
+
+        if process.returncode != 0:
+            # undo the purge and the blocks loaded so far
+            transaction.set_rollback(True)
+            print('DHSVM exited with status %s: discarded %d followed records' % (process.returncode, row_count))
+            return 0
+
+    print('Imported {} records'.format(row_count))
+    return row_count
 
-    start_timestamp = inlines[0].split()[0]
-    start_time = tz.localize(datetime.strptime(start_timestamp, "%m.%d.%Y-%H:%M:%S"))
-    end_timestamp = inlines[-1].split()[0]
-    end_time = tz.localize(datetime.strptime(end_timestamp, "%m.%d.%Y-%H:%M:%S"))
+# ======================================
+# COMPARE TREATMENT TO BASELINE
+# ======================================
 
+def getStreamFlowSegmentResults(segment_ids, scenario=None, start_time=None, end_time=None, metric_keys=None):
+    # Absolute flow for the baseline (scenario None) or a treatment's readings,
+    #   pulled in one query and expanded to the requested FLOW_METRICS in
+    #   memory, shaped like dhsvm_harness.metrics.get_segment_results.
+    #   Rolling windows begin at start_time.
     if scenario:
-        old_records = StreamFlowReading.objects.filter(time__gte=start_time, time__lte=end_time, segment_id__in=segment_ids, treatment=scenario)
-        print('purging {} obsolete records...'.format(old_records.count()))
-        old_records.delete()
-    if is_baseline: # if not scenario or scenario.prescription_treatment_selection == 'notr':
-        StreamFlowReading.objects.filter(time__gte=start_time, time__lte=end_time, segment_id__in=segment_ids, is_baseline=True, treatment=None).delete()
-
-    inline_count = len(inlines)
-    print('Importing {} data records...'.format(inline_count))
-    if inline_count < 10000:
-        if scenario:
-            importBasinLines(inlines, segment_ids, scenario, is_baseline)
-        if is_baseline: # if not scenario or scenario.prescription_treatment_selection == 'notr':
-            importBasinLines(inlines, segment_ids, None, True)
-
+        readings = StreamFlowReading.objects.filter(treatment=scenario)
     else:
-        # release memory
-        inlines = []
-        # create split dir
-        parent_dir = os.path.dirname(flow_file)
-        split_dir = os.path.join(parent_dir, 'flow_split_%s' % datetime.now().timestamp())
-        if os.path.isdir(split_dir):
-            shutil.rmtree(split_dir)
-        os.mkdir(split_dir)
-        os.system('split -l 10000 %s %s/' % (flow_file, split_dir))
-        filecount = 1
-        split_files = os.listdir(split_dir)
-        for filename in split_files:
-            file_slice = os.path.join(split_dir, filename)
-            print('Reading %d (of %d) "%s" at %s' % (filecount, len(split_files), file_slice, str(datetime.now())))
-            with open(status_log, "w+") as f:
-                progress = int((filecount/len(split_files))*100)
-                f.write(str(progress))
-            with open(file_slice, 'r') as f:
-                inlines=f.readlines()
-
-            if scenario:
-                importBasinLines(inlines, segment_ids, scenario, is_baseline)
-            if is_baseline: # not scenario or scenario.prescription_treatment_selection == 'notr':
-                importBasinLines(inlines, segment_ids, None, True)
-
-            filecount +=1
-
-        shutil.rmtree(split_dir)
+        readings = StreamFlowReading.objects.filter(is_baseline=True, treatment=None)
+    readings = readings.filter(segment_id__in=segment_ids, metric=ABSOLUTE_FLOW_METRIC)
+    if start_time:
+        readings = readings.filter(time__gte=start_time)
+    if end_time:
+        readings = readings.filter(time__lte=end_time)
+
+    timestamps = {}
+    values = {}
+    for (segment_id, timestamp, value) in readings.order_by('segment_id', 'time').values_list('segment_id', 'timestamp', 'value').iterator():
+        if not segment_id in values:
+            timestamps[segment_id] = []
+            values[segment_id] = []
+        timestamps[segment_id].append(timestamp)
+        values[segment_id].append(value)
+
+    segment_results = OrderedDict()
+    for segment_id in sorted(values.keys()):
+        flow = numpy.array(values[segment_id], dtype=numpy.float64)
+        segment_results[segment_id] = (timestamps[segment_id], compute_flow_metrics(flow, metric_keys))
+    return segment_results
+
+def getStreamFlowComparison(scenario, segment_ids, start_time=None, end_time=None, metric_keys=None):
+    # Treatment vs baseline for every requested FLOW_METRICS entry (all when
+    #   None) of each segment: two queries, then a vectorized timestamp join.
+    #   See dhsvm_harness.metrics.compare_segment_results for the result shape.
+    segment_ids = check_stream_segment_ids([], segment_ids)
+    baseline_results = getStreamFlowSegmentResults(segment_ids, None, start_time, end_time, metric_keys)
+    treatment_results = getStreamFlowSegmentResults(segment_ids, scenario, start_time, end_time, metric_keys)
+    return compare_segment_results(baseline_results, treatment_results, metric_keys)
 
 # ======================================
 # CREATE TREATMENT SCENARIO RUN DIR
 # ======================================
 
-def getRunDir(treatment_scenario, ts_superbasin_dict, weather_year=ucsrb_settings.NORMAL_YEAR_LABEL):
-
-    # Runs directory
-    try:
-        if not os.path.isdir(RUNS_DIR):
-            os.mkdir(RUNS_DIR)
-            command = "chgrp www-data %s" % RUNS_DIR
-
-    except OSError:
-        print("Runs dir not found. Add RUNS_DIR to settings")
-
+def getRunScenarioId(treatment_scenario):
     # Create a dir for treatment scenario run using id
     if hasattr(treatment_scenario, 'id'):
-        treatment_scenario_id = treatment_scenario.id
-    else:
-        treatment_scenario_id = 'baseline_{}'.format(treatment_scenario)
-    ts_run_dir_name = 'run_{}_{}'.format(str(treatment_scenario_id), weather_year)
-    ts_run_dir = os.path.join(RUNS_DIR, ts_run_dir_name)
+        return str(treatment_scenario.id)
+    return 'baseline_{}'.format(treatment_scenario)
 
-    if os.path.isdir(ts_run_dir):
-        shutil.rmtree(ts_run_dir)
+def getRunDir(treatment_scenario, ts_superbasin_dict, weather_year=ucsrb_settings.NORMAL_YEAR_LABEL):
 
-    os.mkdir(ts_run_dir)
-    os.mkdir("%s/ts_inputs" % ts_run_dir)
+    # Runs directory
+    try:
+        # Replaces any earlier run of this scenario and year; other finished
+        #   runs are kept until the RUNS_MAX_BYTES budget evicts them
+        ts_run_dir = scratch.create_run_dir(getRunScenarioId(treatment_scenario), weather_year)
+    except OSError as e:
+        print("Unable to create run dir under %s: %s. Add RUNS_DIR to settings" % (RUNS_DIR, e))
+        raise
 
     # --------------------------------------
     # Create sym links for met_data, shadows
@@ -225,13 +603,26 @@ def getRunDir(treatment_scenario, ts_superbasin_dict, weather_year=ucsrb_setting
 
     # os.system("ln -s %s/shadows %s/inputs/shadows" % (ts_superbasin_dict['basin_dir'], ts_run_dir))
 
-    # Create output dir
-    ts_run_output_dir = os.path.join(ts_run_dir, "output")
-
-    os.mkdir(ts_run_output_dir)
+    # Output dir: created by scratch.create_run_dir (linked from RUN_OUTPUTS_DIR when set)
 
     return ts_run_dir
 
+def getKeptRunFlowFile(treatment_scenario, weather_year=ucsrb_settings.NORMAL_YEAR_LABEL):
+    # Stream.Flow of a kept run of this scenario (or baseline basin code) and year, or None
+    return scratch.get_run_flow_file(getRunScenarioId(treatment_scenario), weather_year)
+
+def reimportRunStreamFlow(treatment_scenario, weather_year=ucsrb_settings.NORMAL_YEAR_LABEL, is_baseline=None):
+    # Re-import a kept run's Stream.Flow (every SAVE segment in it) without
+    #   re-running DHSVM. Returns False when no kept run has a Stream.Flow.
+    flow_file = getKeptRunFlowFile(treatment_scenario, weather_year)
+    if flow_file == None:
+        return False
+    scenario = treatment_scenario if hasattr(treatment_scenario, 'id') else None
+    if is_baseline == None:
+        is_baseline = scenario == None
+    readStreamFlowData(flow_file, scenario=scenario, is_baseline=is_baseline)
+    return True
+
 
 # ======================================
 # TREATMENT SCENARIO RUN SUPER BASIN
@@ -323,11 +714,155 @@ def dissolveTreatmentGeometries(treatment_areas):
             pass
     return None
 
+def getTreatmentVpuIds(treatment_areas):
+    # Treatments are built from whole VegPlanningUnits: the ids of every VPU
+    #   the treatment areas touch, without dissolving the VPU geometries.
+    ta_geom_union = treatment_areas.aggregate(Union('geometry'))
+    if not ta_geom_union or not ta_geom_union['geometry__union']:
+        return []
+    vpus = VegPlanningUnit.objects.filter(geometry__intersects=ta_geom_union['geometry__union'])
+    return list(vpus.values_list('pk', flat=True))
+
+def getTreatmentVpuSets(treatment_scenario):
+    # {rx_id: sorted VegPlanningUnit ids} for each prescription in the scenario
+    rx_vpu_ids = {}
+    if hasattr(treatment_scenario, 'id'):   # otherwise this is a baseline run
+        for rx_def in ucsrb_settings.PRESCRIPTION_TREATMENT_CHOICES:
+            rx_id = rx_def[0]
+            queryset = treatment_scenario.treatmentarea_set.filter(prescription_treatment_selection=rx_id)
+            if queryset.count() > 0:
+                rx_vpu_ids[rx_id] = sorted(getTreatmentVpuIds(queryset))
+    return rx_vpu_ids
+
+# ======================================
+# VPU ID RASTERS
+# ======================================
+
+def getVpuRasterPath(ts_superbasin_dir, ts_superbasin_code):
+    return "%s/inputs/veg_files/%s_vpu_ids.tif" % (ts_superbasin_dir, ts_superbasin_code)
+
+def buildVpuRaster(superbasin_code):
+    # Rasterize every VegPlanningUnit's id onto the superbasin's veg grid (the
+    #   *_notr.tif), so treated veg layers can be selected by id instead of by
+    #   geometry. Cells are assigned by pixel center, as rasterio.mask does.
+    #   Run offline (manage.py build_vpu_rasters) whenever VPUs or grids change.
+    superbasin_dir = SUPERBASINS[superbasin_code]['inputs']
+    vpu_raster_file = getVpuRasterPath(superbasin_dir, superbasin_code)
+    with rasterio.Env():
+        with rasterio.open("%s/inputs/veg_files/%s_notr.tif" % (superbasin_dir, superbasin_code), "r") as baseline_veg_file:
+            profile = baseline_veg_file.profile
+            out_shape = baseline_veg_file.shape
+            transform = baseline_veg_file.transform
+        vpu_shapes = []
+        for vpu in VegPlanningUnit.objects.all().iterator():
+            vpu_shapes.append((reprojectShape(shape(json.loads(vpu.geometry.json))), vpu.pk))
+        vpu_grid = rasterio.features.rasterize(
+            vpu_shapes,
+            out_shape=out_shape,
+            transform=transform,
+            fill=0,
+            dtype=rasterio.int32
+        )
+        profile.update(
+            driver='GTiff',
+            dtype=rasterio.int32,
+            count=1,
+            nodata=0,
+            compress='lzw'
+        )
+        with rasterio.open(vpu_raster_file, 'w', **profile) as dst:
+            dst.write(vpu_grid, 1)
+    return vpu_raster_file
+
+# ======================================
+# REPROJECTION
+# ======================================
+
+@lru_cache(maxsize=None)
+def getTransformer(source_projection, target_projection):
+    # Building a Transformer parses both CRS definitions (the Albers WKT
+    #   included), so keep one per projection pair for the life of the process.
+    #   always_xy keeps (easting, northing) order, as pyproj.Proj did.
+    return pyproj.Transformer.from_crs(source_projection, target_projection, always_xy=True)
+
+def reprojectCoordinates(coords, source_projection=GEOMETRY_PROJECTION, target_projection=PROJECTION):
+    # (n, 2) array of x, y -> (n, 2) array, projected in a single call
+    (x, y) = getTransformer(source_projection, target_projection).transform(coords[:,0], coords[:,1])
+    return numpy.column_stack((x, y))
+
+def reprojectShape(feature_shape, source_projection=GEOMETRY_PROJECTION, target_projection=PROJECTION):
+    if hasattr(shapely, 'transform'):
+        # shapely 2: every vertex of the geometry goes through in one array
+        return shapely.transform(feature_shape, partial(reprojectCoordinates, source_projection=source_projection, target_projection=target_projection))
+    # shapely 1.x: one vectorized call per coordinate sequence (ring)
+    return shapely.ops.transform(getTransformer(source_projection, target_projection).transform, feature_shape)
+
 # ======================================
 # CREATE TREATED VEG LAYER
 # ======================================
 
-def setVegLayers(treatment_scenario, ts_superbasin_dict, ts_run_dir):
+def overlayVegLayer(composite, treated, veg_file, window, selected):
+    # Within 'window', copy the rx veg values into the composite where
+    #   'selected' is True, the rx value is neither 0 nor the layer's nodata
+    #   value and no earlier rx has already claimed the cell.
+    (rows, cols) = window.toslices()
+    rx_values = veg_file.read(1, window=window)
+    overlay = selected & (rx_values != 0) & ~treated[rows, cols]
+    if veg_file.nodata is not None:
+        overlay &= rx_values != veg_file.nodata
+    composite[rows, cols] = numpy.where(overlay, rx_values, composite[rows, cols])
+    treated[rows, cols] |= overlay
+
+def checkVegLayerGrid(veg_file, baseline_veg_file):
+    if veg_file.shape != baseline_veg_file.shape or not veg_file.transform.almost_equals(baseline_veg_file.transform):
+        raise ValueError("%s is not on the same grid as %s" % (veg_file.name, baseline_veg_file.name))
+
+def compositeVegLayers(baseline_veg_file, rx_layers):
+    # Read the baseline veg layer once and overlay each (rx veg_file, shape)
+    #   in place. Only the window around each shape is read from its rx layer.
+    #   As with rasterio.merge's default 'first' method, the first rx to cover
+    #   a cell with a value other than 0 or nodata wins, and those never overwrite.
+    composite = baseline_veg_file.read(1).astype(rasterio.uint8)
+    treated = numpy.zeros(composite.shape, dtype=bool)
+    extent = Window(0, 0, baseline_veg_file.width, baseline_veg_file.height)
+    for (veg_file, rx_shape) in rx_layers:
+        checkVegLayerGrid(veg_file, baseline_veg_file)
+        geometries = list(rx_shape.geoms) if hasattr(rx_shape, 'geoms') else [rx_shape]
+        try:
+            window = rasterio.features.geometry_window(veg_file, geometries).intersection(extent)
+        except WindowError:
+            # treatment lies outside the basin grid
+            continue
+        inside = rasterio.features.geometry_mask(
+            geometries,
+            out_shape=(int(window.height), int(window.width)),
+            transform=veg_file.window_transform(window),
+            invert=True
+        )
+        overlayVegLayer(composite, treated, veg_file, window, inside)
+    return composite
+
+def compositeVegLayersFromVpuGrid(baseline_veg_file, vpu_grid, rx_layers):
+    # compositeVegLayers for (rx veg_file, VegPlanningUnit ids) pairs: each
+    #   rx's cells are looked up in the precomputed VPU id grid (buildVpuRaster)
+    #   rather than rasterized from geometry.
+    composite = baseline_veg_file.read(1).astype(rasterio.uint8)
+    treated = numpy.zeros(composite.shape, dtype=bool)
+    if vpu_grid.shape != composite.shape:
+        raise ValueError("VPU id grid does not match %s" % baseline_veg_file.name)
+    for (veg_file, vpu_ids) in rx_layers:
+        checkVegLayerGrid(veg_file, baseline_veg_file)
+        selected = numpy.isin(vpu_grid, vpu_ids)
+        (rows, cols) = numpy.nonzero(selected)
+        if rows.size == 0:
+            continue
+        window = Window(cols.min(), rows.min(), cols.max()-cols.min()+1, rows.max()-rows.min()+1)
+        (window_rows, window_cols) = window.toslices()
+        overlayVegLayer(composite, treated, veg_file, window, selected[window_rows, window_cols])
+    return composite
+
+def setVegLayers(treatment_scenario, ts_superbasin_dict, ts_run_dir, rx_vpu_ids=None):
+    # rx_vpu_ids: {rx_id: VegPlanningUnit ids} when already known (getTreatmentVpuSets)
 
     ts_superbasin_dir = ts_superbasin_dict['basin_dir']
     ts_superbasin_code = ts_superbasin_dict['basin_code']
@@ -335,14 +870,13 @@ def setVegLayers(treatment_scenario, ts_superbasin_dict, ts_run_dir):
     # inputs for TreatmentScenario to feed into DHSVM
     ts_run_dir_inputs = os.path.join('%s/ts_inputs' % ts_run_dir)
 
+    # Treatments are selected from the superbasin's VPU id raster when it has
+    #   been built, falling back to dissolving and masking VPU geometries.
+    vpu_raster_file = getVpuRasterPath(ts_superbasin_dir, ts_superbasin_code)
+    use_vpu_grid = os.path.isfile(vpu_raster_file)
+
     # Start a rasterio environment
     with rasterio.Env():
-        # Projection assigned for later use
-        # TODO: add to settings
-        PROJECTION = 'PROJCS["NAD_1983_USFS_R6_Albers",GEOGCS["GCS_North_American_1983",DATUM["D_North_American_1983",SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],PROJECTION["Albers"],PARAMETER["False_Easting",600000.0],PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",-120.0],PARAMETER["Standard_Parallel_1",43.0],PARAMETER["Standard_Parallel_2",48.0],PARAMETER["Latitude_Of_Origin",34.0],UNIT["Meter",1.0]]'
-        # Transform and reproject TS shape/feature to match UCSRB data bin files
-        tfm = partial(pyproj.transform, pyproj.Proj("epsg:3857"), pyproj.Proj(PROJECTION))
-
         # OPEN:
         # Baseline Veg Layer
         baseline_veg_file = rasterio.open("%s/inputs/veg_files/%s_notr.tif" % (ts_superbasin_dir, ts_superbasin_code), "r")
@@ -358,27 +892,25 @@ def setVegLayers(treatment_scenario, ts_superbasin_dict, ts_run_dir):
 
                     rx_dict[rx_id] = {
                     'name': rx_def[1],
-                    # convert each group of rx features into single multipolygon
-                    'geometry': dissolveTreatmentGeometries(queryset),
                     # Treatment Veg Layer
                     'veg_file': rasterio.open("%s/inputs/veg_files/%s_%s.tif" % (ts_superbasin_dir, ts_superbasin_code, rx_id), "r"),
                     }
+                    if use_vpu_grid:
+                        if rx_vpu_ids != None and rx_id in rx_vpu_ids:
+                            rx_dict[rx_id]['vpu_ids'] = rx_vpu_ids[rx_id]
+                        else:
+                            rx_dict[rx_id]['vpu_ids'] = getTreatmentVpuIds(queryset)
+                        continue
+                    # convert each group of rx features into single multipolygon
+                    rx_dict[rx_id]['geometry'] = dissolveTreatmentGeometries(queryset)
                     if rx_dict[rx_id]['geometry']:
                         feature = json.loads(rx_dict[rx_id]['geometry'].json)
                         feature_shape = shape(feature)
-                        rx_dict[rx_id]['shape'] = shapely.ops.transform(tfm, feature_shape)
+                        # Transform and reproject TS shape/feature to match UCSRB data bin files
+                        rx_dict[rx_id]['shape'] = reprojectShape(feature_shape)
                     else:
                         rx_dict[rx_id]['shape'] = None
 
-        profile = baseline_veg_file.profile
-
-        profile.update(
-            dtype=rasterio.uint8,
-            driver='AAIGrid'
-        )
-
-        datasets = []
-
         # TERMINOLOGY:
         # Mask -
         #   Noun: a shape/feature area of interest within a "larger area"
@@ -388,37 +920,29 @@ def setVegLayers(treatment_scenario, ts_superbasin_dict, ts_run_dir):
         #       - Normally this would be called the 'clipped result'
         #   Verb: To remove unwanted data (outside of n. mask), leaving only the data we are interested in.
 
-        # loop through rxs, clipping each related veg layer to be added to the base
-        for rx_id in rx_dict.keys():
-            # skip notr (it will be the base layer)
-            if rx_dict[rx_id]['shape'] and not rx_id == 'notr' :
-                tmpfile = tempfile.NamedTemporaryFile()
-
-                # RDH 2021-09-17: `with rasterio.open(tmpfile,...) as foo` gives BuffDataset writer
-                # but `foo = rasterio.open(tmpfile,...)` gives _GeneratorContextManager
-                # handing the tmpfile name to rasterio fixes the issue.
-                dataset = rasterio.open(tmpfile.name, 'w+', **profile)
-                clipped_treatment = mask(rx_dict[rx_id]['veg_file'], rx_dict[rx_id]['shape'], nodata=0)
-                clipped_treatment_mask = clipped_treatment[0]
-
-                dataset.write(clipped_treatment_mask.astype(rasterio.uint8))
-                datasets.append(dataset)
-
-        datasets.append(baseline_veg_file)
-        merged_veg = merge(datasets, nodata=0, dtype="uint8")
-        merged_veg_layer = merged_veg[0]
-
-        for dataset in datasets:
-            dataset.close()
+        # overlay each rx's veg layer, clipped to its treatment shape, onto the base
+        #   (skip notr: it is the base layer)
+        rx_layers = []
+        if use_vpu_grid:
+            for rx_id in rx_dict.keys():
+                if rx_dict[rx_id]['vpu_ids'] and not rx_id == 'notr':
+                    rx_layers.append((rx_dict[rx_id]['veg_file'], rx_dict[rx_id]['vpu_ids']))
+            with rasterio.open(vpu_raster_file, "r") as vpu_file:
+                vpu_grid = vpu_file.read(1)
+            merged_veg_layer = compositeVegLayersFromVpuGrid(baseline_veg_file, vpu_grid, rx_layers)
+        else:
+            for rx_id in rx_dict.keys():
+                if rx_dict[rx_id]['shape'] and not rx_id == 'notr':
+                    rx_layers.append((rx_dict[rx_id]['veg_file'], rx_dict[rx_id]['shape']))
+            merged_veg_layer = compositeVegLayers(baseline_veg_file, rx_layers)
 
+        # written straight to DHSVM's binary layout: no AAIGrid or myconvert
         asc_file = "%s/ts_clipped_treatment_layer.asc" % ts_run_dir_inputs
-        with rasterio.open(asc_file, 'w', **profile) as dst:
-            dst.write(merged_veg_layer)
+        write_dhsvm_binary(merged_veg_layer, asc_file + '.bin', 'character')
 
         for rx_id in rx_dict.keys():
             rx_dict[rx_id]['veg_file'].close()
-        if not 'notr' in rx_dict.keys():
-            baseline_veg_file.close()
+        baseline_veg_file.close()
 
     return asc_file + '.bin'
 
@@ -595,25 +1119,29 @@ def createTargetStreamNetworkFile(ts_target_stream_basins, ts_run_dir, ts_superb
 # CREATE INPUT CONFIG FILE
 # ======================================
 
+def getInputTemplatePath(ts_superbasin_dict):
+    ts_superbasin_name = SUPERBASINS[ts_superbasin_dict['basin_code']]['name'].lower()
+    # Get superbasin input config file
+    # ts_superbasin_input_template_name = 'INPUT.UCSRB.%s.bck' % ts_superbasin_name
+    ts_superbasin_input_template_name = 'INPUT.UCSRB.%s' % ts_superbasin_name
+    return os.path.join(ts_superbasin_dict['basin_dir'], ts_superbasin_input_template_name)
+
 def createInputConfig(ts_target_basin, ts_superbasin_dict, ts_run_dir, ts_veg_layer_file, ts_network_file, model_year=ucsrb_settings.NORMAL_YEAR_LABEL):
 
     # SUPERBASINS = settings.SUPERBASINS
     ts_superbasin_code = ts_superbasin_dict['basin_code']
-    ts_superbasin_name = SUPERBASINS[ts_superbasin_code]['name'].lower()
     ts_superbasin_dir = SUPERBASINS[ts_superbasin_code]['inputs']
 
-    # Get superbasin input config file
-    # ts_superbasin_input_template_name = 'INPUT.UCSRB.%s.bck' % ts_superbasin_name
-    ts_superbasin_input_template_name = 'INPUT.UCSRB.%s' % ts_superbasin_name
-    ts_superbasin_input_template = os.path.join(ts_superbasin_dict['basin_dir'], ts_superbasin_input_template_name)
+    ts_superbasin_input_template = getInputTemplatePath(ts_superbasin_dict)
 
     # Location for new run input config file
     ts_run_input_file = os.path.join(ts_run_dir, 'INPUT.UCSRB.run')
 
     # mask_file = os.path.join(ts_superbasin_dict['basin_dir'], 'masks', "%s.asc.bin" % ts_target_basin.unit_id)
     if MASK_RUNS:
-        createMaskFile(ts_superbasin_code, ts_superbasin_dir, ts_target_basin, ts_run_dir)
         mask_file = os.path.join(ts_run_dir, 'ts_inputs', "mask.asc.bin")
+        if not os.path.isfile(mask_file):   # else linked from the inputs cache
+            createMaskFile(ts_superbasin_code, ts_superbasin_dir, ts_target_basin, ts_run_dir)
     else:
         mask_file = "%s/masks/%s_mask.asc.bin" % (ts_superbasin_dir, ts_superbasin_code)
 
@@ -657,9 +1185,7 @@ def createMaskFile(basin_id, ts_superbasin_dir, focus_area, ts_run_dir):
 
 
     # Transform and reproject TS shape/feature to match UCSRB data bin files
-    PROJECTION = 'PROJCS["NAD_1983_USFS_R6_Albers",GEOGCS["GCS_North_American_1983",DATUM["D_North_American_1983",SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],PROJECTION["Albers"],PARAMETER["False_Easting",600000.0],PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",-120.0],PARAMETER["Standard_Parallel_1",43.0],PARAMETER["Standard_Parallel_2",48.0],PARAMETER["Latitude_Of_Origin",34.0],UNIT["Meter",1.0]]'
-    tfm = partial(pyproj.transform, pyproj.Proj("epsg:3857"), pyproj.Proj(PROJECTION))
-    ts_shape = shapely.ops.transform(tfm, feature_shape)
+    ts_shape = reprojectShape(feature_shape)
     # get superbasin bounds/header values
     # rasterize the geometry (to ascii)
     #   Read in full basin mask raster
@@ -670,88 +1196,347 @@ def createMaskFile(basin_id, ts_superbasin_dir, focus_area, ts_run_dir):
     clipped_treatment = mask(basin_mask_file, ts_shape, nodata=0)
     clipped_treatment_mask = clipped_treatment[0]
 
-    profile = basin_mask_file.profile
     # convert to asc.bin
-    # save file to filename
-    # with tempfile.NamedTemporaryFile() as tmpfile:
-    profile.update(
-        dtype=rasterio.uint8,
-        driver='AAIGrid'
-    )
-
-    with rasterio.open("%s/mask.asc" % ts_run_dir_inputs, 'w', **profile) as dst:
-        # dst.write(merged_veg_layer)
-        dst.write(clipped_treatment_mask)
+    write_dhsvm_binary(clipped_treatment_mask.astype(numpy.uint8), "%s/mask.asc.bin" % ts_run_dir_inputs, 'character')
 
     # basin_blank_file.close()
     basin_mask_file.close()
 
+# ======================================
+# RUN INPUTS CACHE
+# ======================================
+
+def getRunInputsKey(ts_superbasin_dict, rx_vpu_ids, segment_ids, ts_target_basin):
+    # Everything a run's ts_inputs are generated from. The weather year and
+    #   INPUT template only affect the INPUT file, which is rendered per run
+    #   (it names the run dir), so they are left out to share inputs between years.
+    ts_superbasin_dir = ts_superbasin_dict['basin_dir']
+    ts_superbasin_code = ts_superbasin_dict['basin_code']
+    source_files = [
+        "%s/inputs/veg_files/%s_notr.tif" % (ts_superbasin_dir, ts_superbasin_code),
+        getVpuRasterPath(ts_superbasin_dir, ts_superbasin_code),
+        os.path.join(ts_superbasin_dir, 'inputs', 'stream.network_clean.dat'),
+        os.path.join(ts_superbasin_dir, 'inputs', 'stream.network_all.dat'),
+    ]
+    for rx_id in sorted(rx_vpu_ids.keys()):
+        source_files.append("%s/inputs/veg_files/%s_%s.tif" % (ts_superbasin_dir, ts_superbasin_code, rx_id))
+    if MASK_RUNS:
+        source_files.append("%s/masks/%s_mask.tif" % (ts_superbasin_dir, ts_superbasin_code))
+    return input_cache.get_inputs_key({
+        'superbasin': ts_superbasin_code,
+        'rx_vpu_ids': rx_vpu_ids,
+        'save_segments': sorted(segment_ids) if segment_ids != None else 'all',
+        'mask': ts_target_basin.unit_id if MASK_RUNS and ts_target_basin else None,
+        'sources': [input_cache.get_file_signature(x) for x in source_files],
+    })
+
 # ======================================
 # CONFIGURE TREATMENT SCENARIO RUN
 # ======================================
 
-def runHarnessConfig(treatment_scenario, basin=None, weather_year=ucsrb_settings.NORMAL_YEAR_LABEL):
+def getHarnessRunInputs(treatment_scenario, basin=None, trace=None):
+    # The parts of a run's set-up that don't depend on the weather year, shared
+    #   by every year of a scenario (see prepareHarnessYearRuns)
+    # trace: a RunTrace recording each stage, see dhsvm_harness.instrumentation
     if treatment_scenario:
         # identify super dir to copy original files from
-        ts_superbasin_dict = getRunSuperBasinDir(treatment_scenario)        # 2 seconds
-
-        # TreatmentScenario run directory
-        ts_run_dir = getRunDir(treatment_scenario, ts_superbasin_dict, weather_year)      # 0 seconds
-
-        # Create run layer
-        ts_veg_layer_file = setVegLayers(treatment_scenario, ts_superbasin_dict, ts_run_dir)    # 2 min, 2 sec
+        with trace_stage(trace, 'getRunSuperBasinDir'):
+            ts_superbasin_dict = getRunSuperBasinDir(treatment_scenario)
 
         # Get LCD basin
-        ts_target_basin = getTargetBasin(treatment_scenario)                # 2 seconds
+        with trace_stage(trace, 'getTargetBasin'):
+            ts_target_basin = getTargetBasin(treatment_scenario)
+        veg_scenario = treatment_scenario
     elif basin:
         basin_code = ucsrb_settings.BASIN_RESET_LOOKUP[basin.lower()]['BASIN_ID']
         ts_superbasin_dict = {
             'basin_dir': SUPERBASINS[basin_code]['inputs'],
             'basin_code': basin_code
         }
-        ts_run_dir = getRunDir(basin_code, ts_superbasin_dict, weather_year=weather_year)
-        ts_veg_layer_file = setVegLayers(basin_code, ts_superbasin_dict, ts_run_dir)
-        ts_target_basin = getTargetBasin(basin)
+        with trace_stage(trace, 'getTargetBasin'):
+            ts_target_basin = getTargetBasin(basin)
+        veg_scenario = basin_code
 
     # Get target stream segments basins
     if ts_target_basin:
-        ts_target_stream_basins = getTargetStreamSegmentBasins(ts_target_basin)    # 0 seconds (???)
+        with trace_stage(trace, 'getTargetStreamSegmentBasins'):
+            ts_target_stream_basins = getTargetStreamSegmentBasins(ts_target_basin)
     else:
         ts_target_stream_basins = None
 
     if basin == None:
-        ts_network_file = createTargetStreamNetworkFile(ts_target_stream_basins, ts_run_dir, ts_superbasin_dict['basin_dir'])
         segment_ids = [x.unit_id for x in ts_target_stream_basins]
+        network_basins = ts_target_stream_basins
     else:
-        ts_network_file = createTargetStreamNetworkFile(None, ts_run_dir, ts_superbasin_dict['basin_dir'])
         segment_ids = None
+        network_basins = None
 
+    with trace_stage(trace, 'getTreatmentVpuSets'):
+        rx_vpu_ids = getTreatmentVpuSets(veg_scenario)
+    return {
+        'superbasin': ts_superbasin_dict,
+        'target_basin': ts_target_basin,
+        'veg_scenario': veg_scenario,
+        'segment_ids': segment_ids,
+        'network_basins': network_basins,
+        'rx_vpu_ids': rx_vpu_ids,
+        'inputs_key': getRunInputsKey(ts_superbasin_dict, rx_vpu_ids, segment_ids, ts_target_basin),
+    }
 
-    # TODO: run for all three weather years: ['wet', 'normal', 'dry']
-    ts_run_input_file = createInputConfig(ts_target_basin, ts_superbasin_dict, ts_run_dir, ts_veg_layer_file, ts_network_file, model_year=weather_year)
+def prepareHarnessRun(treatment_scenario, basin=None, weather_year=ucsrb_settings.NORMAL_YEAR_LABEL, run_inputs=None, shared_inputs_dir=None, trace=None):
+    # Prepare stage: run dir, inputs and INPUT file for one model run. Returns
+    #   what the model and import stages need, as JSON-serializable values so
+    #   that queued runs (see dhsvm_harness.scheduler) can pass it between
+    #   processes.
+    # run_inputs: from getHarnessRunInputs; shared_inputs_dir: the ts_inputs of
+    #   another weather year of the same run, linked instead of regenerated
+    if run_inputs == None:
+        run_inputs = getHarnessRunInputs(treatment_scenario, basin, trace)
+    ts_superbasin_dict = run_inputs['superbasin']
+    ts_target_basin = run_inputs['target_basin']
+    segment_ids = run_inputs['segment_ids']
+    inputs_key = run_inputs['inputs_key']
+
+    # TreatmentScenario run directory
+    with trace_stage(trace, 'getRunDir'):
+        ts_run_dir = getRunDir(run_inputs['veg_scenario'], ts_superbasin_dict, weather_year)
 
-    # Convert all .asc to .asc.bin
-    binAsciis(ts_run_dir)
+    try:
+        # Unchanged scenarios (e.g. re-run after editing only metadata) link their
+        #   ts_inputs from the inputs cache rather than regenerating them
+        ts_run_dir_inputs = os.path.join(ts_run_dir, 'ts_inputs')
+        with trace_stage(trace, 'fetchInputs'):
+            if shared_inputs_dir:
+                cached_inputs = input_cache.link_inputs(shared_inputs_dir, ts_run_dir_inputs)
+                print('Using run inputs from %s' % shared_inputs_dir)
+            else:
+                cached_inputs = input_cache.fetch_inputs(inputs_key, ts_run_dir_inputs)
+                if cached_inputs != None:
+                    print('Using cached run inputs %s' % inputs_key)
+        if cached_inputs != None:
+            ts_veg_layer_file = os.path.join(ts_run_dir_inputs, 'ts_clipped_treatment_layer.asc.bin')
+            ts_network_file = os.path.join(ts_run_dir_inputs, 'stream.network.dat')
+        else:
+            # Create run layer
+            with trace_stage(trace, 'setVegLayers'):
+                ts_veg_layer_file = setVegLayers(run_inputs['veg_scenario'], ts_superbasin_dict, ts_run_dir, run_inputs['rx_vpu_ids'])
+            with trace_stage(trace, 'createTargetStreamNetworkFile'):
+                ts_network_file = createTargetStreamNetworkFile(run_inputs['network_basins'], ts_run_dir, ts_superbasin_dict['basin_dir'])
+
+        # One weather year per run dir: prepareHarnessYearRuns prepares several
+        with trace_stage(trace, 'createInputConfig'):
+            ts_run_input_file = createInputConfig(ts_target_basin, ts_superbasin_dict, ts_run_dir, ts_veg_layer_file, ts_network_file, model_year=weather_year)
+
+        # No binAsciis pass: the veg layer and mask are written as .asc.bin
+        #   directly and the stream network is a .dat, so there is no .asc to convert
+        if cached_inputs == None:
+            with trace_stage(trace, 'storeInputs'):
+                input_cache.store_inputs(inputs_key, ts_run_dir_inputs)
+
+        flow_file = os.path.join(ts_run_dir, 'output', 'Stream.Flow')
+        is_baseline = False if treatment_scenario else True
+
+        # A scenario with the same inputs, weather year dates and template has
+        #   already been modelled: its archived Stream.Flow is imported instead
+        #   of running DHSVM
+        model_year = ucsrb_settings.MODEL_YEARS[weather_year]
+        result_key = result_store.get_result_key(inputs_key, weather_year, getInputTemplatePath(ts_superbasin_dict), model_year['start'], model_year['end'])
+        archived_flow_file = result_store.fetch_result_flow(result_key)
+        if archived_flow_file:
+            print('Using archived model results %s' % result_key)
+
+        return {
+            'treatment_scenario_id': treatment_scenario.id if treatment_scenario else None,
+            'basin': basin,
+            'weather_year': weather_year,
+            'run_dir': ts_run_dir,
+            'input_file': ts_run_input_file,
+            'flow_file': flow_file,
+            'segment_ids': segment_ids,
+            'is_baseline': is_baseline,
+            'result_key': result_key,
+            'archived_flow_file': archived_flow_file,
+        }
+    except BaseException:
+        # a failed run is no longer active: leave it to scratch eviction
+        scratch.release_run(ts_run_dir)
+        raise
 
-    # Run DHSVM
+def getHarnessModelCommand(harness_run, num_cores=RUN_CORES):
     dhsvm_run_path = os.path.join(DHSVM_BUILD, 'DHSVM', 'sourcecode', 'DHSVM')
-    num_cores = RUN_CORES
-
-    command = "mpiexec -n %s %s %s" % (num_cores, dhsvm_run_path, ts_run_input_file)
-    print('Running command: %s' % command)
-
-    model_start_time = datetime.now()
-    os.system(command)
+    return ["mpiexec", "-n", str(num_cores), dhsvm_run_path, harness_run['input_file']]
+
+def startHarnessModel(harness_run, num_cores=RUN_CORES):
+    # Model stage: DHSVM runs in the background; the caller waits on the process
+    command = getHarnessModelCommand(harness_run, num_cores)
+    print('Running command: %s' % ' '.join(command))
+    return subprocess.Popen(command)
+
+def importHarnessResults(harness_run, treatment_scenario=None, returncode=0, trace=None):
+    # Import stage: read the run's (or the archived) Stream.Flow. The output of
+    #   a failed model run is partial, and importing it would first purge the
+    #   scenario's existing readings: it is skipped. Returns whether it imported.
+    if returncode != 0 and not harness_run['archived_flow_file']:
+        print('DHSVM exited with status %s: %s not imported' % (returncode, harness_run['flow_file']))
+        return False
+    flow_file = harness_run['archived_flow_file'] if harness_run['archived_flow_file'] else harness_run['flow_file']
+    with trace_stage(trace, 'readStreamFlowData'):
+        readStreamFlowData(flow_file, segment_ids=harness_run['segment_ids'], scenario=treatment_scenario, is_baseline=harness_run['is_baseline'])
+    return True
+
+def getRunTrace(treatment_scenario, basin=None, weather_year=None):
+    # A RunTrace named like the run dir (or for all years when weather_year is None)
+    if treatment_scenario:
+        scenario_id = treatment_scenario.id
+    else:
+        scenario_id = 'baseline_{}'.format(ucsrb_settings.BASIN_RESET_LOOKUP[basin.lower()]['BASIN_ID'])
+    run_name = scratch.get_run_dir_name(scenario_id, weather_year if weather_year else 'all')
+    return RunTrace(run_name, treatment_scenario_id=treatment_scenario.id if treatment_scenario else None, basin=basin, weather_year=weather_year)
+
+def archiveHarnessRun(harness_run, returncode=0):
+    if not harness_run['archived_flow_file']:
+        if returncode == 0:
+            result_store.store_result_flow(harness_run['result_key'], harness_run['flow_file'])
+        else:
+            print('DHSVM exited with status %s: results not archived' % returncode)
+
+def finishHarnessRun(harness_run, returncode=0):
+    archiveHarnessRun(harness_run, returncode)
+
+    # Keep the run dir for re-imports and debugging, within the scratch budget
+    scratch.release_run(harness_run['run_dir'])
+
+def stopHarnessModels(processes):
+    # DHSVM must not keep writing to a run dir that has been released
+    for process in processes:
+        if process != None and process.poll() == None:
+            process.kill()
+            process.wait()
+
+def writeRunTrace(trace):
+    # Save a run's trace and print its per-stage times
+    for stage in trace.stages:
+        print("%s: %.1f s wall, %.1f s cpu" % (stage['stage'], stage['wall_seconds'], stage['cpu_seconds'] + stage['children_cpu_seconds']))
+    trace_file = trace.write()
+    if trace_file:
+        print("run trace written to %s" % trace_file)
+    return trace_file
 
-    read_start_time = datetime.now()
-    flow_file = os.path.join(ts_run_dir, 'output', 'Stream.Flow')
-    is_baseline = False if treatment_scenario else True
-    readStreamFlowData(flow_file, segment_ids=segment_ids, scenario=treatment_scenario, is_baseline=is_baseline)
+def runHarnessConfig(treatment_scenario, basin=None, weather_year=ucsrb_settings.NORMAL_YEAR_LABEL):
+    # Every stage is recorded in a RunTrace, written even if the run fails
+    #   The run dir is released (left to scratch eviction) however the run ends.
+    trace = getRunTrace(treatment_scenario, basin, weather_year)
+    harness_run = None
+    process = None
+    try:
+        harness_run = prepareHarnessRun(treatment_scenario, basin, weather_year, trace=trace)
+
+        if harness_run['archived_flow_file']:
+            importHarnessResults(harness_run, treatment_scenario, trace=trace)
+            return
+
+        # Run DHSVM
+        process = startHarnessModel(harness_run)
+
+        if FLOW_FOLLOW_IMPORT:
+            # import overlaps the model run: only the final block is left
+            #   afterwards. A model failure rolls the whole import back.
+            with trace_stage(trace, 'model+followStreamFlowData'):
+                tz = get_current_timezone()
+                model_start = localizeFlowTimestamp(ucsrb_settings.MODEL_YEARS[weather_year]['start'].strftime("%m.%d.%Y-%H:%M:%S"), tz)
+                model_end = localizeFlowTimestamp(ucsrb_settings.MODEL_YEARS[weather_year]['end'].strftime("%m.%d.%Y-%H:%M:%S"), tz)
+                followStreamFlowData(harness_run['flow_file'], process, model_start, model_end, segment_ids=harness_run['segment_ids'], scenario=treatment_scenario, is_baseline=harness_run['is_baseline'])
+        else:
+            with trace_stage(trace, 'model'):
+                process.wait()
+            importHarnessResults(harness_run, treatment_scenario, process.returncode, trace=trace)
+        archiveHarnessRun(harness_run, process.returncode)
+    finally:
+        stopHarnessModels([process])
+        if harness_run != None:
+            scratch.release_run(harness_run['run_dir'])
+        writeRunTrace(trace)
 
-    # Remove run dir
-    shutil.rmtree(ts_run_dir)
+# ======================================
+# RUN ALL WEATHER YEARS
+# ======================================
 
-    finish_time = datetime.now()
-    print("model started at %d:%d:%d" % (model_start_time.hour, model_start_time.minute, model_start_time.second))
-    print("read started at %d:%d:%d" % (read_start_time.hour, read_start_time.minute, read_start_time.second))
-    print("harness finished at %d:%d:%d" % (finish_time.hour, finish_time.minute, finish_time.second))
+def prepareHarnessYearRuns(treatment_scenario, basin=None, weather_years=None, trace=None):
+    # One prepared run per weather year (default: all MODEL_YEARS). The inputs
+    #   are generated once and linked into every year's run dir; only the INPUT
+    #   files differ.
+    if weather_years == None:
+        weather_years = list(ucsrb_settings.MODEL_YEARS.keys())
+    run_inputs = getHarnessRunInputs(treatment_scenario, basin, trace)
+    harness_runs = []
+    try:
+        for weather_year in weather_years:
+            shared_inputs_dir = os.path.join(harness_runs[0]['run_dir'], 'ts_inputs') if harness_runs else None
+            harness_runs.append(prepareHarnessRun(treatment_scenario, basin, weather_year, run_inputs, shared_inputs_dir, trace))
+    except BaseException:
+        for harness_run in harness_runs:
+            scratch.release_run(harness_run['run_dir'])
+        raise
+    return harness_runs
+
+def runHarnessModels(harness_runs, cores=SCHEDULER_CORES, num_cores=RUN_CORES, poll_interval=SCHEDULER_POLL_SECONDS):
+    # Run DHSVM for every harness run without archived results, as many at once
+    #   as fit in 'cores' (at least one). Returns {weather year: exit status}.
+    #   Only sleeps while no run has finished, so a freed slot is refilled at once.
+    concurrent_runs = max(1, cores//num_cores)
+    pending_runs = [x for x in harness_runs if not x['archived_flow_file']]
+    running = []
+    returncodes = {}
+    try:
+        while pending_runs or running:
+            while pending_runs and len(running) < concurrent_runs:
+                harness_run = pending_runs.pop(0)
+                running.append((harness_run, startHarnessModel(harness_run, num_cores)))
+            finished = [x for x in running if x[1].poll() != None]
+            for (harness_run, process) in finished:
+                running.remove((harness_run, process))
+                returncodes[harness_run['weather_year']] = process.returncode
+                print('DHSVM %s run finished at %s with status %s' % (harness_run['weather_year'], str(datetime.now()), process.returncode))
+            if running and not finished:
+                time.sleep(poll_interval)
+    finally:
+        stopHarnessModels([x[1] for x in running])
+    return returncodes
+
+def readStreamFlowYears(harness_runs, treatment_scenario=None, returncodes=None):
+    # Import every year's Stream.Flow in one transaction through a single COPY
+    #   loader, so the scenario's years appear together. Years whose model
+    #   run failed are left out (and their results not archived).
+    if returncodes == None:
+        returncodes = {}
+    imported_runs = []
+    for harness_run in harness_runs:
+        if returncodes.get(harness_run['weather_year'], 0) != 0:
+            print('DHSVM exited with status %s for %s: not imported' % (returncodes[harness_run['weather_year']], harness_run['weather_year']))
+        else:
+            imported_runs.append(harness_run)
+    with transaction.atomic():
+        with StreamFlowCopyLoader() as loader:
+            for harness_run in imported_runs:
+                flow_file = harness_run['archived_flow_file'] if harness_run['archived_flow_file'] else harness_run['flow_file']
+                readStreamFlowData(flow_file, segment_ids=harness_run['segment_ids'], scenario=treatment_scenario, is_baseline=harness_run['is_baseline'], loader=loader)
+    for harness_run in harness_runs:
+        archiveHarnessRun(harness_run, returncodes.get(harness_run['weather_year'], 0))
+
+def runHarnessConfigYears(treatment_scenario, basin=None, weather_years=None, cores=SCHEDULER_CORES):
+    # runHarnessConfig for several weather years (default: all MODEL_YEARS) at once
+    trace = getRunTrace(treatment_scenario, basin)
+    harness_runs = []
+    try:
+        harness_runs = prepareHarnessYearRuns(treatment_scenario, basin, weather_years, trace)
+
+        with trace_stage(trace, 'model'):
+            returncodes = runHarnessModels(harness_runs, cores)
+
+        with trace_stage(trace, 'readStreamFlowData'):
+            readStreamFlowYears(harness_runs, treatment_scenario, returncodes)
+    finally:
+        for harness_run in harness_runs:
+            scratch.release_run(harness_run['run_dir'])
+        writeRunTrace(trace)
+    return returncodes
@@ -1,15 +1,20 @@
-import os, sys, getopt, shutil, json, statistics
+import os, sys, getopt, shutil, json
 
-from dhsvm_harness.settings import FLOW_METRICS, TIMESTEP, ABSOLUTE_FLOW_METRIC, DELTA_FLOW_METRIC
+from dhsvm_harness import flow_index, metrics, metrics_cache
+from dhsvm_harness.settings import FLOW_METRICS, TIMESTEP, ABSOLUTE_FLOW_METRIC, DELTA_FLOW_METRIC, METRICS_CACHE_DIR
 
 def main(argv):
-    help_text = "usage: get_flow_metrics.py -s <numeric segment id> -i <path to the raw Stream.Flow file> -o <path to output data file>"
+    help_text = "usage: get_flow_metrics.py -s <numeric segment id> -i <path to the raw Stream.Flow file> -o <path to output data file> -f <output format: json (default) or npz> -m <comma-separated flow metrics (default: all)> -w <worker processes (default: 1)> -n (skip the metrics cache)"
     input_flow = False
     output_flow = False
     segment_id = None
+    output_format = 'json'
+    metric_keys = None
+    workers = 1
+    use_cache = METRICS_CACHE_DIR != None
 
     try:
-        opts, args = getopt.getopt(argv, "hs:i:o:", ["segment_id=", "input_flow=", "output_flow="])
+        opts, args = getopt.getopt(argv, "hs:i:o:f:m:w:n", ["segment_id=", "input_flow=", "output_flow=", "format=", "metrics=", "workers=", "no_cache"])
     except getopt.GetoptError:
         print(help_text)
         sys.exit(2)
@@ -24,6 +29,21 @@ def main(argv):
             input_flow = arg
         elif opt in ("-o", "--output_flow"):
             output_flow = arg
+        elif opt in ("-f", "--format"):
+            output_format = arg.lower()
+        elif opt in ("-m", "--metrics"):
+            metric_keys = [x.strip() for x in arg.split(',') if x.strip()]
+        elif opt in ("-w", "--workers"):
+            try:
+                workers = int(arg)
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                print("Workers (-w) must be a positive integer.")
+                print(help_text)
+                sys.exit(1)
+        elif opt in ("-n", "--no_cache"):
+            use_cache = False
 
     if not segment_id:
         print("No 'segment id' provided.")
@@ -33,6 +53,12 @@ def main(argv):
         else:
             print("Script terminated by user.")
             sys.exit(0)
+    if segment_id != 'all':
+        try:
+            segment_id = metrics.format_segment_id(segment_id)
+        except ValueError as e:
+            print("%s. Quitting...\n" % e)
+            sys.exit(1)
     if not input_flow:
         print("Please provide an input (-i) file of flow data (Stream.Flow).")
         print(help_text)
@@ -41,6 +67,14 @@ def main(argv):
         print("Please provide an output (-o) file to write the interpreted flow data to.")
         print(help_text)
         sys.exit(1)
+    if not output_format in ['json', 'npz']:
+        print("Unknown output format '%s'. Use 'json' or 'npz'." % output_format)
+        print(help_text)
+        sys.exit(1)
+    for metric_key in metric_keys if metric_keys else []:
+        if not metric_key in FLOW_METRICS.keys():
+            print("Unknown flow metric '%s'. Choose from: %s" % (metric_key, ', '.join(FLOW_METRICS.keys())))
+            sys.exit(1)
     if not os.path.isfile(input_flow):
         print("Provided input directory '%s' not recognized, or is not a directory." % input_flow)
         print(help_text)
@@ -54,14 +88,40 @@ def main(argv):
             print("Script terminated by user.")
             sys.exit(0)
 
-    input_flow_file = open(input_flow, 'r')
-    inlines = input_flow_file.readlines()
-    input_flow_file.close()
+    if use_cache:
+        # per-segment results keyed by the file's content hash: a repeat
+        #   analysis loads them without parsing the Stream.Flow at all
+        segment_ids = None if segment_id == 'all' else [segment_id]
+        segment_results = metrics_cache.get_cached_segment_results(input_flow, segment_ids, metric_keys, workers)
+        if output_format == 'npz':
+            (timestamps, segment_names, metric_arrays) = metrics.stack_segment_results(segment_results, metric_keys)
+            metrics.write_flow_metrics_npz(output_flow, timestamps, segment_names, metric_arrays)
+        else:
+            with open(output_flow, 'w') as output_flow_file:
+                json.dump(metrics.segment_results_to_json(segment_results), output_flow_file)
+        return
+
+    if segment_id == 'all':
+        input_flow_file = open(input_flow, 'r')
+        inlines = input_flow_file.readlines()
+        input_flow_file.close()
+    else:
+        # seek straight to the segment's rows rather than scanning every line
+        index = flow_index.get_stream_flow_index(input_flow)
+        inlines = list(flow_index.read_indexed_lines(input_flow, index, [segment_id]))
+
+    if output_format == 'npz':
+        # columnar: shared timestamps + a float32 (segment x timestep) matrix per metric.
+        #   Read back with dhsvm_harness.metrics.load_flow_metrics_npz (memory-mapped)
+        segment_ids = get_segment_id_list(inlines) if segment_id == 'all' else [segment_id]
+        (timestamps, segment_names, metric_arrays) = metrics.get_flow_metric_arrays(inlines, segment_ids, metric_keys, workers)
+        metrics.write_flow_metrics_npz(output_flow, timestamps, segment_names, metric_arrays)
+        return
 
     if not segment_id == 'all':
-        flow_json = aggregate_flow_results(inlines, segment_id)
+        flow_json = aggregate_flow_results(inlines, segment_id, metric_keys)
     else:
-        flow_json = aggregate_flow_results(inlines)
+        flow_json = aggregate_flow_results(inlines, metric_keys=metric_keys, workers=workers)
 
     with open(output_flow, 'w') as output_flow_file:
          json.dump(flow_json, output_flow_file)
@@ -75,21 +135,12 @@ def get_segment_id_list(inlines):
         segment_id.append(line_list[-1].split('"')[1])
     return segment_id
 
-def aggregate_flow_results(inlines, segment_ids='all'):
+def aggregate_flow_results(inlines, segment_ids='all', metric_keys=None, workers=1):
     if not isinstance(segment_ids, list):
-        if isinstance(segment_ids, int):
-            segment_ids = ["shed_%s" % segment_ids]
-        elif isinstance(segment_ids, str):
-            if segment_ids == 'all':
-                segment_ids = get_segment_id_list(inlines)
-            elif 'shed_' in segment_ids and isinstance(int(segment_ids.split('shed_')[1]), int):
-                segment_ids = [segment_ids]
-            else:
-                print("Unknown segment ID value: '%s'. Quitting...\n" % segment_ids)
-                sys.exit(1)
+        if segment_ids == 'all':
+            segment_ids = get_segment_id_list(inlines)
         else:
-            print("Unknown segment ID value: '%s'. Quitting...\n" % segment_ids)
-            sys.exit(1)
+            segment_ids = [metrics.format_segment_id(segment_ids)]
 
     # if segment_ids == 'all':
     #     return_val = metrics
@@ -98,11 +149,9 @@ def aggregate_flow_results(inlines, segment_ids='all'):
     #     for segment in segment_ids:
     #         return_val[segment] = metrics[segment]
     # return return_val
-    return get_metric_flow(inlines, segment_ids)
+    return get_metric_flow(inlines, segment_ids, metric_keys, workers)
 
-def get_metric_flow(inlines, segment_ids=False):
-    readings_per_day = 24/TIMESTEP
-    segments = {}
+def get_metric_flow(inlines, segment_ids=False, metric_keys=None, workers=1):
     # Stream Flow Columns:
     #   https://www.pnnl.gov/sites/default/files/media/file/Network%20segment%20output%20file.pdf
     #   0   str     Time Stamp
@@ -120,81 +169,12 @@ def get_metric_flow(inlines, segment_ids=False):
     #           ]
     #   7   (T)fl   Estimate of mass balance error
     #   8   (T)str  "Totals" identifier
-    for line in inlines:
-        data = line.split()
-        segment_name = data[-1].split('"')[1]
-        timestamp = data[0]
-        if not segment_ids or segment_name in segment_ids:
-            if not segment_name in segments.keys() and segment_ids and segment_name in segment_ids:
-                segments[segment_name] = {}     # metric dict for this segment
-                for metric_key in FLOW_METRICS.keys():
-                    segments[segment_name][metric_key] = []
-            for metric_key in FLOW_METRICS.keys():
-                if FLOW_METRICS[metric_key]['measure'] == 'abs':    # Establish abs flow rates/deltas for future reference
-                    if FLOW_METRICS[metric_key]['delta']:
-                        # Assumes 'Absolute Flow Rate' has already been addressed for this segment's timestep
-                        if len(segments[segment_name][ABSOLUTE_FLOW_METRIC]) > 1:
-                            value = segments[segment_name][ABSOLUTE_FLOW_METRIC][-1]['value'] - segments[segment_name][ABSOLUTE_FLOW_METRIC][-2]['value']
-                        else:
-                            value = 0
-                        segments[segment_name][metric_key].append({
-                            'timestep': timestamp,
-                            'value': value
-                        })
-                    else:
-                        segments[segment_name][metric_key].append({
-                            'timestep': timestamp,
-                            'value': float(data[4])/float(TIMESTEP)
-                        })
-                else:
-                    relevant_readings = int(FLOW_METRICS[metric_key]['period']*readings_per_day)
-                    if not FLOW_METRICS[metric_key]['delta']:
-                        readings = [x['value'] for x in segments[segment_name][ABSOLUTE_FLOW_METRIC][-relevant_readings:]]
-                        if FLOW_METRICS[metric_key]['measure'] == 'mean':
-                            segments[segment_name][metric_key].append({
-                                'timestep': timestamp,
-                                'value': statistics.mean(readings)
-                            })
-                        else:
-                            readings.sort()
-                            segments[segment_name][metric_key].append({
-                                'timestep': timestamp,
-                                'value': readings[0]
-                            })
-                    else:
-                        try:
-                            previous_value = segments[segment_name][metric_key][-1]['value']
-                        except IndexError:
-                            previous_value = False
-                        if FLOW_METRICS[metric_key]['period'] == 7:
-                            period = "Seven"
-                        else:
-                            period = "One"
-                        source_metric = "%s Day %s Flow" % (period, FLOW_METRICS[metric_key]['measure'].title())
-                        readings = [x['value'] for x in segments[segment_name][source_metric][-relevant_readings:]]
-                        if FLOW_METRICS[metric_key]['measure'] == 'mean':
-                            if previous_value:
-                                value = statistics.mean(readings)-previous_value
-                            else:
-                                value = 0
-                            segments[segment_name][metric_key].append({
-                                'timestep': timestamp,
-                                'value': value
-                            })
-                        else:
-                            readings.sort()
-                            if previous_value:
-                                value = readings[0]-previous_value
-                            else:
-                                value = 0
-                            segments[segment_name][metric_key].append({
-                                'timestep': timestamp,
-                                'value': value
-                            })
-
-
-
-    return segments
+    # Each segment is loaded into a float64 array and the requested FLOW_METRICS
+    #   series (all when metric_keys is None), plus only the series they depend
+    #   on, are computed with vectorized O(n) rolling kernels (dhsvm_harness.metrics).
+    #   With workers > 1, segments are split across a process pool that reads
+    #   the series from a memory-mapped file instead of pickling them.
+    return metrics.get_metric_flow(inlines, segment_ids, metric_keys, workers)
 
 
 if __name__ == "__main__":
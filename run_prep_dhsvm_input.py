@@ -8,8 +8,10 @@ import rasterio
 import zipfile
 import configparser
 import json
+import numpy
 
 import settings
+from dhsvm_harness import grid
 
 def clip_stream_map(mask_dict, source_map_file, out_map_file):
     MASK_HEADER_OFFSET = 6
@@ -215,26 +217,6 @@ def main(argv):
             print("use of shp as mask is in active development. please stand by. in the mean time feel free to use an ascii mask with header")
         #    sys.exit()
 
-        else:
-            mask_feature = os.path.join(masked_dir, "basin.geojson")
-
-            # Convert ascii to geojson feature
-            os.system("rio shapes --projected %s > %s" % (mask, mask_feature))
-
-            # mask_geojson_dump = {
-            #     "type": "FeatureCollection",
-            #     "features": []
-            # }
-            #
-            # with open(mask_feature, "r+") as open_mask:
-            #     for feat in open_mask:
-            #         # store rio output shape in var
-            #         mask_feat = json.loads(feat)
-            #         # add the rio output to formatted GEOJson
-            #         mask_geojson_dump["features"].append(mask_feat)
-            #     open_mask.seek(0,0)
-            #     open_mask.write(json.dumps(mask_geojson_dump))
-            #     open_mask.close()
 
 
     # if not dhsvm_build_path:
@@ -301,102 +283,24 @@ def main(argv):
     yllcorner = float(yllcorner) - (int(number_of_rows) * float(cellsize))
 
 
-    # Convert bin to ascii
-    ######################
-
-    # path to myconvert
-    myconvert = os.path.join(dhsvm_build_path, 'DHSVM', 'program', 'myconvert')
-
-    # myconvert conversion type for each data file
-    # ASSUPTION: basin name never contains '_'
-
-    data_types = {
-        "_dem": {
-            "type": "float",
-            "nodata": "-9999"
-        },
-        "_dir": {
-            "type": "character",
-            "nodata": "0"
-        },
-        "_mask": {
-            "type": "character",
-            "nodata": "0"
-        },
-        "_soild": {
-            "type": "float",
-            "nodata": "-9999"
-        },
-        "_soiltype": {
-            "type": "character",
-            "nodata": "0"
-        },
-        "_veg": {
-            "type": "character",
-            "nodata": "0"
-        }
-    }
-
-    # Now create the rest of the data files
-    for input in os.listdir(basin_orig_input_files_dir):
-        input_extension = os.path.splitext(input)[-1]
-        if input_extension == '.bin':
-            # splittext gives us the name bc its form ('<data>.asc', '.bin')
-            unmasked_asc_name = os.path.splitext(input)[0]
-            unmasked_asc_path = os.path.abspath(os.path.join(basin_orig_input_files_dir, unmasked_asc_name))
-            unmasked_bin_path = os.path.abspath(os.path.join(basin_orig_input_files_dir, input))
-            for key in data_types:
-                if key in input:
-                    use_type = data_types[key]
-            os.system(
-                "%s %s ascii %s %s %s %s"
-                % (myconvert, use_type['type'], unmasked_bin_path, unmasked_asc_path, parent_basin['nrows'], parent_basin['ncols'])
-            )
-            # print("myconvert to ascii \npath: %s \ntype: %s \noutput: %s" % (unmasked_bin_path, use_type, unmasked_asc_path))
-            # print("myconvert to ascii INPUT %s" % input)
-            print("%s %s ascii %s %s %s %s"
-            % (myconvert, use_type['type'], unmasked_bin_path, unmasked_asc_path, parent_basin['nrows'], parent_basin['ncols']))
-
-            # Save full basin mask path for later
-            # if "mask" in unmasked_asc_name:
-            #     entire_basin_mask = unmasked_asc_path
-
-    # check that entire basin mask file is created
-    # try:
-    #     os.path.isfile(entire_basin_mask)
-    # except OSError:
-    #     print("Missing mask of entire basin: %s \nCheck that a mask file is in the orig_inputs directory" % entire_basin_mask)
-    #     sys.exit()
-
-
-    # Add Header to ascii files
-    ###########################
-    # unmasked_ascii_header = "ncols        %s\nnrows        %s\nxllcorner    %s\nyllcorner    %s\ncellsize     %s\nNODATA_value  %s\n" % (
-    #     parent_basin['ncols'], parent_basin['nrows'], xllcorner, yllcorner, cellsize, NODATA_value
-    # )
-    # ascii_header = "ncols        %s\nnrows        %s\nxllcorner    %s\nyllcorner    %s\ncellsize     %s\nNODATA_value  %s\n" % (number_of_columns, number_of_rows, xllcorner, yllcorner, cellsize, NODATA_value)
-
-    for input_file in os.listdir(basin_orig_input_files_dir):
-        for key in data_types:
-            if key in input_file:
-                use_type = data_types[key]
-        unmasked_ascii_header = "ncols        %s\nnrows        %s\nxllcorner    %s\nyllcorner    %s\ncellsize     %s\nNODATA_value  %s\n" % (
-            parent_basin['ncols'], parent_basin['nrows'], parent_basin['xllcorner'], parent_basin['yllcorner'], cellsize, use_type['nodata']
-        )
-        input_extension = os.path.splitext(input_file)[-1]
-        if input_extension == '.asc':
-            input_path = os.path.abspath(os.path.join(basin_orig_input_files_dir, input_file))
-            ascii_file = open(input_path, "r+")
-            content = ascii_file.read()
-            ascii_file.seek(0,0)
-            ascii_file.write(unmasked_ascii_header + content)
-            ascii_file.close()
-
-    # Overwrite full basin mask with desired mask
-    #############################################
-
-    # os.system('cp %s %s' % (mask, entire_basin_mask))
+    # Grid window of the mask within the parent basin
+    ##################################################
+    # Basin inputs are memory-mapped .asc.bin grids (see dhsvm_harness.grid):
+    #   masking crops each one to the mask's window and writes it straight back
+    #   out as .asc.bin, with no myconvert, header, gdal or sed round-trips.
 
+    mask_grid_def = {
+        'ncols': int(mask_ncols),
+        'nrows': int(mask_nrows),
+        'xllcorner': float(mask_xllcorner),
+        'yllcorner': float(mask_yllcorner),
+        'cellsize': float(cellsize),
+    }
+    parent_grid_def = dict(parent_basin)
+    parent_grid_def['cellsize'] = float(cellsize)
+    mask_window = grid.get_grid_window(parent_grid_def, mask_grid_def)
+    # cells outside the mask (NODATA, 0) are set to each grid's nodata value
+    outside_mask = numpy.loadtxt(mask, skiprows=6) == 0
 
     # Add crs to ascii files
     ########################
@@ -434,25 +338,19 @@ def main(argv):
     for unmasked_file in os.listdir(basin_orig_input_files_dir):
         input_extension = os.path.splitext(unmasked_file)[-1]
         print("masking INPUT file %s" % unmasked_file)
-        if input_extension == ".asc":
-            mask_json = os.path.join(masked_dir, "basin.geojson")
-            input_unmasked_ascii = os.path.abspath(os.path.join(basin_orig_input_files_dir, unmasked_file))
-            input_unmasked_tiff = "%s.tif" % input_unmasked_ascii
-            output_masked_ascii = os.path.abspath(os.path.join(masked_dir, unmasked_file))
-            output_masked_tiff = "%s.tiff" % output_masked_ascii
-            os.system("gdal_translate -of \"GTiff\" %s %s" % (input_unmasked_ascii,input_unmasked_tiff))
-            os.system("rio mask %s %s --crop --overwrite --geojson-mask %s" % (input_unmasked_tiff, output_masked_tiff, mask_json))
-            os.system("gdal_translate -of \"AAIGrid\" %s %s" % (output_masked_tiff,output_masked_ascii))
-            os.system("sed -i 's/^[ \t]*//g' %s" % output_masked_ascii )
-            os.system("sed -i 's/ /\t/g' %s" % output_masked_ascii )
-            os.system("sed -i 's/$/\t/g' %s" % output_masked_ascii )
-            # Delete tiffs and unmasked ascii
-            # print("REMOVING file %s" % input_unmasked_ascii)
-            # os.remove(input_unmasked_ascii)
-            print("REMOVING file %s" % input_unmasked_tiff)
-            os.remove(input_unmasked_tiff)
-            print("REMOVING file %s" % output_masked_tiff)
-            os.remove(output_masked_tiff)
+        if input_extension == ".bin":
+            use_type = grid.get_grid_data_type(unmasked_file)
+            if use_type == None:
+                print("no DHSVM data type known for %s, skipping" % unmasked_file)
+                continue
+            input_unmasked_bin = os.path.abspath(os.path.join(basin_orig_input_files_dir, unmasked_file))
+            output_masked_bin = os.path.abspath(os.path.join(masked_dir, unmasked_file))
+            unmasked_grid = grid.open_dhsvm_grid(input_unmasked_bin, parent_grid_def, use_type['type'])
+            masked_grid = grid.open_dhsvm_grid(output_masked_bin, mask_grid_def, use_type['type'], mode='w+')
+            numpy.copyto(masked_grid, grid.read_grid_window(unmasked_grid, mask_window))
+            masked_grid[outside_mask] = use_type['nodata']
+            masked_grid.flush()
+            del unmasked_grid, masked_grid
         elif input_extension == '.dat' and 'stream' in unmasked_file and 'map' in unmasked_file:
             mask_dict = {
                 'ncols': int(mask_ncols),
@@ -468,49 +366,6 @@ def main(argv):
             in_map_file = os.path.join(basin_orig_input_files_dir,unmasked_file)
             clip_stream_map(mask_dict, in_map_file, out_map_file)
 
-    # Remove header from ascii
-    ##########################
-    try:
-        basin_masked_files = os.listdir(masked_dir)
-    except OSError:
-        print(
-            "Path not found: %s. Please make a masked directory in your basins inputs directory."
-            % masked_dir
-        )
-        sys.exit()
-
-    # Off with their heads!
-    for masked_file in basin_masked_files:
-        input_extension = os.path.splitext(masked_file)[-1]
-        if input_extension == '.asc':
-            input_path = os.path.abspath(os.path.join(masked_dir, masked_file))
-            ascii_file = open(input_path, "r+")
-            content_lines = ascii_file.readlines()
-            ascii_file.seek(0,0)
-            count = 0
-            for l in content_lines:
-                if count > 5:
-                    ascii_file.write(l)
-                count += 1
-            ascii_file.close()
-
-    # Convert ascii to bin
-    ######################
-
-    for masked_file in basin_masked_files:
-        input_extension = os.path.splitext(masked_file)[-1]
-        if input_extension == '.asc':
-            masked_bin_name = os.path.splitext(masked_file)[0] + ".asc.bin"
-            masked_bin_path = os.path.abspath(os.path.join(masked_dir, masked_bin_name))
-            masked_ascii_path = os.path.abspath(os.path.join(masked_dir, masked_file))
-            for key in data_types:
-                if key in masked_file:
-                    use_type = data_types[key]
-            os.system(
-                "%s ascii %s %s %s %s %s"
-                % (myconvert, use_type['type'], masked_ascii_path, masked_bin_path, mask_nrows, mask_ncols)
-            )
-
     # Update INPUT config file
     ##########################
 